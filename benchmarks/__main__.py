@@ -0,0 +1,315 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, List, Optional
+
+import aiohttp
+
+from benchmarks.fake_fleet import fleet_hosts, raise_open_files_limit
+from master.remote_workers_manager import RemoteWorkerManager
+from master.workers_poller import WorkersPoller
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+COMPARED_METRICS = (
+    "startup_sec",
+    "poll_cycle_sec.p50",
+    "poll_cycle_sec.p95",
+    "detect_failure_sec",
+    "scale_out_sec",
+    "master_cpu_sec",
+    "master_rss_mb",
+)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def install_ssh_stand_in(bin_dir: str) -> None:
+    stand_in = os.path.join(BENCH_DIR, "ssh_stand_in.py")
+    for program in ("ssh", "scp"):
+        path = os.path.join(bin_dir, program)
+        with open(path, "w") as script:
+            script.write(f'#!/bin/sh\nexec "{sys.executable}" "{stand_in}" {program} "$@"\n')
+        os.chmod(path, 0o755)
+
+
+def summarize(values: List[float]) -> dict:
+    ordered = sorted(values)
+    return {
+        "mean": statistics.mean(ordered),
+        "p50": ordered[len(ordered) // 2],
+        "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        "max": ordered[-1],
+    }
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def wait_until(
+    predicate: Callable[[], bool], timeout: float, step: float = 0.02
+) -> Optional[float]:
+    started = time.monotonic()
+    while not predicate():
+        if time.monotonic() - started > timeout:
+            return None
+        await asyncio.sleep(step)
+    return time.monotonic() - started
+
+
+async def poll_loop(poller: WorkersPoller, reconcile: bool) -> None:
+    # Same loop as WorkersPoller without its startup and error handling
+    while True:
+        cycle_duration = await poller.poll_cycle()
+        if reconcile:
+            await poller.worker_manager.check_and_scale_workers()
+        await asyncio.sleep(max(0.0, poller.interval - cycle_duration))
+
+
+def healthy_count(manager: RemoteWorkerManager) -> int:
+    return manager.workers_data.count("healthy")
+
+
+class Fleet:
+    def __init__(self, args: argparse.Namespace, workers: int, spare: int):
+        self.args = args
+        self.workers = workers
+        self.hosts = fleet_hosts(workers + spare)
+        self.worker_port = free_port()
+        self.control_url = f"http://127.0.0.1:{free_port()}"
+        self.process = None
+        self.session = None
+
+    async def __aenter__(self) -> "Fleet":
+        args = self.args
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "-m",
+            "benchmarks.fake_fleet",
+            "--hosts", str(len(self.hosts)),
+            "--deployed", str(self.workers),
+            "--worker-port", str(self.worker_port),
+            "--control-port", self.control_url.rpartition(":")[2],
+            "--latency", str(args.latency),
+            "--jitter", str(args.jitter),
+            "--failure-rate", str(args.failure_rate),
+            "--cpu", str(args.cpu),
+            "--memory", str(args.memory),
+            "--deploy-delay", str(args.deploy_delay),
+            cwd=REPO_DIR,
+        )
+        # The ssh stand-in forwards remote commands to this fleet
+        os.environ["BENCH_FLEET_URL"] = self.control_url
+        self.session = aiohttp.ClientSession()
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                await self.stats()
+                return self
+            except aiohttp.ClientError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError("Fake fleet did not start")
+                await asyncio.sleep(0.05)
+
+    async def stats(self) -> dict:
+        async with self.session.get(f"{self.control_url}/stats") as response:
+            return await response.json()
+
+    async def update(self, **fields) -> None:
+        async with self.session.post(f"{self.control_url}/workers", json=fields) as response:
+            response.raise_for_status()
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.session.close()
+        self.process.kill()
+        await self.process.wait()
+
+
+async def bench_fleet_size(workers: int, args: argparse.Namespace) -> dict:
+    spare = max(2, workers // 5)
+    result = {"workers": workers, "spare_hosts": spare}
+    async with Fleet(args, workers, spare) as fleet:
+        manager = RemoteWorkerManager(
+            app_info={"image": "bench_app", "app_port": 5000, "healthcheck": "/"},
+            worker_info={"port": fleet.worker_port},
+            worker_limits={
+                "min_workers": 1,
+                "max_workers": workers + spare,
+                "cpu_limit": 80,
+                "memory_limit": 80,
+            },
+            virtual_machines=fleet.hosts,
+            operations_info={"readiness_max_delay": 0.5},
+        )
+        poller = WorkersPoller(
+            manager,
+            interval=args.interval,
+            concurrency=args.concurrency,
+            request_timeout=args.request_timeout,
+        )
+        cpu_started = time.process_time()
+        async with aiohttp.ClientSession() as session:
+            poller.session = manager.session = session
+
+            started = time.monotonic()
+            await manager.initialize_workers_data(poller.request_timeout)
+            result["startup_sec"] = time.monotonic() - started
+
+            cycle_cpu_started = time.process_time()
+            cycles = [await poller.poll_cycle() for _ in range(args.cycles)]
+            result["poll_cycle_sec"] = summarize(cycles)
+            result["poll_cycle_cpu_sec"] = (time.process_time() - cycle_cpu_started) / args.cycles
+
+            # Failure detection, a tenth of the fleet stops answering
+            failed_hosts = fleet.hosts[: max(1, workers // 10)]
+            failed_workers = [f"bench-worker-{index}" for index in range(len(failed_hosts))]
+            await fleet.update(hosts=failed_hosts, mode=args.failure_mode)
+            loop = asyncio.create_task(poll_loop(poller, reconcile=False))
+            result["detect_failure_sec"] = await wait_until(
+                lambda: all(
+                    manager.workers_data[worker_name].get("status") != "healthy"
+                    for worker_name in failed_workers
+                ),
+                args.timeout,
+            )
+            loop.cancel()
+            await fleet.update(hosts=failed_hosts, mode="up")
+            manager.breakers.breakers.clear()
+            await poller.poll_cycle()
+
+            # Scale-out, the whole fleet goes over the CPU limit
+            await fleet.update(cpu_usage=95.0)
+            loop = asyncio.create_task(poll_loop(poller, reconcile=True))
+            result["scale_out_sec"] = await wait_until(
+                lambda: healthy_count(manager) > workers, args.timeout
+            )
+            loop.cancel()
+            await asyncio.gather(*manager.operations.tasks, return_exceptions=True)
+
+        result["master_cpu_sec"] = time.process_time() - cpu_started
+        result["master_rss_mb"] = rss_mb()
+        result["fleet"] = await fleet.stats()
+    await manager.ssh_pool.close()
+    return result
+
+
+def metric(result: dict, path: str) -> Optional[float]:
+    for key in path.split("."):
+        if not isinstance(result, dict):
+            return None
+        result = result.get(key)
+    return result
+
+
+def compare(results: List[dict], baseline_path: str) -> None:
+    with open(baseline_path) as baseline_file:
+        baseline = {
+            result["workers"]: result for result in json.load(baseline_file)["results"]
+        }
+    for result in results:
+        previous = baseline.get(result["workers"])
+        if previous is None:
+            continue
+        for path in COMPARED_METRICS:
+            old, new = metric(previous, path), metric(result, path)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old * 100 if old else 0.0
+            print(
+                f"{result['workers']:>6} workers  {path:<22} {old:10.3f} -> {new:10.3f}"
+                f"  ({change:+.1f}%)",
+                file=sys.stderr,
+            )
+
+
+async def run(args: argparse.Namespace) -> dict:
+    results = []
+    for workers in args.workers:
+        logger.info(f"Benchmarking {workers} workers")
+        results.append(await bench_fleet_size(workers, args))
+    return {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "started_at": time.time(),
+        "config": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("output", "compare", "log_level")
+        },
+        "results": results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Orchestrator benchmark on a fake fleet")
+    parser.add_argument("--workers", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--cycles", type=int, default=5)
+    parser.add_argument("--interval", type=float, default=1.0)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--request-timeout", type=float, default=5.0)
+    parser.add_argument("--latency", type=float, default=0.005)
+    parser.add_argument("--jitter", type=float, default=0.005)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--failure-mode", choices=("refuse", "hang"), default="refuse")
+    parser.add_argument("--cpu", type=float, default=20.0)
+    parser.add_argument("--memory", type=float, default=30.0)
+    parser.add_argument("--deploy-delay", type=float, default=0.5)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--output", help="write results JSON here instead of stdout")
+    parser.add_argument("--compare", help="previous results JSON to compare against")
+    parser.add_argument("--log-level", default="CRITICAL", help="log level of the master")
+    args = parser.parse_args()
+
+    logging.getLogger("master").setLevel(args.log_level)
+    raise_open_files_limit()
+    os.environ.setdefault("SSH_USER", "bench")
+    bin_dir = tempfile.mkdtemp(prefix="orchestrator-bench-")
+    install_ssh_stand_in(bin_dir)
+    os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+
+    report = asyncio.run(run(args))
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+    if args.compare:
+        compare(report["results"], args.compare)
+
+
+if __name__ == "__main__":
+    main()
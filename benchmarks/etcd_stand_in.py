@@ -0,0 +1,150 @@
+import argparse
+import base64
+import time
+from typing import Dict, Optional
+
+from aiohttp import web
+
+
+# Stands in for etcd when running several masters locally: the leases, keys
+# and the create-if-absent transaction of the v3 JSON gateway, in memory.
+class EtcdStandIn:
+    def __init__(self):
+        self.revision = 0
+        self.next_lease = 1
+        # lease id -> (ttl, monotonic expiry)
+        self.leases: Dict[str, tuple] = {}
+        # key bytes -> {"value", "create_revision", "mod_revision", "lease"}
+        self.kvs: Dict[bytes, dict] = {}
+
+    def expire_leases(self) -> None:
+        now = time.monotonic()
+        for lease, (_, expires_at) in list(self.leases.items()):
+            if expires_at <= now:
+                self.drop_lease(lease)
+
+    def drop_lease(self, lease: str) -> None:
+        self.leases.pop(lease, None)
+        for key, kv in list(self.kvs.items()):
+            if kv["lease"] == lease:
+                del self.kvs[key]
+                self.revision += 1
+
+    def put(self, body: dict) -> dict:
+        lease = body.get("lease")
+        if lease and str(lease) not in self.leases:
+            raise web.HTTPBadRequest(text="requested lease not found")
+        key = base64.b64decode(body["key"])
+        self.revision += 1
+        previous = self.kvs.get(key)
+        self.kvs[key] = {
+            "value": body.get("value", ""),
+            "create_revision": previous["create_revision"] if previous else self.revision,
+            "mod_revision": self.revision,
+            "lease": str(lease) if lease else None,
+        }
+        return {"header": self.header()}
+
+    def range(self, body: dict) -> dict:
+        key = base64.b64decode(body["key"])
+        range_end: Optional[bytes] = (
+            base64.b64decode(body["range_end"]) if body.get("range_end") else None
+        )
+        kvs = [
+            {
+                "key": base64.b64encode(stored_key).decode(),
+                "value": kv["value"],
+                "create_revision": str(kv["create_revision"]),
+                "mod_revision": str(kv["mod_revision"]),
+                **({"lease": kv["lease"]} if kv["lease"] else {}),
+            }
+            for stored_key, kv in sorted(self.kvs.items())
+            if (key <= stored_key < range_end if range_end else stored_key == key)
+        ]
+        response = {"header": self.header()}
+        if kvs:
+            response["kvs"] = kvs
+            response["count"] = str(len(kvs))
+        return response
+
+    def header(self) -> dict:
+        return {"revision": str(self.revision)}
+
+    async def handle_grant(self, request: web.Request) -> web.Response:
+        self.expire_leases()
+        ttl = int((await request.json())["TTL"])
+        lease = str(self.next_lease)
+        self.next_lease += 1
+        self.leases[lease] = (ttl, time.monotonic() + ttl)
+        return web.json_response({"header": self.header(), "ID": lease, "TTL": str(ttl)})
+
+    async def handle_keepalive(self, request: web.Request) -> web.Response:
+        self.expire_leases()
+        lease = str((await request.json())["ID"])
+        result = {"header": self.header(), "ID": lease}
+        if lease in self.leases:
+            ttl = self.leases[lease][0]
+            self.leases[lease] = (ttl, time.monotonic() + ttl)
+            result["TTL"] = str(ttl)
+        return web.json_response({"result": result})
+
+    async def handle_revoke(self, request: web.Request) -> web.Response:
+        self.expire_leases()
+        self.drop_lease(str((await request.json())["ID"]))
+        return web.json_response({"header": self.header()})
+
+    async def handle_put(self, request: web.Request) -> web.Response:
+        self.expire_leases()
+        return web.json_response(self.put(await request.json()))
+
+    async def handle_range(self, request: web.Request) -> web.Response:
+        self.expire_leases()
+        return web.json_response(self.range(await request.json()))
+
+    async def handle_txn(self, request: web.Request) -> web.Response:
+        # Only create_revision/value comparisons and puts, what the masters use
+        self.expire_leases()
+        body = await request.json()
+        succeeded = True
+        for compare in body.get("compare", []):
+            kv = self.kvs.get(base64.b64decode(compare["key"]))
+            if compare["target"] == "CREATE":
+                actual = kv["create_revision"] if kv else 0
+                expected = int(compare.get("create_revision", 0))
+            else:
+                actual = kv["value"] if kv else None
+                expected = compare.get("value")
+            if (actual == expected) != (compare.get("result", "EQUAL") == "EQUAL"):
+                succeeded = False
+        responses = []
+        for operation in body.get("success" if succeeded else "failure", []):
+            responses.append({"response_put": self.put(operation["request_put"])})
+        response = {"header": self.header(), "responses": responses}
+        if succeeded:
+            response["succeeded"] = True
+        return web.json_response(response)
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes(
+            [
+                web.post("/v3/lease/grant", self.handle_grant),
+                web.post("/v3/lease/keepalive", self.handle_keepalive),
+                web.post("/v3/lease/revoke", self.handle_revoke),
+                web.post("/v3/kv/put", self.handle_put),
+                web.post("/v3/kv/range", self.handle_range),
+                web.post("/v3/kv/txn", self.handle_txn),
+            ]
+        )
+        return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="In-memory etcd v3 stand-in")
+    parser.add_argument("--port", type=int, default=2379)
+    args = parser.parse_args()
+    web.run_app(EtcdStandIn().create_app(), host="127.0.0.1", port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+import argparse
+import asyncio
+import random
+import resource
+import shlex
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+SSH_OPTIONS_WITH_VALUE = ("-o", "-O", "-p", "-i", "-l")
+
+
+def fleet_hosts(count: int) -> List[str]:
+    # Loopback addresses, Linux routes all of 127.0.0.0/8 to lo
+    return [f"127.10.{index // 250}.{index % 250 + 1}" for index in range(count)]
+
+
+def raise_open_files_limit() -> None:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+class FakeWorker:
+    def __init__(self, host: str, cpu_usage: float, memory_usage: float):
+        self.host = host
+        self.name: Optional[str] = None
+        self.app_running = False
+        self.prepared = False
+        self.cpu_usage = cpu_usage
+        self.memory_usage = memory_usage
+        self.revision: Optional[str] = None
+        # Deploy manifest the master left on the VM
+        self.manifest = ""
+        # "up", "refuse" (drops connections) or "hang" (never answers)
+        self.mode = "up"
+
+    def status(self, noise: float) -> dict:
+        if self.app_running:
+            status = "healthy"
+        elif self.prepared:
+            status = "standby"
+        else:
+            status = "app_failed_worker_running"
+        return {
+            "worker_name": self.name,
+            "status": status,
+            "cpu_usage": max(0.0, self.cpu_usage + random.gauss(0, noise))
+            if self.app_running
+            else 0.0,
+            "memory_usage": self.memory_usage if self.app_running else 0.0,
+            "app_revision": self.revision if self.app_running else None,
+        }
+
+
+# Fake worker agents for every host on one port, plus a control API the ssh
+# stand-in and the benchmark use to deploy, remove and reconfigure them.
+class FakeFleet:
+    def __init__(
+        self,
+        hosts: List[str],
+        deployed: int,
+        worker_port: int,
+        control_port: int,
+        latency: float = 0.005,
+        jitter: float = 0.005,
+        failure_rate: float = 0.0,
+        cpu_usage: float = 20.0,
+        memory_usage: float = 30.0,
+        noise: float = 2.0,
+        deploy_delay: float = 0.5,
+        start_delay: float = 0.2,
+    ):
+        self.worker_port = worker_port
+        self.control_port = control_port
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.cpu_usage = cpu_usage
+        self.memory_usage = memory_usage
+        self.noise = noise
+        self.deploy_delay = deploy_delay
+        self.start_delay = start_delay
+        self.workers: Dict[str, FakeWorker] = {}
+        for index, host in enumerate(hosts):
+            worker = self.workers[host] = FakeWorker(host, cpu_usage, memory_usage)
+            if index < deployed:
+                worker.name = f"bench-worker-{index}"
+                worker.app_running = True
+            else:
+                worker.mode = "refuse"
+        self.requests = 0
+        self.ssh_commands = 0
+
+    async def start(self) -> None:
+        agent_app = web.Application()
+        agent_app.add_routes(
+            [
+                web.get("/status", self.handle_status),
+                web.post("/start_app", self.handle_start_app),
+                web.post("/prepare_app", self.handle_prepare_app),
+                web.post("/stop_app", self.handle_stop_app),
+                web.get("/connections", self.handle_connections),
+            ]
+        )
+        agent_runner = web.AppRunner(agent_app, access_log=None)
+        await agent_runner.setup()
+        for host in self.workers:
+            await web.TCPSite(agent_runner, host, self.worker_port).start()
+
+        control_app = web.Application()
+        control_app.add_routes(
+            [
+                web.post("/ssh", self.handle_ssh),
+                web.post("/workers", self.handle_update_workers),
+                web.get("/stats", self.handle_stats),
+            ]
+        )
+        control_runner = web.AppRunner(control_app, access_log=None)
+        await control_runner.setup()
+        await web.TCPSite(control_runner, "127.0.0.1", self.control_port).start()
+
+    async def worker_for(self, request: web.Request) -> FakeWorker:
+        self.requests += 1
+        worker = self.workers[request.transport.get_extra_info("sockname")[0]]
+        if worker.mode == "hang":
+            await asyncio.sleep(3600)
+        if worker.mode == "refuse":
+            request.transport.close()
+            raise web.HTTPServiceUnavailable()
+        await asyncio.sleep(max(0.0, self.latency + random.uniform(-1, 1) * self.jitter))
+        if random.random() < self.failure_rate:
+            raise web.HTTPInternalServerError(text="injected failure")
+        return worker
+
+    async def handle_status(self, request: web.Request) -> web.Response:
+        worker = await self.worker_for(request)
+        return web.json_response(worker.status(self.noise))
+
+    async def handle_start_app(self, request: web.Request) -> web.Response:
+        worker = await self.worker_for(request)
+        body = (await request.json() if request.can_read_body else None) or {}
+        await asyncio.sleep(self.start_delay)
+        worker.app_running = True
+        worker.prepared = False
+        worker.revision = body.get("revision")
+        return web.json_response({"message": "Application started successfully"})
+
+    async def handle_prepare_app(self, request: web.Request) -> web.Response:
+        worker = await self.worker_for(request)
+        await asyncio.sleep(self.start_delay)
+        worker.prepared = True
+        return web.json_response({"message": "Application prepared successfully"})
+
+    async def handle_stop_app(self, request: web.Request) -> web.Response:
+        worker = await self.worker_for(request)
+        worker.app_running = False
+        return web.json_response({"message": "Application stopped successfully"})
+
+    async def handle_connections(self, request: web.Request) -> web.Response:
+        await self.worker_for(request)
+        return web.json_response({"active_connections": 0})
+
+    async def handle_ssh(self, request: web.Request) -> web.Response:
+        self.ssh_commands += 1
+        argv = (await request.json())["argv"]
+        program, args = argv[0], argv[1:]
+        positional = []
+        skip = False
+        for arg in args:
+            if skip:
+                skip = False
+            elif arg in SSH_OPTIONS_WITH_VALUE:
+                skip = True
+            elif not arg.startswith("-") or positional:
+                positional.append(arg)
+        if program == "scp" or not positional:
+            return web.json_response({"returncode": 0, "stdout": "", "stderr": ""})
+
+        host = positional[0].rpartition("@")[2]
+        command = shlex.split(" ".join(positional[1:]))
+        worker = self.workers.get(host)
+        if worker is None:
+            return web.json_response(
+                {"returncode": 255, "stdout": "", "stderr": f"no route to {host}"}
+            )
+        if command and command[0].endswith("deploy_worker.sh"):
+            await asyncio.sleep(self.deploy_delay)
+            worker.name = command[2]
+            worker.app_running = worker.prepared = False
+            worker.cpu_usage, worker.memory_usage = self.cpu_usage, self.memory_usage
+            worker.mode = "up"
+        elif "printf" in command:
+            # mkdir -p .orchestrator && printf %s '<manifest>' > <path>
+            worker.manifest = command[command.index("printf") + 2]
+        elif "cat" in command:
+            return web.json_response({"returncode": 0, "stdout": worker.manifest, "stderr": ""})
+        elif command[:3] == ["docker", "rm", "-f"]:
+            worker.name = None
+            worker.app_running = worker.prepared = False
+            worker.mode = "refuse"
+        return web.json_response({"returncode": 0, "stdout": "", "stderr": ""})
+
+    async def handle_update_workers(self, request: web.Request) -> web.Response:
+        update = await request.json()
+        hosts = update.pop("hosts", None) or [
+            host for host, worker in self.workers.items() if worker.name
+        ]
+        for host in hosts:
+            for key, value in update.items():
+                setattr(self.workers[host], key, value)
+        return web.json_response({"updated": len(hosts)})
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "workers": sum(worker.name is not None for worker in self.workers.values()),
+                "requests": self.requests,
+                "ssh_commands": self.ssh_commands,
+            }
+        )
+
+
+async def serve(args: argparse.Namespace) -> None:
+    raise_open_files_limit()
+    fleet = FakeFleet(
+        fleet_hosts(args.hosts),
+        deployed=args.deployed,
+        worker_port=args.worker_port,
+        control_port=args.control_port,
+        latency=args.latency,
+        jitter=args.jitter,
+        failure_rate=args.failure_rate,
+        cpu_usage=args.cpu,
+        memory_usage=args.memory,
+        deploy_delay=args.deploy_delay,
+    )
+    await fleet.start()
+    await asyncio.Event().wait()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Fake worker fleet")
+    parser.add_argument("--hosts", type=int, required=True)
+    parser.add_argument("--deployed", type=int, required=True)
+    parser.add_argument("--worker-port", type=int, required=True)
+    parser.add_argument("--control-port", type=int, required=True)
+    parser.add_argument("--latency", type=float, default=0.005)
+    parser.add_argument("--jitter", type=float, default=0.005)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--cpu", type=float, default=20.0)
+    parser.add_argument("--memory", type=float, default=30.0)
+    parser.add_argument("--deploy-delay", type=float, default=0.5)
+    asyncio.run(serve(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,471 @@
+import argparse
+import asyncio
+import heapq
+import json
+import logging
+import math
+import os
+import random
+import sys
+from collections import Counter
+from typing import List, Optional
+
+from master.autoscaler import Autoscaler
+from master.remote_workers_manager import REMOVAL_KINDS, RemoteWorkerManager
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CONFIG = os.path.join(os.path.dirname(BENCH_DIR), "master", "config_app.json")
+SCALE_OUT_KINDS = ("deploy", "promote")
+
+
+class VirtualClock:
+    def __init__(self, now: float = 0.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def snapshot_frame(snapshot: dict, time: float) -> dict:
+    # A /workers snapshot becomes the load the fleet served then, in percent
+    # of one worker, so it can be spread over however many workers a policy
+    # would have had
+    workers = snapshot.get("workers", snapshot)
+    serving = [
+        worker
+        for worker in workers.values()
+        if worker.get("status") == "healthy"
+        and not worker.get("standby")
+        and not worker.get("draining")
+    ]
+    return {
+        "time": snapshot.get("time", time),
+        "cpu_demand": sum(worker.get("cpu_usage") or 0 for worker in serving),
+        "memory_demand": sum(worker.get("memory_usage") or 0 for worker in serving),
+    }
+
+
+def load_trace(path: str, step: float) -> List[dict]:
+    # JSONL, one /workers snapshot per line, optionally as
+    # {"time": ..., "workers": {...}}, or frames with the demand already summed up
+    frames = []
+    with open(path) as trace_file:
+        for index, line in enumerate(trace_file):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "cpu_demand" in record:
+                frames.append({"time": index * step, **record})
+            else:
+                frames.append(snapshot_frame(record, index * step))
+    origin = frames[0]["time"] if frames else 0.0
+    for frame in frames:
+        frame["time"] -= origin
+    return sorted(frames, key=lambda frame: frame["time"])
+
+
+def synthetic_trace(
+    duration: float,
+    step: float,
+    base: float,
+    peak: float,
+    period: float,
+    noise: float,
+    memory_ratio: float,
+    seed: int,
+) -> List[dict]:
+    # Demand swinging between base and peak once per period, like a day
+    rng = random.Random(seed)
+    frames = []
+    for index in range(int(duration / step) + 1):
+        time = index * step
+        cpu = base + (peak - base) * (1 - math.cos(2 * math.pi * time / period)) / 2
+        cpu = max(0.0, cpu + rng.gauss(0, noise))
+        frames.append({"time": time, "cpu_demand": cpu, "memory_demand": cpu * memory_ratio})
+    return frames
+
+
+# The real manager with its planner and operation runner, only the actions
+# are played by the simulation instead of touching VMs
+class SimulatedManager(RemoteWorkerManager):
+    def __init__(self, simulation: "Simulation", **kwargs):
+        super().__init__(**kwargs)
+        self.simulation = simulation
+
+    def submit_action(
+            self, kind: str, host: str, worker_name: Optional[str] = None
+    ) -> dict:
+        self.simulation.actions.append((self.simulation.clock.now, kind))
+        return self.operations.submit(
+            kind,
+            host,
+            worker_name,
+            lambda operation: self.simulation.perform(kind, host, worker_name, operation),
+        )
+
+
+# Replays a demand trace against one scaling policy on a virtual clock. Every
+# step the demand is spread over the serving workers, every interval the
+# manager reconciles like the poller does. Deploys take deploy_seconds give or
+# take deploy_jitter and fail with failure_rate, healthy workers crash at
+# crash_rate per hour.
+class Simulation:
+    def __init__(
+        self,
+        trace: List[dict],
+        worker_limits: dict,
+        operations_info: Optional[dict] = None,
+        vms: Optional[int] = None,
+        step: float = 1.0,
+        interval: float = 7.0,
+        deploy_seconds: float = 90.0,
+        deploy_jitter: float = 30.0,
+        start_seconds: float = 5.0,
+        drain_seconds: float = 30.0,
+        failure_rate: float = 0.0,
+        crash_rate: float = 0.0,
+        initial_workers: Optional[int] = None,
+        cpu_threshold: Optional[float] = None,
+        memory_threshold: Optional[float] = None,
+        seed: int = 0,
+    ):
+        self.trace = trace
+        self.worker_limits = worker_limits
+        self.step = step
+        self.interval = interval
+        self.deploy_seconds = deploy_seconds
+        self.deploy_jitter = deploy_jitter
+        self.start_seconds = start_seconds
+        self.drain_seconds = drain_seconds
+        self.failure_rate = failure_rate
+        self.crash_rate = crash_rate
+        self.cpu_threshold = cpu_threshold or worker_limits.get("cpu_limit")
+        self.memory_threshold = memory_threshold or worker_limits.get("memory_limit")
+        self.initial_workers = (
+            worker_limits["min_workers"] if initial_workers is None else initial_workers
+        )
+        self.rng = random.Random(seed)
+        self.clock = VirtualClock()
+        # (wake up time, sequence, future) of the actions waiting on the clock
+        self.timers: List[tuple] = []
+        self.timer_sequence = 0
+        self.worker_sequence = 0
+        # (time, kind) of every submitted action
+        self.actions: List[tuple] = []
+        vms = vms or worker_limits["max_workers"] + worker_limits.get("warm_pool_size", 0) + 2
+        self.manager = SimulatedManager(
+            self,
+            app_info={"name": "simulated", "image": "simulated"},
+            worker_info={"port": 0},
+            worker_limits=worker_limits,
+            virtual_machines=[f"vm-{index}" for index in range(vms)],
+            operations_info=operations_info,
+        )
+        self.manager.autoscaler = Autoscaler(
+            self.manager.metric_store, worker_limits, clock=self.clock
+        )
+
+    async def sleep(self, seconds: float) -> None:
+        future = asyncio.get_running_loop().create_future()
+        self.timer_sequence += 1
+        heapq.heappush(self.timers, (self.clock.now + seconds, self.timer_sequence, future))
+        await future
+
+    async def settle(self) -> None:
+        # Lets the operations woken up run until they wait on the clock again
+        for _ in range(10):
+            await asyncio.sleep(0)
+
+    def deploy_duration(self) -> float:
+        return max(self.start_seconds, self.rng.gauss(self.deploy_seconds, self.deploy_jitter))
+
+    def new_worker_name(self) -> str:
+        self.worker_sequence += 1
+        return f"worker-{self.worker_sequence}"
+
+    async def perform(
+            self, kind: str, host: str, worker_name: Optional[str], operation: dict
+    ) -> None:
+        manager = self.manager
+        if kind in ("deploy", "provision"):
+            worker_name = operation["worker"] = self.new_worker_name()
+        if kind in ("deploy", "provision", "restart"):
+            await self.sleep(self.deploy_duration())
+            if self.rng.random() < self.failure_rate:
+                raise Exception(f"Simulated {kind} failure on {host}")
+        elif kind in ("start_app", "promote", "update"):
+            await self.sleep(self.start_seconds)
+        if kind in REMOVAL_KINDS:
+            if kind == "scale_in":
+                await manager.set_worker_value_data(worker_name, "draining", True)
+                await self.sleep(self.drain_seconds)
+            await manager.del_worker_data(worker_name)
+        elif kind == "provision":
+            await manager.set_worker_data(
+                worker_name,
+                {"name": worker_name, "host": host, "standby": True, "status": "standby"},
+            )
+        else:
+            await manager.set_worker_data(
+                worker_name,
+                {
+                    "name": worker_name,
+                    "host": host,
+                    "status": "healthy",
+                    "standby": False,
+                    "draining": False,
+                    "started_at": self.clock.now,
+                },
+            )
+
+    def frame_at(self, index: int, time: float) -> int:
+        while index + 1 < len(self.trace) and self.trace[index + 1]["time"] <= time:
+            index += 1
+        return index
+
+    def serving_workers(self) -> List[str]:
+        workers_data = self.manager.workers_data
+        return [
+            worker_name
+            for worker_name in workers_data.with_status("healthy")
+            if not self.manager.is_standby(worker_name)
+            and not workers_data[worker_name].get("draining")
+        ]
+
+    def provisioned_workers(self) -> int:
+        # Every VM that is taken costs, booting and draining ones included
+        booting = sum(
+            operation["kind"] in ("deploy", "provision")
+            and operation["worker"] not in self.manager.workers_data
+            for operation in self.manager.operations.active()
+        )
+        return len(self.manager.workers_data) + booting
+
+    async def run(self) -> dict:
+        manager = self.manager
+        for _ in range(self.initial_workers):
+            worker_name = self.new_worker_name()
+            await manager.set_worker_data(
+                worker_name,
+                {
+                    "name": worker_name,
+                    "host": manager.discover_free_vm(
+                        exclude={worker["host"] for worker in manager.workers_data.values()}
+                    ),
+                    "status": "healthy",
+                    "standby": False,
+                    "started_at": 0.0,
+                },
+            )
+
+        duration = self.trace[-1]["time"] if self.trace else 0.0
+        worker_seconds = 0.0
+        over_threshold_seconds = 0.0
+        unserved_seconds = 0.0
+        peak_workers = 0
+        next_reconcile = 0.0
+        index = 0
+        for tick in range(int(duration / self.step) + 1):
+            now = self.clock.now = tick * self.step
+            while self.timers and self.timers[0][0] <= now:
+                _, _, future = heapq.heappop(self.timers)
+                if not future.done():
+                    future.set_result(None)
+            await self.settle()
+
+            index = self.frame_at(index, now)
+            frame = self.trace[index]
+            serving = self.serving_workers()
+            if self.crash_rate:
+                for worker_name in serving:
+                    if self.rng.random() < self.crash_rate * self.step / 3600:
+                        await manager.set_worker_value_data(worker_name, "status", "failed")
+                serving = self.serving_workers()
+
+            cpu = frame["cpu_demand"] / len(serving) if serving else None
+            memory = frame["memory_demand"] / len(serving) if serving else None
+            provisioned = self.provisioned_workers()
+            worker_seconds += provisioned * self.step
+            peak_workers = max(peak_workers, provisioned)
+            if not serving:
+                if frame["cpu_demand"] > 0:
+                    unserved_seconds += self.step
+                    over_threshold_seconds += self.step
+            elif (self.cpu_threshold and cpu > self.cpu_threshold) or (
+                self.memory_threshold and memory > self.memory_threshold
+            ):
+                over_threshold_seconds += self.step
+
+            if now >= next_reconcile:
+                # What the agents would report in this poll cycle
+                for worker_name in serving:
+                    await manager.set_worker_data(
+                        worker_name, {"cpu_usage": cpu, "memory_usage": memory}
+                    )
+                await manager.check_and_scale_workers()
+                await self.settle()
+                next_reconcile += self.interval
+
+        for _, _, future in self.timers:
+            future.cancel()
+        await asyncio.gather(*manager.operations.tasks, return_exceptions=True)
+        return self.report(duration, worker_seconds, over_threshold_seconds, unserved_seconds, peak_workers)
+
+    def report(
+        self,
+        duration: float,
+        worker_seconds: float,
+        over_threshold_seconds: float,
+        unserved_seconds: float,
+        peak_workers: int,
+    ) -> dict:
+        kinds = Counter(kind for _, kind in self.actions)
+        # A scale-out after a scale-in or the other way round
+        direction_changes = 0
+        direction = None
+        for _, kind in self.actions:
+            if kind in SCALE_OUT_KINDS or kind == "scale_in":
+                current = "out" if kind in SCALE_OUT_KINDS else "in"
+                if direction is not None and current != direction:
+                    direction_changes += 1
+                direction = current
+        failed = Counter(
+            operation["kind"]
+            for operation in self.manager.operations.operations.values()
+            if operation["state"] == "failed"
+        )
+        return {
+            "duration_seconds": duration,
+            "worker_minutes": worker_seconds / 60,
+            "mean_workers": worker_seconds / duration if duration else 0.0,
+            "peak_workers": peak_workers,
+            "over_threshold_seconds": over_threshold_seconds,
+            "over_threshold_share": over_threshold_seconds / duration if duration else 0.0,
+            "unserved_seconds": unserved_seconds,
+            "scale_outs": sum(kinds[kind] for kind in SCALE_OUT_KINDS),
+            "scale_ins": kinds["scale_in"],
+            "direction_changes": direction_changes,
+            "actions": dict(kinds),
+            "failed_actions": dict(failed),
+        }
+
+
+def load_policy(value: str, base_limits: dict, index: int) -> tuple:
+    # A JSON file with worker_limits, or with a config that has them, or an
+    # inline JSON object; either way on top of the configured limits
+    if value.lstrip().startswith("{"):
+        name, limits = f"policy-{index}", json.loads(value)
+    else:
+        with open(value) as policy_file:
+            limits = json.load(policy_file)
+        name = os.path.splitext(os.path.basename(value))[0]
+    limits = limits.get("worker_limits", limits)
+    return name, {**base_limits, **limits}
+
+
+async def simulate(args: argparse.Namespace, name: str, limits: dict, trace: List[dict], operations_info: dict) -> dict:
+    simulation = Simulation(
+        trace,
+        limits,
+        operations_info=operations_info,
+        vms=args.vms,
+        step=args.step,
+        interval=args.interval,
+        deploy_seconds=args.deploy_seconds,
+        deploy_jitter=args.deploy_jitter,
+        start_seconds=args.start_seconds,
+        drain_seconds=args.drain_seconds,
+        failure_rate=args.failure_rate,
+        crash_rate=args.crash_rate,
+        initial_workers=args.initial_workers,
+        cpu_threshold=args.cpu_threshold,
+        memory_threshold=args.memory_threshold,
+        seed=args.seed,
+    )
+    return {"policy": name, "worker_limits": limits, **await simulation.run()}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Replay a load trace against autoscaling policies on a virtual clock"
+    )
+    parser.add_argument("--trace", help="JSONL of /workers snapshots, synthetic load if unset")
+    parser.add_argument(
+        "--policy",
+        action="append",
+        help="worker_limits JSON file or inline object, repeat to compare",
+    )
+    parser.add_argument("--config", default=DEFAULT_CONFIG, help="config with the base limits")
+    parser.add_argument("--step", type=float, default=1.0, help="simulated seconds per step")
+    parser.add_argument("--interval", type=float, help="reconcile interval, the poller's if unset")
+    parser.add_argument("--trace-step", type=float, default=7.0, help="seconds between snapshots without a time")
+    parser.add_argument("--duration", type=float, default=86400.0)
+    parser.add_argument("--base", type=float, default=60.0, help="synthetic demand low, %% of one worker")
+    parser.add_argument("--peak", type=float, default=600.0, help="synthetic demand high")
+    parser.add_argument("--period", type=float, default=86400.0)
+    parser.add_argument("--noise", type=float, default=20.0)
+    parser.add_argument("--memory-ratio", type=float, default=0.5)
+    parser.add_argument("--vms", type=int)
+    parser.add_argument("--initial-workers", type=int)
+    parser.add_argument("--deploy-seconds", type=float, default=90.0)
+    parser.add_argument("--deploy-jitter", type=float, default=30.0)
+    parser.add_argument("--start-seconds", type=float, default=5.0)
+    parser.add_argument("--drain-seconds", type=float, default=30.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of deploys that fail")
+    parser.add_argument("--crash-rate", type=float, default=0.0, help="crashes per worker and hour")
+    parser.add_argument("--cpu-threshold", type=float, help="over-threshold CPU, the policy's cpu_limit if unset")
+    parser.add_argument("--memory-threshold", type=float)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results JSON here instead of stdout")
+    parser.add_argument("--log-level", default="CRITICAL", help="log level of the master")
+    args = parser.parse_args()
+
+    logging.getLogger("master").setLevel(args.log_level)
+    os.environ.setdefault("SSH_USER", "simulator")
+    with open(args.config) as config_file:
+        config = json.load(config_file)
+    base_limits = config["worker_limits"]
+    if args.interval is None:
+        args.interval = config.get("poller", {}).get("interval", 7)
+    policies = [
+        load_policy(value, base_limits, index)
+        for index, value in enumerate(args.policy or [], start=1)
+    ] or [("config", base_limits)]
+
+    if args.trace:
+        trace = load_trace(args.trace, args.trace_step)
+    else:
+        trace = synthetic_trace(
+            args.duration, args.interval, args.base, args.peak, args.period,
+            args.noise, args.memory_ratio, args.seed,
+        )
+    if not trace:
+        sys.exit("The trace is empty")
+
+    results = []
+    for name, limits in policies:
+        logger.info(f"Simulating policy {name}")
+        results.append(
+            asyncio.run(simulate(args, name, limits, trace, config.get("operations", {})))
+        )
+    output = json.dumps({"results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+    for result in results:
+        print(
+            f"{result['policy']:<16} {result['worker_minutes']:10.1f} worker-min"
+            f"  {result['over_threshold_share'] * 100:5.1f}% over threshold"
+            f"  {result['scale_outs']:4} out {result['scale_ins']:4} in"
+            f"  {result['direction_changes']:4} flips",
+            file=sys.stderr,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+import json
+import os
+import sys
+import urllib.request
+
+
+# Stands in for ssh and scp: forwards the command line to the fake fleet,
+# which plays the remote host, and exits like the real command would.
+def open_master(argv: list) -> None:
+    # Leaves a file where ssh would keep the master's socket, the pool checks
+    # for it before reusing the connection
+    options = [argv[index + 1] for index, arg in enumerate(argv[:-1]) if arg == "-o"]
+    if "ControlMaster=yes" in options:
+        for option in options:
+            if option.startswith("ControlPath="):
+                open(option.partition("=")[2], "a").close()
+
+
+def main() -> None:
+    open_master(sys.argv[1:])
+    request = urllib.request.Request(
+        f"{os.environ['BENCH_FLEET_URL']}/ssh",
+        data=json.dumps({"argv": sys.argv[1:]}).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request) as response:
+        result = json.load(response)
+    sys.stdout.write(result["stdout"])
+    sys.stderr.write(result["stderr"])
+    sys.exit(result["returncode"])
+
+
+if __name__ == "__main__":
+    main()
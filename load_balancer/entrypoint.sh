@@ -1,43 +1,98 @@
 #!/bin/bash
 set -e
 
+UPSTREAM_CONF=/etc/nginx/conf.d/upstream.conf
+# API_URL of older deployments names the healthy_hosts endpoint next to upstreams
+if [ -z "$UPSTREAMS_URL" ] && [ -n "$API_URL" ]; then
+    UPSTREAMS_URL="${API_URL%/healthy_hosts}/upstreams"
+    echo "API_URL is deprecated, set UPSTREAMS_URL=$UPSTREAMS_URL instead"
+fi
+export UPSTREAMS_URL=${UPSTREAMS_URL:-http://host.docker.internal:8000/upstreams}
+# The applied upstreams, the telemetry collector names upstreams after them
+export UPSTREAMS_FILE=${UPSTREAMS_FILE:-/etc/nginx/upstreams.json}
+LONG_POLL_TIMEOUT=${LONG_POLL_TIMEOUT:-30}
+LOAD_BALANCER_ID=${LOAD_BALANCER_ID:-$(hostname)}
+etag=""
+
 log() {
     echo "$(date +"%Y-%m-%d %H:%M:%S") $1"
 }
 
-# Fetch hosts and create an upstream block
-fetch_hosts() {
-    log "Fetching hosts from API"
-    response=$(curl -s -f -S $API_URL 2>&1)
-    ret=$?
-    if [ $ret -ne 0 ]; then
-        log "Error: Failed to fetch hosts from API: $response"
-        return $ret
-    fi
-
-    hosts=$(echo $response | jq -r '.[]')
-    ret=$?
-    if [ $ret -ne 0 ]; then
-        log "Error: Failed to parse hosts from API response: $hosts"
-        return $ret
-    fi
-
-    upstream_block=$(printf "upstream backend {\n")
-    for host in $hosts; do
+# Render the upstreams JSON into an upstream block
+render_upstream() {
+    printf "upstream backend {\n"
+    echo "$1" | jq -r '.upstreams[] | "\(.host) \(.weight)"' | while read -r host weight; do
         if [[ "$host" == 127.0.0.1* ]]; then
             host=${host/127.0.0.1/host.docker.internal}
         fi
-        log "Adding host to upstream block: $host"
-        upstream_block=$(printf "%s    server %s;\n" "$upstream_block" "$host")
+        printf "    server %s weight=%s;\n" "$host" "$weight"
     done
-    upstream_block=$(printf "%s}\n" "$upstream_block")
-    echo "$upstream_block" > /etc/nginx/conf.d/upstream.conf
+    if [ "$(echo "$1" | jq '.upstreams | length')" -eq 0 ]; then
+        # nginx refuses an empty upstream block
+        printf "    server 127.0.0.1:65535 down;\n"
+    fi
+    printf "}\n"
 }
 
-# Fetch initial hosts and reload nginx
-fetch_hosts  true
-log "Reloading Nginx configuration"
-nginx -c /etc/nginx/nginx.conf -t # Test the configuration
+# Wait for a new upstreams version, sets `response` and `new_etag`.
+# Returns 0 on a new version, 1 when nothing changed and 2 on errors
+fetch_upstreams() {
+    local wait=$1
+    local headers
+    headers=$(mktemp)
+    local status
+    status=$(curl -s -S -o /tmp/upstreams.json -D "$headers" -w "%{http_code}" \
+        --max-time $((LONG_POLL_TIMEOUT + 10)) \
+        -H "If-None-Match: $etag" -H "X-Load-Balancer-Id: $LOAD_BALANCER_ID" \
+        "$UPSTREAMS_URL?wait=$wait" 2>&1) || {
+        log "Error: Failed to fetch upstreams from API: $status"
+        rm -f "$headers"
+        return 2
+    }
+    new_etag=$(grep -i '^etag:' "$headers" | cut -d' ' -f2- | tr -d '\r')
+    rm -f "$headers"
+    if [ "$status" == "304" ]; then
+        return 1
+    fi
+    if [ "$status" != "200" ]; then
+        log "Error: Unexpected upstreams API response status $status"
+        return 2
+    fi
+    response=$(cat /tmp/upstreams.json)
+    return 0
+}
+
+# Write the upstream block and reload nginx only if it really changed.
+# The ETag is advanced only once the config is applied, which acks it to the master
+apply_upstreams() {
+    local reload=$1
+    render_upstream "$response" > "$UPSTREAM_CONF.new"
+    if cmp -s "$UPSTREAM_CONF.new" "$UPSTREAM_CONF"; then
+        rm -f "$UPSTREAM_CONF.new"
+        echo "$response" > "$UPSTREAMS_FILE"
+        etag=$new_etag
+        return 0
+    fi
+    [ -f "$UPSTREAM_CONF" ] && cp "$UPSTREAM_CONF" "$UPSTREAM_CONF.old"
+    mv "$UPSTREAM_CONF.new" "$UPSTREAM_CONF"
+    if ! nginx -c /etc/nginx/nginx.conf -t -q; then
+        log "Error: Invalid upstream configuration, keeping the previous one"
+        [ -f "$UPSTREAM_CONF.old" ] && mv "$UPSTREAM_CONF.old" "$UPSTREAM_CONF"
+        return 1
+    fi
+    log "Upstreams version $new_etag: $(echo "$response" | jq -c '.upstreams')"
+    if [ "$reload" == "true" ]; then
+        log "Reloading Nginx configuration"
+        nginx -s reload
+    fi
+    echo "$response" > "$UPSTREAMS_FILE"
+    etag=$new_etag
+}
+
+# Fetch initial upstreams
+until fetch_upstreams 0 && apply_upstreams false; do
+    sleep 1
+done
 
 # Create the PID file
 touch /var/run/nginx.pid
@@ -46,16 +101,23 @@ touch /var/run/nginx.pid
 log "Starting Nginx"
 nginx -c /etc/nginx/nginx.conf -g "daemon off;" &
 
-# Set up a periodic task to fetch hosts and reload nginx
+# Request rates and latencies for the orchestrator's autoscaler. It can run
+# as a separate container too, sharing the network namespace of this one
+if [ "${TELEMETRY_ENABLED:-true}" == "true" ]; then
+    log "Starting the telemetry collector"
+    python3 /telemetry_collector.py &
+fi
+
+# Follow upstream changes with long polling
 (
   while true; do
-    fetch_hosts  true
-    log "Reloading Nginx configuration"
-    nginx -s reload
-    log "Sleeping for 5 minutes"
-    sleep 300 # Sleep for 5 minutes
+    if fetch_upstreams "$LONG_POLL_TIMEOUT"; then
+        apply_upstreams true || sleep 1
+    elif [ $? -eq 2 ]; then
+        sleep 1
+    fi
   done
 ) &
 
 # Keep the script running
-wait
\ No newline at end of file
+wait
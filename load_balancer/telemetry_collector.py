@@ -0,0 +1,218 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import urllib.request
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+# Upper bounds of the latency histogram buckets, in ms, the last bucket
+# counts everything slower
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def upstream_time(value):
+    # "0.012" or, after retries, one time per tried upstream: "0.5, 0.012"
+    last = value.split(",")[-1].strip()
+    try:
+        return float(last)
+    except ValueError:
+        return None
+
+
+def parse_stub_status(text):
+    # Active connections: 3
+    # server accepts handled requests
+    #  10 10 25
+    # Reading: 0 Writing: 1 Waiting: 2
+    lines = text.splitlines()
+    accepted, handled, requests = (int(value) for value in lines[2].split())
+    fields = lines[3].split()
+    return {
+        "active": int(lines[0].split(":")[1]),
+        "accepted": accepted,
+        "handled": handled,
+        "requests": requests,
+        "reading": int(fields[1]),
+        "writing": int(fields[3]),
+        "waiting": int(fields[5]),
+    }
+
+
+def docker_host(host):
+    # The entrypoint reaches upstreams on the docker host through the gateway name
+    if host.startswith("127.0.0.1"):
+        return host.replace("127.0.0.1", "host.docker.internal", 1)
+    return host
+
+
+def resolve_upstream(host):
+    # "vm-1:8080" -> {"10.0.0.5:8080"}, the addresses nginx reports in $upstream_addr
+    name, _, port = docker_host(host).rpartition(":")
+    try:
+        return {
+            f"{info[4][0]}:{port}" if info[0] == socket.AF_INET else f"[{info[4][0]}]:{port}"
+            for info in socket.getaddrinfo(name, int(port), proto=socket.IPPROTO_TCP)
+        }
+    except (OSError, ValueError) as e:
+        logging.warning(f"Failed to resolve upstream {host}: {e!r}")
+        return set()
+
+
+# Sidecar of the nginx load balancer. nginx ships its JSON access log lines
+# over syslog/UDP, the collector aggregates them per upstream into request
+# counts and latency histograms and pushes them to the orchestrator together
+# with the stub_status connection counters every interval. Upstreams are
+# reported by the host the orchestrator configured, not by the address nginx
+# resolved it to.
+class TelemetryCollector:
+    def __init__(
+        self, telemetry_url, load_balancer_id, stub_status_url, listen_port, interval,
+        upstreams_file=None,
+    ):
+        self.telemetry_url = telemetry_url
+        self.load_balancer_id = load_balancer_id
+        self.stub_status_url = stub_status_url
+        self.listen_port = listen_port
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.upstreams = {}
+        # Upstreams JSON the entrypoint applied last, its mtime and the
+        # resolved address -> configured host map built from it
+        self.upstreams_file = upstreams_file
+        self.upstreams_mtime = None
+        self.upstream_names = {}
+
+    def load_upstream_names(self):
+        try:
+            mtime = os.stat(self.upstreams_file).st_mtime
+            if mtime == self.upstreams_mtime:
+                return
+            with open(self.upstreams_file) as file:
+                hosts = [upstream["host"] for upstream in json.load(file)["upstreams"]]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning(f"Failed to read upstreams from {self.upstreams_file}: {e!r}")
+            return
+        names = {}
+        for host in hosts:
+            for address in resolve_upstream(host):
+                names[address] = host
+        self.upstream_names, self.upstreams_mtime = names, mtime
+
+    def upstream_name(self, address):
+        return self.upstream_names.get(address, address)
+
+    def new_upstream(self):
+        return {"requests": 0, "errors": 0, "latency_buckets": [0] * (len(BUCKETS_MS) + 1)}
+
+    def record(self, entry):
+        address = entry.get("upstream_addr", "").split(",")[-1].strip()
+        if not address or address == "-":
+            # Answered by nginx itself, no backend involved
+            return
+        latency = upstream_time(entry.get("upstream_response_time", ""))
+        if latency is None:
+            latency = upstream_time(entry.get("request_time", ""))
+        status = entry.get("upstream_status", "").split(",")[-1].strip() or entry.get("status", "")
+        with self.lock:
+            upstream = self.upstreams.get(address)
+            if upstream is None:
+                upstream = self.upstreams[address] = self.new_upstream()
+            upstream["requests"] += 1
+            if not status.isdigit() or int(status) >= 500:
+                upstream["errors"] += 1
+            if latency is not None:
+                latency_ms = latency * 1000
+                index = next(
+                    (index for index, bound in enumerate(BUCKETS_MS) if latency_ms <= bound),
+                    len(BUCKETS_MS),
+                )
+                upstream["latency_buckets"][index] += 1
+
+    def listen(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("127.0.0.1", self.listen_port))
+        logging.info(f"Receiving access log on udp://127.0.0.1:{self.listen_port}")
+        while True:
+            message = sock.recv(65535).decode(errors="replace")
+            # "<190>Oct 17 10:00:00 nginx: {...}", the JSON is the rest of the line
+            start = message.find("{")
+            if start < 0:
+                continue
+            try:
+                self.record(json.loads(message[start:]))
+            except ValueError:
+                logging.warning(f"Skipping malformed access log line: {message[:200]}")
+
+    def fetch_connections(self):
+        try:
+            with urllib.request.urlopen(self.stub_status_url, timeout=2) as response:
+                return parse_stub_status(response.read().decode())
+        except Exception as e:
+            logging.warning(f"Failed to read stub_status: {e!r}")
+            return None
+
+    def push(self, started):
+        with self.lock:
+            upstreams, self.upstreams = self.upstreams, {}
+        if self.upstreams_file:
+            self.load_upstream_names()
+        named = {}
+        for address, stats in upstreams.items():
+            # Addresses of one host, like its IPv4 and IPv6 ones, add up
+            name = self.upstream_name(address)
+            if name not in named:
+                named[name] = stats
+                continue
+            total = named[name]
+            total["requests"] += stats["requests"]
+            total["errors"] += stats["errors"]
+            total["latency_buckets"] = [
+                sum(counts) for counts in zip(total["latency_buckets"], stats["latency_buckets"])
+            ]
+        report = {
+            "load_balancer": self.load_balancer_id,
+            "interval": time.monotonic() - started,
+            "connections": self.fetch_connections(),
+            "buckets_ms": list(BUCKETS_MS),
+            "upstreams": named,
+        }
+        request = urllib.request.Request(
+            self.telemetry_url,
+            data=json.dumps(report).encode(),
+            headers={
+                "Content-Type": "application/json",
+                "X-Load-Balancer-Id": self.load_balancer_id,
+            },
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=5):
+                pass
+        except Exception as e:
+            logging.warning(f"Failed to push telemetry to {self.telemetry_url}: {e!r}")
+
+    def run(self):
+        threading.Thread(target=self.listen, daemon=True).start()
+        started = time.monotonic()
+        while True:
+            time.sleep(max(0.0, started + self.interval - time.monotonic()))
+            now = time.monotonic()
+            self.push(started)
+            started = now
+
+
+if __name__ == "__main__":
+    upstreams_url = os.environ["UPSTREAMS_URL"]
+    TelemetryCollector(
+        telemetry_url=os.environ.get("TELEMETRY_URL")
+        or upstreams_url.rsplit("/upstreams", 1)[0] + "/telemetry",
+        load_balancer_id=os.environ.get("LOAD_BALANCER_ID") or socket.gethostname(),
+        stub_status_url=os.environ.get("STUB_STATUS_URL", "http://127.0.0.1:8080/stub_status"),
+        listen_port=int(os.environ.get("TELEMETRY_SYSLOG_PORT", 5140)),
+        interval=float(os.environ.get("TELEMETRY_INTERVAL", 5)),
+        upstreams_file=os.environ.get("UPSTREAMS_FILE", "/etc/nginx/upstreams.json"),
+    ).run()
@@ -1,33 +1,119 @@
 import asyncio
 import json
 import os
+from typing import List
 
 from aiohttp import web
+from master.cluster import Cluster
 from master.remote_workers_manager import RemoteWorkerManager
+from master.scheduler import BinPackingScheduler
 from master.workers_poller import WorkersPoller
 from master.orchestrator_api import OrchestratorAPI
 
 
+def app_configs(config: dict) -> List[dict]:
+    # Without an "apps" list the top-level app_info is the only application
+    if not config.get("apps"):
+        return [
+            {
+                "app_info": config["app_info"],
+                "worker_info": config["worker_info"],
+                "worker_limits": config["worker_limits"],
+                "heartbeat_info": config.get("heartbeat"),
+                "state_info": config.get("state"),
+            }
+        ]
+
+    configs = []
+    for app in config["apps"]:
+        name = app["name"]
+        heartbeat_info = config.get("heartbeat")
+        if heartbeat_info and heartbeat_info.get("master_url"):
+            # Agents of each app report to the app's own heartbeat route
+            heartbeat_info = {
+                **heartbeat_info,
+                "master_url": f"{heartbeat_info['master_url'].rstrip('/')}/apps/{name}",
+            }
+        state_info = config.get("state")
+        if state_info and state_info.get("directory"):
+            state_info = {
+                **state_info,
+                "directory": os.path.join(state_info["directory"], name),
+                "etcd_prefix": f"{state_info.get('etcd_prefix', '/orchestrator')}/apps/{name}",
+            }
+        configs.append(
+            {
+                "app_info": {
+                    key: value
+                    for key, value in app.items()
+                    if key not in ("worker_port", "worker_limits")
+                },
+                "worker_info": {**config["worker_info"], "port": app["worker_port"]},
+                "worker_limits": {**config["worker_limits"], **app.get("worker_limits", {})},
+                "heartbeat_info": heartbeat_info,
+                "state_info": state_info,
+            }
+        )
+    return configs
+
+
 async def main():
     with open(os.getenv("CONFIG_MASTER")) as config_file:
         config = json.load(config_file)
 
-    worker_manager = RemoteWorkerManager(
-        app_info=config["app_info"],
-        worker_info=config["worker_info"],
-        worker_limits=config["worker_limits"],
-        virtual_machines=config["virtual_machines"],
-    )
+    cluster = None
+    if (config.get("cluster") or {}).get("etcd_url"):
+        cluster = Cluster(**config["cluster"])
+        await cluster.start()
+
+    scheduler = BinPackingScheduler(**config.get("scheduler", {}))
+    worker_managers = []
+    for app_config in app_configs(config):
+        state_info = app_config["state_info"]
+        if cluster is not None and state_info and state_info.get("etcd_url"):
+            # Replicas share etcd, each keeps its own snapshot
+            etcd_prefix = state_info.get("etcd_prefix", "/orchestrator")
+            app_config["state_info"] = {
+                **state_info,
+                "etcd_prefix": f"{etcd_prefix}/replicas/{cluster.replica_id}",
+            }
+        worker_manager = RemoteWorkerManager(
+            virtual_machines=config["virtual_machines"],
+            image_distribution=config.get("image_distribution"),
+            ssh_info=config.get("ssh"),
+            operations_info=config.get("operations"),
+            load_balancer_info=config.get("load_balancer"),
+            breaker_info=config.get("circuit_breaker"),
+            rollout_info=config.get("rollout"),
+            scheduler=scheduler,
+            cluster=cluster,
+            **app_config,
+        )
+        await worker_manager.restore_state()
+        worker_managers.append(worker_manager)
 
-    orchestrator_api = OrchestratorAPI(worker_manager)
+    orchestrator_api = OrchestratorAPI(worker_managers, cluster)
     api_app = orchestrator_api.create_app()
     runner = web.AppRunner(api_app)
     await runner.setup()
     site = web.TCPSite(runner, "0.0.0.0", os.getenv("MASTER_API_PORT"))
     await site.start()
 
-    workers_poller = WorkersPoller(worker_manager)
-    await workers_poller.poll_workers()
+    workers_pollers = [
+        WorkersPoller(worker_manager, **config.get("poller", {}))
+        for worker_manager in worker_managers
+    ]
+    try:
+        await asyncio.gather(
+            *(workers_poller.poll_workers() for workers_poller in workers_pollers)
+        )
+    finally:
+        if cluster is not None:
+            await cluster.stop()
+        for worker_manager in worker_managers:
+            await worker_manager.ssh_pool.close()
+            if worker_manager.journal is not None:
+                worker_manager.journal.close()
 
 
 if __name__ == "__main__":
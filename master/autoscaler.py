@@ -0,0 +1,132 @@
+import logging
+import math
+import time
+from typing import Callable, Dict, List, Optional
+
+from master.metric_store import FLEET, MetricStore
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+LIMITED_METRICS = {"cpu_usage": "cpu_limit", "memory_usage": "memory_limit"}
+# Read by agents from the app container's cgroup: share of CFS periods that
+# ran out of quota and of time stalled on memory, used once limited
+PRESSURE_METRICS = {
+    "cpu_throttled": "cpu_throttled_limit",
+    "memory_pressure": "memory_pressure_limit",
+}
+WORKER_METRICS = {**LIMITED_METRICS, **PRESSURE_METRICS}
+# Fleet-wide load balancer signals, used once their target is configured
+TRAFFIC_METRICS = {
+    "requests_per_worker": "target_requests_per_worker",
+    "latency_p95_ms": "target_latency_p95_ms",
+}
+SCALING_METRICS = {**WORKER_METRICS, **TRAFFIC_METRICS}
+
+
+# Decides on fleet-wide load instead of single samples: scale out when the
+# smoothed or forecast load crosses the limit, scale in one worker at a time
+# only after load stayed low for a while and would stay below the limit.
+class Autoscaler:
+    def __init__(
+        self,
+        metric_store: MetricStore,
+        worker_limits: Dict[str, float],
+        clock: Callable[[], float] = time.time,
+    ):
+        self.metric_store = metric_store
+        self.worker_limits = worker_limits
+        self.clock = clock
+        self.last_scale_out = float("-inf")
+        # Scale-in needs a full cooldown worth of history after startup
+        self.last_scale_in = clock()
+        self.last_decision: dict = {}
+
+    def record_fleet(self, workers: List[dict]) -> None:
+        if not workers:
+            return
+        now = self.clock()
+        for metric in LIMITED_METRICS:
+            values = [worker.get(metric) or 0 for worker in workers]
+            self.metric_store.record(FLEET, metric, sum(values) / len(values), now)
+        for metric in PRESSURE_METRICS:
+            # Agents sampling docker stats do not report these
+            values = [worker[metric] for worker in workers if worker.get(metric) is not None]
+            if values:
+                self.metric_store.record(FLEET, metric, sum(values) / len(values), now)
+
+    def record_traffic(
+        self, requests_per_second: float, latency_p95_ms: Optional[float], workers: int
+    ) -> None:
+        now = self.clock()
+        if workers:
+            self.metric_store.record(
+                FLEET, "requests_per_worker", requests_per_second / workers, now
+            )
+        if latency_p95_ms is not None:
+            self.metric_store.record(FLEET, "latency_p95_ms", latency_p95_ms, now)
+
+    # Cooldowns start once a change was actually acted on, a proposal that
+    # found no VM or room is proposed again on the next cycle
+    def record_scale_out(self) -> None:
+        self.last_scale_out = self.clock()
+
+    def record_scale_in(self) -> None:
+        self.last_scale_in = self.clock()
+
+    def desired_change(self, current_workers: int) -> int:
+        limits = self.worker_limits
+        now = self.clock()
+        horizon = limits.get("forecast_horizon", 60)
+        scale_in_window = limits.get("scale_in_window", 300)
+        scale_in_threshold = limits.get("scale_in_threshold", 0.5)
+
+        scale_out_ratio = 0.0
+        scale_in_ratio = 0.0
+        projected_ratio = 0.0
+        for metric, limit_key in SCALING_METRICS.items():
+            ewma = self.metric_store.ewma(FLEET, metric)
+            limit = limits.get(limit_key)
+            if ewma is None or not limit:
+                continue
+            if metric in TRAFFIC_METRICS:
+                # Without fresh telemetry the last values would hold the fleet
+                age = self.metric_store.age(FLEET, metric, now)
+                if age is None or age > limits.get("telemetry_max_age", 60):
+                    continue
+            forecast = self.metric_store.forecast(FLEET, metric, horizon) or 0
+            p95 = self.metric_store.percentile(FLEET, metric, 95, scale_in_window, now)
+            scale_out_ratio = max(scale_out_ratio, max(ewma, forecast) / limit)
+            scale_in_ratio = max(scale_in_ratio, max(ewma, p95 or 0) / limit)
+            if current_workers > 1:
+                projected_ratio = max(
+                    projected_ratio, ewma * current_workers / (current_workers - 1) / limit
+                )
+
+        change = 0
+        if scale_out_ratio >= 1:
+            if now - self.last_scale_out >= limits.get("scale_out_cooldown", 60):
+                change = max(1, math.ceil(current_workers * scale_out_ratio) - current_workers)
+        elif (
+            current_workers > 1
+            and scale_in_ratio < scale_in_threshold
+            # Hysteresis: the remaining workers must stay clear of the limit
+            and projected_ratio < 1
+            and now - max(self.last_scale_in, self.last_scale_out)
+            >= limits.get("scale_in_cooldown", 300)
+        ):
+            change = -1
+
+        self.last_decision = {
+            "time": now,
+            "workers": current_workers,
+            "scale_out_ratio": scale_out_ratio,
+            "scale_in_ratio": scale_in_ratio,
+            "change": change,
+        }
+        if change:
+            logger.info(
+                f"Autoscaler decided to {'add' if change > 0 else 'remove'} {abs(change)} "
+                f"worker(s), load ratio {scale_out_ratio:.2f}"
+            )
+        return change
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Callable, Dict
+
+import aiohttp
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def is_unreachable_error(error: Exception) -> bool:
+    # A refused connection means the VM is up and only the agent is down
+    if isinstance(error, aiohttp.ClientConnectorError):
+        return not isinstance(error.os_error, ConnectionRefusedError)
+    return isinstance(error, (asyncio.TimeoutError, aiohttp.ServerTimeoutError))
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        failure_threshold: int,
+        base_delay: float,
+        max_delay: float,
+        jitter: float,
+        clock: Callable[[], float],
+    ):
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.retry_at = 0.0
+
+    def allow(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.clock() < self.retry_at:
+            return False
+        # One probe per backoff period, the next one if the probe never reports
+        self.state = HALF_OPEN
+        self.retry_at = self.clock() + self.backoff()
+        return True
+
+    def record_success(self) -> None:
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0
+
+    def record_failure(self) -> None:
+        if self.state == OPEN:
+            return
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened += 1
+            self.state = OPEN
+            self.retry_at = self.clock() + self.backoff()
+
+    def backoff(self) -> float:
+        delay = min(self.max_delay, self.base_delay * 2 ** max(self.opened - 1, 0))
+        return delay * (1 - self.jitter * random.random())
+
+    def to_dict(self) -> dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "retry_in": max(0.0, self.retry_at - self.clock()) if self.state != CLOSED else 0.0,
+        }
+
+
+# Tracks reachability per VM so dead hosts are skipped instead of costing a
+# full timeout on every poll, restart and ssh attempt.
+class CircuitBreakers:
+    def __init__(
+        self,
+        failure_threshold: int = 3,
+        base_delay: float = 5,
+        max_delay: float = 300,
+        jitter: float = 0.5,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.clock = clock
+        self.breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, host: str) -> CircuitBreaker:
+        breaker = self.breakers.get(host)
+        if breaker is None:
+            breaker = self.breakers[host] = CircuitBreaker(
+                self.failure_threshold,
+                self.base_delay,
+                self.max_delay,
+                self.jitter,
+                self.clock,
+            )
+        return breaker
+
+    def allow(self, host: str) -> bool:
+        return self.get(host).allow()
+
+    def is_closed(self, host: str) -> bool:
+        return self.get(host).state == CLOSED
+
+    def record_success(self, host: str) -> None:
+        breaker = self.get(host)
+        if breaker.state != CLOSED:
+            logger.info(f"Host {host} is reachable again, closing its circuit")
+        breaker.record_success()
+
+    def record_failure(self, host: str) -> None:
+        breaker = self.get(host)
+        was_open = breaker.state == OPEN
+        breaker.record_failure()
+        if breaker.state == OPEN and not was_open:
+            logger.warning(
+                f"Host {host} is unreachable, circuit open for "
+                f"{breaker.retry_at - self.clock():.1f} sec"
+            )
+
+    def to_dict(self) -> dict:
+        return {host: breaker.to_dict() for host, breaker in self.breakers.items()}
@@ -0,0 +1,265 @@
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import socket
+import time
+from bisect import bisect
+from typing import Callable, Dict, Iterable, List, Optional
+
+import aiohttp
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def _encode(value: str) -> str:
+    return base64.b64encode(value.encode()).decode()
+
+
+def _decode(value: str) -> str:
+    return base64.b64decode(value).decode()
+
+
+def _prefix_end(prefix: str) -> str:
+    # etcd ranges are half-open, the end of a prefix is its last byte plus one
+    end = bytearray(prefix.encode())
+    end[-1] += 1
+    return base64.b64encode(bytes(end)).decode()
+
+
+# The handful of etcd v3 calls the masters coordinate with, over the JSON
+# gateway so no gRPC client is needed
+class EtcdClient:
+    def __init__(self, url: str, timeout: float = 5):
+        self.url = url.rstrip("/")
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    async def call(self, path: str, body: dict) -> dict:
+        if self.session is None:
+            self.session = aiohttp.ClientSession(timeout=self.timeout)
+        async with self.session.post(f"{self.url}{path}", json=body) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+    async def grant_lease(self, ttl: int) -> str:
+        return (await self.call("/v3/lease/grant", {"TTL": ttl}))["ID"]
+
+    async def keepalive(self, lease: str) -> int:
+        # Seconds left on the lease, 0 once it has expired
+        result = (await self.call("/v3/lease/keepalive", {"ID": lease})).get("result", {})
+        return int(result.get("TTL", 0))
+
+    async def revoke(self, lease: str) -> None:
+        await self.call("/v3/lease/revoke", {"ID": lease})
+
+    async def put(self, key: str, value: str, lease: Optional[str] = None) -> None:
+        body = {"key": _encode(key), "value": _encode(value)}
+        if lease:
+            body["lease"] = lease
+        await self.call("/v3/kv/put", body)
+
+    async def get(self, key: str) -> Optional[str]:
+        kvs = (await self.call("/v3/kv/range", {"key": _encode(key)})).get("kvs")
+        return _decode(kvs[0]["value"]) if kvs else None
+
+    async def get_prefix(self, prefix: str) -> Dict[str, str]:
+        response = await self.call(
+            "/v3/kv/range", {"key": _encode(prefix), "range_end": _prefix_end(prefix)}
+        )
+        return {
+            _decode(kv["key"]): _decode(kv.get("value", ""))
+            for kv in response.get("kvs", [])
+        }
+
+    async def create(self, key: str, value: str, lease: Optional[str] = None) -> bool:
+        # Puts the key only if it does not exist, atomically
+        put = {"key": _encode(key), "value": _encode(value)}
+        if lease:
+            put["lease"] = lease
+        response = await self.call(
+            "/v3/kv/txn",
+            {
+                "compare": [
+                    {
+                        "key": _encode(key),
+                        "result": "EQUAL",
+                        "target": "CREATE",
+                        "create_revision": "0",
+                    }
+                ],
+                "success": [{"request_put": put}],
+            },
+        )
+        return bool(response.get("succeeded"))
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+# Consistent hashing of VMs onto master replicas. Every replica has `vnodes`
+# points on the ring, so a replica joining or leaving only moves its share.
+class HashRing:
+    def __init__(self, members: Iterable[str] = (), vnodes: int = 64):
+        self.members = sorted(members)
+        points = sorted(
+            (self._hash(f"{member}#{index}"), member)
+            for member in self.members
+            for index in range(vnodes)
+        )
+        self.points = [point for point, _ in points]
+        self.owners = [member for _, member in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def owner(self, key: str) -> Optional[str]:
+        if not self.points:
+            return None
+        return self.owners[bisect(self.points, self._hash(key)) % len(self.points)]
+
+
+# callback(old ring, new ring) after the replica set changed
+RebalanceListener = Callable[[HashRing, HashRing], None]
+
+
+# Membership of the master replicas in etcd. Every replica keeps a key under
+# members/ alive with a lease, the replicas split the VMs by consistent
+# hashing over the live members, and the replica holding the leader key
+# makes the fleet-wide scaling decisions.
+class Cluster:
+    def __init__(
+        self,
+        etcd_url: str,
+        replica_id: Optional[str] = None,
+        api_url: Optional[str] = None,
+        prefix: str = "/orchestrator/cluster",
+        lease_ttl: int = 10,
+        vnodes: int = 64,
+    ):
+        self.etcd = EtcdClient(etcd_url)
+        self.replica_id = (
+            replica_id or os.getenv("MASTER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+        )
+        self.api_url = (
+            api_url
+            or os.getenv("MASTER_API_URL")
+            or f"http://{socket.gethostname()}:{os.getenv('MASTER_API_PORT')}"
+        ).rstrip("/")
+        prefix = prefix.rstrip("/")
+        self.members_prefix = f"{prefix}/members/"
+        self.leader_key = f"{prefix}/leader"
+        self.lease_ttl = lease_ttl
+        self.vnodes = vnodes
+        self.lease: Optional[str] = None
+        self.last_renewed = 0.0
+        self.leader: Optional[str] = None
+        # replica id -> {"id": ..., "api_url": ...}
+        self.members: Dict[str, dict] = {self.replica_id: self.member}
+        self.ring = HashRing(self.members, vnodes)
+        self.listeners: List[RebalanceListener] = []
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def member(self) -> dict:
+        return {"id": self.replica_id, "api_url": self.api_url}
+
+    def subscribe(self, listener: RebalanceListener) -> None:
+        self.listeners.append(listener)
+
+    @property
+    def is_leader(self) -> bool:
+        # A replica that could not renew its lease may have been replaced already
+        return (
+            self.leader == self.replica_id
+            and time.monotonic() - self.last_renewed < self.lease_ttl
+        )
+
+    def owner(self, host: str) -> Optional[dict]:
+        return self.members.get(self.ring.owner(host))
+
+    def owns(self, host: str) -> bool:
+        return self.ring.owner(host) == self.replica_id
+
+    def peers(self) -> List[dict]:
+        return [
+            member for replica_id, member in self.members.items()
+            if replica_id != self.replica_id
+        ]
+
+    async def start(self) -> None:
+        await self.register()
+        await self.refresh()
+        self.task = asyncio.create_task(self.run())
+
+    async def register(self) -> None:
+        self.lease = await self.etcd.grant_lease(self.lease_ttl)
+        await self.etcd.put(
+            f"{self.members_prefix}{self.replica_id}", json.dumps(self.member), self.lease
+        )
+        self.last_renewed = time.monotonic()
+        logger.info(f"Replica {self.replica_id} joined the cluster at {self.api_url}")
+
+    async def renew(self) -> None:
+        if await self.etcd.keepalive(self.lease):
+            self.last_renewed = time.monotonic()
+        else:
+            # Our keys went with the lease, join again as a new member
+            logger.warning(f"Lease of replica {self.replica_id} expired")
+            await self.register()
+
+    async def refresh(self) -> None:
+        members = {}
+        for value in (await self.etcd.get_prefix(self.members_prefix)).values():
+            member = json.loads(value)
+            members[member["id"]] = member
+        members[self.replica_id] = self.member
+        leader = await self.etcd.get(self.leader_key)
+        if leader is None and await self.etcd.create(
+            self.leader_key, self.replica_id, self.lease
+        ):
+            leader = self.replica_id
+        if leader != self.leader:
+            logger.info(f"Replica {leader} is the leader")
+            self.leader = leader
+        self.members = members
+        if set(members) != set(self.ring.members):
+            old_ring, self.ring = self.ring, HashRing(members, self.vnodes)
+            logger.info(f"Cluster members changed to {', '.join(sorted(members))}")
+            for listener in self.listeners:
+                listener(old_ring, self.ring)
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.lease_ttl / 3)
+            try:
+                await self.renew()
+                await self.refresh()
+            except Exception as e:
+                logger.warning(f"Failed to refresh cluster membership: {e!r}")
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+        try:
+            if self.lease:
+                # Peers take over the VMs and leadership right away
+                await self.etcd.revoke(self.lease)
+        except Exception as e:
+            logger.warning(f"Failed to revoke lease of replica {self.replica_id}: {e!r}")
+        finally:
+            await self.etcd.close()
+
+    def to_dict(self) -> dict:
+        return {
+            "replica_id": self.replica_id,
+            "leader": self.leader,
+            "is_leader": self.is_leader,
+            "members": self.members,
+        }
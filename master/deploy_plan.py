@@ -0,0 +1,66 @@
+import hashlib
+import json
+import re
+import time
+from typing import List, Optional, Sequence
+
+# Manifests live next to deploy_worker.sh in the ssh user's home on the VM
+MANIFEST_DIR = ".orchestrator"
+# Run in this order, a step whose inputs changed reruns every later step
+STEPS = ("script", "worker_image", "container")
+
+
+def content_hash(*parts) -> str:
+    return hashlib.sha256(
+        json.dumps(parts, sort_keys=True, default=str).encode()
+    ).hexdigest()[:16]
+
+
+def manifest_path(app_image: str) -> str:
+    return f"{MANIFEST_DIR}/{re.sub(r'[^A-Za-z0-9_.-]', '_', app_image)}.json"
+
+
+# What one worker deployment to a VM consists of: the bootstrap script, the
+# worker image and the agent container with its configuration. Every step is
+# hashed over its inputs and the hashes of the steps before it, and compared
+# with the manifest the last deployment left on the VM. An input that is not
+# known, like the commit of a worker repo that could not be resolved, makes
+# its step run every time. The app configuration is not part of it, it goes
+# to the agent with every start of the app.
+class DeployPlan:
+    def __init__(
+        self,
+        worker_name: str,
+        script: Optional[bytes],
+        worker_image: Optional[str],
+        deploy_args: Sequence[str],
+    ):
+        self.worker_name = worker_name
+        self.deploy_args = tuple(deploy_args)
+        self.hashes = {
+            "script": hashlib.sha256(script).hexdigest()[:16] if script is not None else None
+        }
+        self.hashes["worker_image"] = (
+            content_hash(worker_image, self.hashes["script"])
+            if worker_image and self.hashes["script"]
+            else None
+        )
+        self.hashes["container"] = (
+            content_hash(self.deploy_args, self.hashes["worker_image"])
+            if self.hashes["worker_image"]
+            else None
+        )
+
+    def changed_steps(self, manifest: dict) -> List[str]:
+        deployed = manifest.get("steps", {})
+        for index, step in enumerate(STEPS):
+            if self.hashes[step] is None or deployed.get(step) != self.hashes[step]:
+                return list(STEPS[index:])
+        return []
+
+    def manifest(self) -> dict:
+        return {
+            "worker_name": self.worker_name,
+            "steps": self.hashes,
+            "deployed_at": time.time(),
+        }
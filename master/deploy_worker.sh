@@ -9,6 +9,12 @@ APP_PORT=$6
 HEALTHCHECK_API=$7
 APP_DOCKERFILE=$8
 WORKER_DOCKERFILE=$9
+MASTER_URL=${10}
+HEARTBEAT_INTERVAL=${11}
+WORKER_HOST=${12}
+WORKER_IMAGE=${13}
+# "false" when the master's deploy plan found the worker image unchanged
+BUILD_WORKER_IMAGE=${14:-true}
 
 
 # Remove existing container with the same name if it's running
@@ -19,21 +25,32 @@ fi
 # Remove containers running worker_image
 docker ps -a --filter ancestor="worker_image_${APP_IMAGE}" --format '{{.ID}}' | xargs -r docker rm -f
 
-# Clone worker git repository and build Docker image
-rm -rf worker_repo
-git clone $WORKER_GIT_REPO worker_repo
-cd worker_repo
-WORKER_DIR=$(dirname "$WORKER_DOCKERFILE")
-cd $WORKER_DIR
-echo "Current directory: $(pwd); Dockerfile path: $WORKER_DOCKERFILE"
-docker build --no-cache -t "worker_image_${APP_IMAGE}" .
-cd -
-cd ..
+if [ "$BUILD_WORKER_IMAGE" = "false" ] && docker image inspect "worker_image_${APP_IMAGE}" > /dev/null 2>&1; then
+  echo "Worker image worker_image_${APP_IMAGE} is up to date"
+elif [ -n "$WORKER_IMAGE" ] && docker image inspect "$WORKER_IMAGE" > /dev/null 2>&1; then
+  # Image was built once on the master and shipped to this VM
+  echo "Using prebuilt worker image $WORKER_IMAGE"
+  docker tag "$WORKER_IMAGE" "worker_image_${APP_IMAGE}"
+else
+  # Clone worker git repository and build Docker image
+  rm -rf worker_repo
+  git clone $WORKER_GIT_REPO worker_repo
+  cd worker_repo
+  WORKER_DIR=$(dirname "$WORKER_DOCKERFILE")
+  cd $WORKER_DIR
+  echo "Current directory: $(pwd); Dockerfile path: $WORKER_DOCKERFILE"
+  docker build --no-cache -t "worker_image_${APP_IMAGE}" .
+  cd -
+  cd ..
+fi
 
-# Run the Docker container
+# Run the Docker container, the host cgroup tree is mounted for the metrics of the app container
 docker run -d --name $WORKER_NAME -p $WORKER_PORT:$WORKER_PORT \
   -e APP_PORT=$APP_PORT -e HEALTHCHECK_API=$HEALTHCHECK_API -e APP_DOCKERFILE=$APP_DOCKERFILE \
   -e WORKER_PORT=$WORKER_PORT -e APP_GIT_REPO=$APP_GIT_REPO \
   -e APP_IMAGE=$APP_IMAGE -e WORKER_NAME=$WORKER_NAME \
+  -e MASTER_URL=$MASTER_URL -e HEARTBEAT_INTERVAL=$HEARTBEAT_INTERVAL -e WORKER_HOST=$WORKER_HOST \
   -v /var/run/docker.sock:/var/run/docker.sock \
+  -v /sys/fs/cgroup:/host/cgroup:ro -e CGROUP_ROOT=/host/cgroup \
+  -v /proc:/host/proc:ro -e PROC_ROOT=/host/proc \
   "worker_image_${APP_IMAGE}"
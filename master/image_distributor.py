@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import os
+import tempfile
+from typing import Dict, Optional, Tuple
+
+from master.ssh_pool import CommandError, SSHPool, run_command
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+REVISION_LABEL = "org.opencontainers.image.revision"
+
+
+# Builds images once per git commit on the master and ships them to VMs.
+# With a registry configured VMs pull only the layers they miss, otherwise the
+# image is streamed with `docker save | ssh docker load`.
+class ImageDistributor:
+    def __init__(self, ssh_pool: SSHPool, registry: Optional[str] = None):
+        self.ssh_pool = ssh_pool
+        self.registry = registry.rstrip("/") if registry else None
+        self.builds: Dict[Tuple[str, str, str], asyncio.Task] = {}
+        self.pushed = set()
+        self.host_locks: Dict[str, asyncio.Lock] = {}
+
+    async def resolve_commit(self, git_repo: str, ref: str = "HEAD") -> str:
+        output = await run_command("git", "ls-remote", git_repo, ref)
+        if not output:
+            raise CommandError(f"Ref {ref} not found in {git_repo}")
+        return output.split()[0]
+
+    async def ensure_image(
+        self, git_repo: str, dockerfile: str, image: str, ref: str = "HEAD"
+    ) -> str:
+        commit = await self.resolve_commit(git_repo, ref)
+        key = (git_repo, dockerfile, commit)
+        build = self.builds.get(key)
+        if build is None or (build.done() and build.exception()):
+            build = self.builds[key] = asyncio.create_task(
+                self._build(git_repo, dockerfile, image, commit)
+            )
+        return await asyncio.shield(build)
+
+    async def _build(self, git_repo: str, dockerfile: str, image: str, commit: str) -> str:
+        tag = f"{image}:{commit[:12]}"
+        if await self.local_image_id(tag):
+            logger.info(f"Image {tag} already built")
+            return tag
+
+        logger.info(f"Building image {tag} from {git_repo}@{commit}")
+        with tempfile.TemporaryDirectory() as tempdir:
+            await run_command("git", "init", "-q", tempdir)
+            await run_command(
+                "git", "-C", tempdir, "fetch", "-q", "--depth", "1", git_repo, commit
+            )
+            await run_command("git", "-C", tempdir, "checkout", "-q", "FETCH_HEAD")
+            build_context = os.path.dirname(os.path.join(tempdir, dockerfile))
+            await run_command(
+                "docker",
+                "build",
+                "-q",
+                "-t",
+                tag,
+                "--label",
+                f"{REVISION_LABEL}={commit}",
+                "-f",
+                os.path.join(tempdir, dockerfile),
+                build_context,
+            )
+        logger.info(f"Image {tag} built")
+        return tag
+
+    async def local_image_id(self, tag: str) -> Optional[str]:
+        try:
+            return await run_command(
+                "docker", "image", "inspect", "--format", "{{.Id}}", tag
+            )
+        except CommandError:
+            return None
+
+    async def remote_image_id(self, host: str, tag: str) -> Optional[str]:
+        try:
+            return await self.ssh_pool.run(
+                host, "docker", "image", "inspect", "--format", "{{.Id}}", tag
+            )
+        except CommandError:
+            return None
+
+    async def distribute(self, host: str, tag: str) -> None:
+        lock = self.host_locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            image_id = await self.local_image_id(tag)
+            if image_id and image_id == await self.remote_image_id(host, tag):
+                logger.info(f"Image {tag} already present on {host}")
+                return
+
+            if self.registry:
+                await self._pull_from_registry(host, tag)
+            else:
+                await self._stream_image(host, tag)
+            logger.info(f"Image {tag} distributed to {host}")
+
+    async def _pull_from_registry(self, host: str, tag: str) -> None:
+        registry_tag = f"{self.registry}/{tag}"
+        if registry_tag not in self.pushed:
+            await run_command("docker", "tag", tag, registry_tag)
+            await run_command("docker", "push", "-q", registry_tag)
+            self.pushed.add(registry_tag)
+        await self.ssh_pool.run(host, "docker", "pull", "-q", registry_tag)
+        await self.ssh_pool.run(host, "docker", "tag", registry_tag, tag)
+
+    async def _stream_image(self, host: str, tag: str) -> None:
+        read_fd, write_fd = os.pipe()
+        try:
+            save = await asyncio.create_subprocess_exec(
+                "docker", "save", tag, stdout=write_fd, stderr=asyncio.subprocess.PIPE
+            )
+        finally:
+            os.close(write_fd)
+        try:
+            await self.ssh_pool.run(host, "docker", "load", "-q", stdin=read_fd)
+        finally:
+            # Closing the read end unblocks docker save if the load failed early
+            os.close(read_fd)
+            _, save_stderr = await save.communicate()
+        if save.returncode != 0:
+            raise CommandError(f"Error saving image {tag}: {save_stderr.decode()}")
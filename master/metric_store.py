@@ -0,0 +1,161 @@
+import math
+import time
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+FLEET = "fleet"
+
+
+class RingBuffer:
+    __slots__ = ("capacity", "timestamps", "values", "start", "size")
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.timestamps = array("d", bytes(8 * capacity))
+        self.values = array("d", bytes(8 * capacity))
+        self.start = 0
+        self.size = 0
+
+    def append(self, timestamp: float, value: float) -> None:
+        index = (self.start + self.size) % self.capacity
+        self.timestamps[index] = timestamp
+        self.values[index] = value
+        if self.size < self.capacity:
+            self.size += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+
+    def items(self, since: Optional[float] = None) -> List[Tuple[float, float]]:
+        items = []
+        for offset in range(self.size):
+            index = (self.start + offset) % self.capacity
+            if since is None or self.timestamps[index] >= since:
+                items.append((self.timestamps[index], self.values[index]))
+        return items
+
+    def last(self, count: int) -> List[Tuple[float, float]]:
+        count = min(count, self.size)
+        first = self.start + self.size - count
+        return [
+            (
+                self.timestamps[(first + offset) % self.capacity],
+                self.values[(first + offset) % self.capacity],
+            )
+            for offset in range(count)
+        ]
+
+
+# Fixed-size metric history per worker and for the whole fleet, with the
+# aggregates the autoscaler decides on.
+class MetricStore:
+    def __init__(self, capacity: int = 360, ewma_alpha: float = 0.3):
+        self.capacity = capacity
+        self.ewma_alpha = ewma_alpha
+        self.series: Dict[Tuple[str, str], RingBuffer] = {}
+        self.ewmas: Dict[Tuple[str, str], float] = {}
+
+    def record(
+        self, scope: str, metric: str, value: float, timestamp: Optional[float] = None
+    ) -> None:
+        key = (scope, metric)
+        buffer = self.series.get(key)
+        if buffer is None:
+            buffer = self.series[key] = RingBuffer(self.capacity)
+        buffer.append(time.time() if timestamp is None else timestamp, value)
+        previous = self.ewmas.get(key)
+        self.ewmas[key] = (
+            value
+            if previous is None
+            else self.ewma_alpha * value + (1 - self.ewma_alpha) * previous
+        )
+
+    def drop(self, scope: str) -> None:
+        for key in [key for key in self.series if key[0] == scope]:
+            del self.series[key]
+            self.ewmas.pop(key, None)
+
+    def dump(self) -> List[list]:
+        return [
+            [scope, metric, buffer.items(), self.ewmas.get((scope, metric))]
+            for (scope, metric), buffer in self.series.items()
+        ]
+
+    def load(self, dump: List[list]) -> None:
+        for scope, metric, items, ewma in dump:
+            buffer = self.series[(scope, metric)] = RingBuffer(self.capacity)
+            for timestamp, value in items[-self.capacity:]:
+                buffer.append(timestamp, value)
+            if ewma is not None:
+                self.ewmas[(scope, metric)] = ewma
+
+    def scopes(self) -> List[str]:
+        return sorted({scope for scope, _ in self.series})
+
+    def history(
+        self, scope: str, metric: str, since: Optional[float] = None
+    ) -> List[Tuple[float, float]]:
+        buffer = self.series.get((scope, metric))
+        return buffer.items(since) if buffer else []
+
+    def latest(self, scope: str, metric: str) -> Optional[float]:
+        buffer = self.series.get((scope, metric))
+        if not buffer or not buffer.size:
+            return None
+        return buffer.last(1)[0][1]
+
+    def age(
+        self, scope: str, metric: str, now: Optional[float] = None
+    ) -> Optional[float]:
+        buffer = self.series.get((scope, metric))
+        if not buffer or not buffer.size:
+            return None
+        return (time.time() if now is None else now) - buffer.last(1)[0][0]
+
+    def ewma(self, scope: str, metric: str) -> Optional[float]:
+        return self.ewmas.get((scope, metric))
+
+    def percentile(
+        self,
+        scope: str,
+        metric: str,
+        percentile: float,
+        window: float,
+        now: Optional[float] = None,
+    ) -> Optional[float]:
+        now = time.time() if now is None else now
+        values = sorted(value for _, value in self.history(scope, metric, now - window))
+        if not values:
+            return None
+        rank = max(0, math.ceil(percentile / 100 * len(values)) - 1)
+        return values[rank]
+
+    def forecast(
+        self,
+        scope: str,
+        metric: str,
+        horizon: float,
+        samples: int = 12,
+        min_samples: int = 6,
+    ) -> Optional[float]:
+        # Least squares line through the recent samples, extrapolated ahead
+        buffer = self.series.get((scope, metric))
+        points = buffer.last(samples) if buffer else []
+        if len(points) < max(2, min_samples):
+            return None
+        origin = points[0][0]
+        xs = [timestamp - origin for timestamp, _ in points]
+        ys = [value for _, value in points]
+        mean_x = sum(xs) / len(xs)
+        mean_y = sum(ys) / len(ys)
+        variance = sum((x - mean_x) ** 2 for x in xs)
+        if not variance:
+            return mean_y
+        slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / variance
+        return max(0.0, mean_y + slope * (xs[-1] + horizon - mean_x))
+
+    def summary(self, scope: str, metric: str, window: float = 300) -> dict:
+        return {
+            "latest": self.latest(scope, metric),
+            "ewma": self.ewma(scope, metric),
+            "p95": self.percentile(scope, metric, 95, window),
+        }
@@ -0,0 +1,185 @@
+import asyncio
+import time
+from bisect import bisect_left
+from typing import Dict, List, Sequence, Tuple
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300
+)
+LOCK_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+REGISTRY: List["Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        super().__init__(name, help_text, labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        return super().render() + [
+            f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+            for key, value in sorted(self.values.items())
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        self.values[self._key(labels)] = value
+
+    def clear(self) -> None:
+        self.values.clear()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+        # label values -> (per-bucket counts with +Inf last, sum)
+        self.values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for key, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = bound if bound == "+Inf" else _format_value(bound)
+                labels = _format_labels(self.labels, key, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total!r}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+# An asyncio.Lock that records how long acquiring it took
+class TimedLock:
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = asyncio.Lock()
+
+    def locked(self) -> bool:
+        return self.lock.locked()
+
+    async def __aenter__(self) -> None:
+        started = time.monotonic()
+        await self.lock.acquire()
+        LOCK_WAIT_SECONDS.observe(time.monotonic() - started, lock=self.name)
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.lock.release()
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+WORKER_POLL_SECONDS = Histogram(
+    "orchestrator_worker_poll_seconds",
+    "Duration of one worker status request",
+    ["outcome"],
+)
+POLL_CYCLE_SECONDS = Histogram(
+    "orchestrator_poll_cycle_seconds", "Duration of polling the whole fleet once"
+)
+RECONCILE_SECONDS = Histogram(
+    "orchestrator_reconcile_seconds", "Duration of one check_and_scale_workers run"
+)
+SSH_COMMAND_SECONDS = Histogram(
+    "orchestrator_ssh_command_seconds",
+    "Duration of ssh and scp commands",
+    ["command", "outcome"],
+)
+OPERATIONS_TOTAL = Counter(
+    "orchestrator_operations_total",
+    "Finished worker operations by kind and final state",
+    ["kind", "state"],
+)
+OPERATION_SECONDS = Histogram(
+    "orchestrator_operation_seconds",
+    "Duration of worker operations from start to finish",
+    ["kind"],
+)
+LOCK_WAIT_SECONDS = Histogram(
+    "orchestrator_lock_wait_seconds",
+    "Time spent waiting to acquire a master lock",
+    ["lock"],
+    buckets=LOCK_BUCKETS,
+)
+WORKERS = Gauge(
+    "orchestrator_workers", "Known workers by application and status", ["app", "status"]
+)
+ACTIVE_OPERATIONS = Gauge(
+    "orchestrator_active_operations", "Pending and running operations", ["app"]
+)
+OPEN_CIRCUITS = Gauge(
+    "orchestrator_open_circuits", "Hosts whose circuit breaker is not closed", ["app"]
+)
+TRAFFIC_REQUESTS = Gauge(
+    "orchestrator_traffic_requests_per_second",
+    "Requests per second over all load balancers",
+    ["app"],
+)
+TRAFFIC_LATENCY_P95 = Gauge(
+    "orchestrator_traffic_latency_p95_seconds",
+    "95th percentile upstream response time over all load balancers",
+    ["app"],
+)
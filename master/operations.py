@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from master.metrics import OPERATION_SECONDS, OPERATIONS_TOTAL
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATES = ("pending", "running")
+
+
+# Runs deploy/restart/remove actions as background tasks, bounded globally and
+# per VM, and keeps their progress for the API.
+class OperationRunner:
+    def __init__(
+        self,
+        max_parallel: int = 10,
+        max_parallel_per_vm: int = 1,
+        history_size: int = 100,
+        on_change: Optional[Callable[[dict], None]] = None,
+    ):
+        self.semaphore = asyncio.Semaphore(max_parallel)
+        self.max_parallel_per_vm = max_parallel_per_vm
+        self.vm_semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.operations: Dict[str, dict] = {}
+        self.finished = deque()
+        self.history_size = history_size
+        self.tasks = set()
+        self.on_change = on_change
+
+    def submit(
+        self,
+        kind: str,
+        host: str,
+        worker_name: Optional[str],
+        action: Callable[[dict], Awaitable[None]],
+    ) -> dict:
+        operation = {
+            "id": str(uuid.uuid4()),
+            "kind": kind,
+            "worker": worker_name,
+            "host": host,
+            "state": "pending",
+            "step": None,
+            "error": None,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+        }
+        self.operations[operation["id"]] = operation
+        self._changed(operation)
+        task = asyncio.create_task(self._run(operation, action))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        logger.info(f"Scheduled {kind} operation {operation['id']} on {host}")
+        return operation
+
+    @staticmethod
+    def set_step(operation: Optional[dict], step: str) -> None:
+        if operation is not None:
+            operation["step"] = step
+
+    def active(self) -> List[dict]:
+        return [
+            operation
+            for operation in self.operations.values()
+            if operation["state"] in ACTIVE_STATES
+        ]
+
+    def to_list(self) -> List[dict]:
+        return sorted(self.operations.values(), key=lambda op: op["created_at"])
+
+    async def _run(self, operation: dict, action: Callable[[dict], Awaitable[None]]):
+        vm_semaphore = self.vm_semaphores.setdefault(
+            operation["host"], asyncio.Semaphore(self.max_parallel_per_vm)
+        )
+        try:
+            async with self.semaphore, vm_semaphore:
+                operation["state"] = "running"
+                operation["started_at"] = time.time()
+                self._changed(operation)
+                await action(operation)
+            operation["state"] = "succeeded"
+        except Exception as e:
+            operation["state"] = "failed"
+            operation["error"] = str(e)
+            logger.error(
+                f"{operation['kind']} operation {operation['id']} on {operation['host']} failed: {e}"
+            )
+        finally:
+            operation["finished_at"] = time.time()
+            OPERATIONS_TOTAL.inc(kind=operation["kind"], state=operation["state"])
+            if operation["started_at"] is not None:
+                OPERATION_SECONDS.observe(
+                    operation["finished_at"] - operation["started_at"],
+                    kind=operation["kind"],
+                )
+            self._remember(operation)
+            self._changed(operation)
+
+    def interrupt(self, operation: dict) -> None:
+        # An operation a previous master run did not finish
+        operation.update(state="interrupted", finished_at=time.time())
+        self.operations[operation["id"]] = operation
+        self._remember(operation)
+        self._changed(operation)
+
+    def _changed(self, operation: dict) -> None:
+        if self.on_change is not None:
+            self.on_change(operation)
+
+    def _remember(self, operation: dict) -> None:
+        self.finished.append(operation["id"])
+        while len(self.finished) > self.history_size:
+            self.operations.pop(self.finished.popleft(), None)
@@ -1,12 +1,56 @@
-import aiohttp
+import asyncio
+import json
+import math
+from typing import Callable, Dict, List, Optional, Tuple
+
 from aiohttp import web
 
+from master.autoscaler import SCALING_METRICS
+from master.cluster import Cluster
+from master.metrics import WORKERS, render_metrics
 from master.remote_workers_manager import RemoteWorkerManager
 
+REFRESH_CONCURRENCY = 50
+STREAM_KEEPALIVE = 15
+# Changes within this window go out as one event
+STREAM_COALESCE = 0.5
+
+
+def query_number(request: web.Request, name: str, default: Optional[float] = None) -> Optional[float]:
+    value = request.query.get(name)
+    if not value:
+        return default
+    try:
+        number = float(value)
+    except ValueError:
+        number = math.nan
+    # nan and inf parse but compare as nothing else does
+    if not math.isfinite(number):
+        raise web.HTTPBadRequest(text=f"{name} must be a number, got {value!r}")
+    return number
+
 
 class OrchestratorAPI:
-    def __init__(self, worker_manager: RemoteWorkerManager):
-        self.worker_manager = worker_manager
+    def __init__(
+        self, worker_managers: List[RemoteWorkerManager], cluster: Optional[Cluster] = None
+    ):
+        self.worker_managers = {
+            worker_manager.app_name: worker_manager for worker_manager in worker_managers
+        }
+        # Routes without an /apps/{app} prefix serve the first application
+        self.worker_manager = worker_managers[0]
+        # (app, payload) -> (version, serialized JSON)
+        self.payload_cache: Dict[Tuple[str, str], Tuple[int, bytes]] = {}
+        self.cluster = cluster
+
+    def manager(self, request: web.Request) -> RemoteWorkerManager:
+        app_name = request.match_info.get("app")
+        if app_name is None:
+            return self.worker_manager
+        worker_manager = self.worker_managers.get(app_name)
+        if worker_manager is None:
+            raise web.HTTPNotFound(text=f"Unknown application {app_name}")
+        return worker_manager
 
     async def index(self, request: web.Request) -> web.Response:
         html = """
@@ -102,19 +146,35 @@ class OrchestratorAPI:
             </div>
             
             <script>
-                async function fetchAndUpdate(url, id) {
-                    const response = await fetch(url);
+                async function fetchAndUpdate(url, id, options) {
+                    const response = await fetch(url, options);
                     const data = await response.json();
                     document.getElementById(id).innerText = JSON.stringify(data, null, 2);
                 }
             
+                // Live worker statuses, the stream sends a snapshot and then only changes
+                let workers = {};
+                const renderWorkers = () => {
+                    document.getElementById('workerStatusesOutput').innerText = JSON.stringify(workers, null, 2);
+                };
+                const workersStream = new EventSource('/workers/stream');
+                workersStream.addEventListener('snapshot', (event) => {
+                    workers = JSON.parse(event.data).workers;
+                    renderWorkers();
+                });
+                workersStream.addEventListener('delta', (event) => {
+                    const delta = JSON.parse(event.data);
+                    Object.assign(workers, delta.workers);
+                    delta.removed.forEach((name) => delete workers[name]);
+                    renderWorkers();
+                });
+
                 document.getElementById("refreshWorkers").addEventListener("click", () => {
                     fetchAndUpdate('/workers', 'workerStatusesOutput');
                 });
             
-                document.getElementById("updateWorkers").addEventListener("click", async () => {
-                    await fetch('/workers', { method: 'PUT' });
-                    fetchAndUpdate('/workers', 'workerStatusesOutput');
+                document.getElementById("updateWorkers").addEventListener("click", () => {
+                    fetchAndUpdate('/workers', 'workerStatusesOutput', { method: 'PUT' });
                 });
             
                 document.getElementById("viewConfigs").addEventListener("click", () => {
@@ -130,46 +190,384 @@ class OrchestratorAPI:
             """
         return web.Response(text=html, content_type="text/html")
 
+    def cached_json(
+        self,
+        request: web.Request,
+        payload: str,
+        version: int,
+        etag: str,
+        build: Callable[[], object],
+    ) -> web.Response:
+        # Serialized once per version, unchanged clients get a 304
+        if etag in request.headers.get("If-None-Match", ""):
+            return web.Response(status=304, headers={"ETag": etag})
+        key = (self.manager(request).app_name, payload)
+        cached = self.payload_cache.get(key)
+        if cached is None or cached[0] != version:
+            cached = self.payload_cache[key] = (version, json.dumps(build()).encode())
+        return web.Response(
+            body=cached[1], content_type="application/json", headers={"ETag": etag}
+        )
+
+    @staticmethod
+    def workers_delta(worker_manager: RemoteWorkerManager, since: Optional[int]) -> dict:
+        workers_data = worker_manager.workers_data
+        changed = workers_data.changed_since(since)
+        delta = {
+            "epoch": worker_manager.epoch,
+            "version": workers_data.version,
+            "full": changed is None,
+        }
+        if changed is None:
+            # Too old or from another epoch, start over from a full snapshot
+            delta["workers"] = workers_data.to_dict()
+            delta["removed"] = []
+        else:
+            delta["workers"] = {
+                worker_name: workers_data[worker_name].to_dict()
+                for worker_name in changed
+                if worker_name in workers_data
+            }
+            delta["removed"] = sorted(
+                worker_name for worker_name in changed if worker_name not in workers_data
+            )
+        return delta
+
     async def get_workers_statuses(self, request: web.Request) -> web.Response:
-        worker_statuses = self.worker_manager.workers_data
-        return web.json_response(worker_statuses)
+        worker_manager = self.manager(request)
+        since = request.query.get("since")
+        if since is not None:
+            return web.json_response(
+                self.workers_delta(worker_manager, worker_manager.parse_version(since)),
+                headers={"ETag": worker_manager.workers_etag},
+            )
+        return self.cached_json(
+            request,
+            "workers",
+            worker_manager.workers_data.version,
+            worker_manager.workers_etag,
+            worker_manager.workers_data.to_dict,
+        )
+
+    async def stream_workers(self, request: web.Request) -> web.StreamResponse:
+        # Server-sent events: a full snapshot first, then deltas as workers change
+        worker_manager = self.manager(request)
+        response = web.StreamResponse(
+            headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"}
+        )
+        await response.prepare(request)
+        version = worker_manager.parse_version(
+            request.headers.get("Last-Event-ID") or request.query.get("since")
+        )
+        try:
+            while True:
+                changed = worker_manager.workers_changed
+                if version != worker_manager.workers_data.version:
+                    delta = self.workers_delta(worker_manager, version)
+                    version = delta["version"]
+                    await response.write(
+                        f"id: {delta['epoch']}-{version}\n"
+                        f"event: {'snapshot' if delta['full'] else 'delta'}\n"
+                        f"data: {json.dumps(delta)}\n\n".encode()
+                    )
+                try:
+                    await asyncio.wait_for(changed.wait(), STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    await response.write(b": keepalive\n\n")
+                    continue
+                await asyncio.sleep(STREAM_COALESCE)
+        except (ConnectionResetError, asyncio.CancelledError):
+            pass
+        return response
 
     async def update_workers_data(self, request: web.Request) -> web.Response:
-        # Assuming the update_workers_data method in the RemoteWorkerManager is modified to be a coroutine
-        async with aiohttp.ClientSession() as session:
-            for worker in self.worker_manager.workers_data.values():
-                await self.worker_manager.update_worker_data(worker, session)
-        return web.Response(status=204)
+        worker_manager = self.manager(request)
+        if worker_manager.session is None:
+            raise web.HTTPServiceUnavailable(text="Workers are not polled yet")
+        semaphore = asyncio.Semaphore(REFRESH_CONCURRENCY)
+
+        async def refresh(worker):
+            async with semaphore:
+                return await worker_manager.update_worker_data(worker)
+
+        workers = list(worker_manager.workers_data.values())
+        refreshed = await asyncio.gather(*(refresh(worker) for worker in workers))
+        return web.json_response(
+            {
+                "version": worker_manager.workers_data.version,
+                "workers": {
+                    worker["name"]: {
+                        "status": worker.get("status"),
+                        # Workers with an operation in flight, on an open
+                        # circuit or of another replica are left alone
+                        "skipped": not was_refreshed,
+                    }
+                    for worker, was_refreshed in zip(workers, refreshed)
+                },
+            },
+            headers={"ETag": worker_manager.workers_etag},
+        )
 
     async def get_hosts_with_healthy_workers(
         self, request: web.Request
     ) -> web.Response:
-        healthy_hosts = [
-            f"{worker_data['host']}:{self.worker_manager.app_port}"
-            for worker_data in self.worker_manager.workers_data.values()
-            if worker_data["status"] == "healthy"
-        ]
-        return web.json_response(healthy_hosts)
+        worker_manager = self.manager(request)
+        # Legacy clients apply whatever they fetched
+        worker_manager.ack_upstreams(request.remote, worker_manager.upstreams_version)
+        return self.cached_json(
+            request,
+            "healthy_hosts",
+            worker_manager.upstreams_version,
+            worker_manager.upstreams_etag,
+            worker_manager.get_healthy_hosts,
+        )
+
+    async def get_upstreams(self, request: web.Request) -> web.Response:
+        # Long poll: with If-None-Match of the current version the request is held
+        # until the upstreams change or `wait` seconds pass
+        worker_manager = self.manager(request)
+        load_balancer = request.headers.get("X-Load-Balancer-Id", request.remote)
+        known_version = worker_manager.parse_version(
+            request.headers.get("If-None-Match")
+        )
+        if known_version is not None:
+            worker_manager.ack_upstreams(load_balancer, known_version)
+        wait = min(
+            max(query_number(request, "wait", 0.0), 0.0),
+            worker_manager.upstreams_long_poll_timeout,
+        )
+        if known_version == worker_manager.upstreams_version and wait > 0:
+            try:
+                await asyncio.wait_for(worker_manager.upstreams_changed.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+        headers = {"ETag": worker_manager.upstreams_etag}
+        if known_version == worker_manager.upstreams_version:
+            return web.Response(status=304, headers=headers)
+        return web.json_response(
+            {
+                "version": worker_manager.upstreams_version,
+                "upstreams": worker_manager.upstreams,
+            },
+            headers=headers,
+        )
+
+    async def receive_heartbeat(self, request: web.Request) -> web.Response:
+        heartbeat = await request.json()
+        accepted = await self.manager(request).apply_heartbeat(
+            heartbeat, request.remote, request.headers.get("X-Forwarded-By")
+        )
+        if not accepted:
+            return web.json_response({"resync": True}, status=409)
+        return web.Response(status=204)
+
+    async def receive_telemetry(self, request: web.Request) -> web.Response:
+        worker_manager = self.manager(request)
+        report = await request.json()
+        load_balancer = report.get("load_balancer") or request.headers.get(
+            "X-Load-Balancer-Id", request.remote
+        )
+        worker_manager.telemetry.add(load_balancer, report)
+        if not worker_manager.is_leader and "X-Forwarded-By" not in request.headers:
+            await worker_manager.forward_telemetry(report)
+        return web.Response(status=204)
+
+    async def get_telemetry(self, request: web.Request) -> web.Response:
+        return web.json_response(self.manager(request).telemetry.summary())
+
+    async def get_metrics_history(self, request: web.Request) -> web.Response:
+        worker_manager = self.manager(request)
+        metric_store = worker_manager.metric_store
+        return web.json_response(
+            {
+                "scopes": {
+                    scope: {
+                        metric: metric_store.summary(scope, metric)
+                        for metric in SCALING_METRICS
+                    }
+                    for scope in metric_store.scopes()
+                },
+                "autoscaler": worker_manager.autoscaler.last_decision,
+            }
+        )
+
+    async def get_scope_metrics_history(self, request: web.Request) -> web.Response:
+        metric_store = self.manager(request).metric_store
+        scope = request.match_info["scope"]
+        since = query_number(request, "since")
+        metrics = request.query.getall("metric", list(SCALING_METRICS))
+        return web.json_response(
+            {metric: metric_store.history(scope, metric, since) for metric in metrics}
+        )
+
+    async def get_operations(self, request: web.Request) -> web.Response:
+        return web.json_response(self.manager(request).operations.to_list())
+
+    async def get_operation(self, request: web.Request) -> web.Response:
+        operations = self.manager(request).operations.operations
+        operation = operations.get(request.match_info["operation_id"])
+        if operation is None:
+            raise web.HTTPNotFound()
+        return web.json_response(operation)
+
+    async def submit_action(self, request: web.Request) -> web.Response:
+        # Actions the leader planned for VMs this replica owns
+        worker_manager = self.manager(request)
+        if worker_manager.session is None:
+            raise web.HTTPServiceUnavailable(text="Workers are not polled yet")
+        action = await request.json()
+        if not worker_manager.owns(action["host"]):
+            raise web.HTTPConflict(text=f"VM {action['host']} is owned by another replica")
+        if "revision" in action:
+            # The leader's revision is the one to deploy
+            worker_manager.set_app_revision(action["revision"])
+        try:
+            operation = worker_manager.submit_action(
+                action["kind"], action["host"], action.get("worker_name")
+            )
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+        return web.json_response(
+            operation,
+            status=202,
+            headers={"Location": f"/apps/{worker_manager.app_name}/operations/{operation['id']}"},
+        )
+
+    async def get_metrics(self, request: web.Request) -> web.Response:
+        WORKERS.clear()
+        for worker_manager in self.worker_managers.values():
+            worker_manager.update_metric_gauges()
+        return web.Response(
+            body=render_metrics().encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+    async def get_circuit_breakers(self, request: web.Request) -> web.Response:
+        return web.json_response(self.manager(request).breakers.to_dict())
+
+    async def get_ssh_pool_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.manager(request).ssh_pool.stats())
 
     async def get_master_settings(self, request: web.Request) -> web.Response:
+        worker_manager = self.manager(request)
         settings = {
-            "worker_limits": self.worker_manager.worker_limits,
-            "virtual_machines": self.worker_manager.virtual_machines,
-            "worker_port": self.worker_manager.worker_port,
-            "app_port": self.worker_manager.app_port,
+            "app": worker_manager.app_name,
+            "app_resources": worker_manager.app_resources,
+            "app_revision": worker_manager.app_revision,
+            "worker_limits": worker_manager.worker_limits,
+            "virtual_machines": worker_manager.virtual_machines,
+            "worker_port": worker_manager.worker_port,
+            "app_port": worker_manager.app_port,
+            "heartbeat_url": worker_manager.heartbeat_url,
+            "heartbeat_interval": worker_manager.heartbeat_interval,
+            "upstreams_version": worker_manager.upstreams_version,
             # Add other settings here
         }
         return web.json_response(settings)
 
+    async def get_apps(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                app_name: {
+                    "resources": worker_manager.app_resources,
+                    "workers": len(worker_manager.workers_data),
+                    "healthy_workers": len(worker_manager.upstreams),
+                    "worker_port": worker_manager.worker_port,
+                    "app_port": worker_manager.app_port,
+                }
+                for app_name, worker_manager in self.worker_managers.items()
+            }
+        )
+
+    async def get_placement(self, request: web.Request) -> web.Response:
+        return web.json_response(self.worker_manager.scheduler.to_dict())
+
+    async def start_rollout(self, request: web.Request) -> web.Response:
+        worker_manager = self.manager(request)
+        if not worker_manager.is_leader:
+            raise web.HTTPConflict(
+                text=f"Rollouts run on the leader replica {self.cluster.leader}"
+            )
+        if worker_manager.session is None:
+            raise web.HTTPServiceUnavailable(text="Workers are not polled yet")
+        params = await request.json()
+        if not params.get("revision"):
+            raise web.HTTPBadRequest(text="revision is required")
+        try:
+            rollout = worker_manager.start_rollout(**params)
+        except (TypeError, ValueError) as e:
+            # Unknown parameters or a wave of size 0
+            raise web.HTTPBadRequest(text=str(e))
+        except RuntimeError as e:
+            raise web.HTTPConflict(text=str(e))
+        return web.json_response(
+            rollout.to_dict(),
+            status=202,
+            headers={"Location": f"/apps/{worker_manager.app_name}/rollouts/{rollout.id}"},
+        )
+
+    async def get_rollouts(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            [rollout.to_dict() for rollout in self.manager(request).rollouts.values()]
+        )
+
+    def find_rollout(self, request: web.Request):
+        rollout = self.manager(request).rollouts.get(request.match_info["rollout_id"])
+        if rollout is None:
+            raise web.HTTPNotFound()
+        return rollout
+
+    async def get_rollout(self, request: web.Request) -> web.Response:
+        return web.json_response(self.find_rollout(request).to_dict())
+
+    async def abort_rollout(self, request: web.Request) -> web.Response:
+        # Stops after the operations in flight, the fleet stays mixed
+        rollout = self.find_rollout(request)
+        rollout.abort()
+        return web.json_response(rollout.to_dict(), status=202)
+
+    async def get_cluster(self, request: web.Request) -> web.Response:
+        if self.cluster is None:
+            return web.json_response({"replica_id": None, "is_leader": True, "members": {}})
+        return web.json_response(self.cluster.to_dict())
+
     def create_app(self) -> web.Application:
         app = web.Application()
+        app_routes = [
+            ("GET", "/workers", self.get_workers_statuses),
+            ("GET", "/workers/stream", self.stream_workers),
+            ("PUT", "/workers", self.update_workers_data),
+            ("GET", "/healthy_hosts", self.get_hosts_with_healthy_workers),
+            ("GET", "/upstreams", self.get_upstreams),
+            ("POST", "/heartbeat", self.receive_heartbeat),
+            ("POST", "/telemetry", self.receive_telemetry),
+            ("GET", "/telemetry", self.get_telemetry),
+            ("GET", "/ssh_pool", self.get_ssh_pool_stats),
+            ("GET", "/circuit_breakers", self.get_circuit_breakers),
+            ("GET", "/operations", self.get_operations),
+            ("GET", "/operations/{operation_id}", self.get_operation),
+            ("POST", "/actions", self.submit_action),
+            ("GET", "/rollouts", self.get_rollouts),
+            ("POST", "/rollouts", self.start_rollout),
+            ("GET", "/rollouts/{rollout_id}", self.get_rollout),
+            ("POST", "/rollouts/{rollout_id}/abort", self.abort_rollout),
+            ("GET", "/history", self.get_metrics_history),
+            ("GET", "/history/{scope}", self.get_scope_metrics_history),
+            ("GET", "/settings", self.get_master_settings),
+        ]
         app.add_routes(
             [
                 web.get("/", self.index),
-                web.get("/workers", self.get_workers_statuses),
-                web.put("/workers", self.update_workers_data),
-                web.get("/healthy_hosts", self.get_hosts_with_healthy_workers),
-                web.get("/settings", self.get_master_settings),
+                web.get("/metrics", self.get_metrics),
+                web.get("/apps", self.get_apps),
+                web.get("/placement", self.get_placement),
+                web.get("/cluster", self.get_cluster),
+            ]
+            + [web.route(method, path, handler) for method, path, handler in app_routes]
+            + [
+                web.route(method, f"/apps/{{app}}{path}", handler)
+                for method, path, handler in app_routes
             ]
         )
         return app
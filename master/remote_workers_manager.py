@@ -1,12 +1,53 @@
 import asyncio
+import json
 import os
+import shlex
+import time
 import uuid
-from typing import List, Dict
+from typing import List, Dict, Optional, Set
 import logging
 
+import aiohttp
+
+from master.autoscaler import Autoscaler, WORKER_METRICS
+from master.circuit_breaker import CircuitBreakers, is_unreachable_error
+from master.cluster import Cluster, HashRing
+from master.deploy_plan import MANIFEST_DIR, DeployPlan, manifest_path
+from master.image_distributor import ImageDistributor
+from master.metric_store import MetricStore
+from master.metrics import (
+    ACTIVE_OPERATIONS,
+    OPEN_CIRCUITS,
+    RECONCILE_SECONDS,
+    TRAFFIC_LATENCY_P95,
+    TRAFFIC_REQUESTS,
+    WORKER_POLL_SECONDS,
+    WORKERS,
+    TimedLock,
+)
+from master.operations import OperationRunner
+from master.rollout import Rollout, resolve_revision
+from master.scheduler import BinPackingScheduler
+from master.ssh_pool import CommandError, SSHPool
+from master.state_journal import StateJournal
+from master.telemetry import TrafficTelemetry
+from master.worker_registry import WorkerRecord, WorkerRegistry
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+REMOVAL_KINDS = ("remove", "scale_in")
+# How old the agent's samples are, they change with every poll and neither
+# go to the journal nor bump the workers version
+SAMPLE_AGE_FIELDS = ("status_age", "memory_usage_age", "cpu_usage_age")
+# Reported with every heartbeat, kept out of the journal
+SAMPLED_FIELDS = set(WORKER_METRICS) | {
+    "cpu_pressure",
+    "io_pressure",
+    "io_read_bytes_per_second",
+    "io_write_bytes_per_second",
+}
+
 
 class RemoteWorkerManager:
     def __init__(
@@ -15,10 +56,26 @@ class RemoteWorkerManager:
             worker_info: dict,
             worker_limits: Dict[str, int],
             virtual_machines: List[str],
+            heartbeat_info: Optional[dict] = None,
+            image_distribution: Optional[dict] = None,
+            ssh_info: Optional[dict] = None,
+            operations_info: Optional[dict] = None,
+            load_balancer_info: Optional[dict] = None,
+            state_info: Optional[dict] = None,
+            breaker_info: Optional[dict] = None,
+            scheduler: Optional[BinPackingScheduler] = None,
+            cluster: Optional[Cluster] = None,
+            rollout_info: Optional[dict] = None,
     ):
         self.worker_limits = worker_limits
         self.virtual_machines = virtual_machines
-        self.workers_data = {}
+        self.workers_data = WorkerRegistry(virtual_machines, quiet_fields=SAMPLE_AGE_FIELDS)
+        self.workers_data.subscribe(self.on_worker_change)
+        self.metric_store = MetricStore(
+            capacity=worker_limits.get("history_size", 360),
+            ewma_alpha=worker_limits.get("ewma_alpha", 0.3),
+        )
+        self.autoscaler = Autoscaler(self.metric_store, worker_limits)
         self.worker_port = str(worker_info["port"])
         self.app_port = str(app_info.get("app_port", ""))
         self.worker_git_repo = worker_info.get("git_repo", "")
@@ -27,303 +84,1426 @@ class RemoteWorkerManager:
         self.app_image = app_info.get("image", "")
         self.app_git_repo = app_info.get("git_repo", "")
         self.app_dockerfile = app_info.get("dockerfile", "")
-        self.worker_operation_lock = asyncio.Lock()
-        self.worker_data_lock = asyncio.Lock()
-        self.session = None
+        self.app_name = app_info.get("name") or self.app_image
+        # {"cpus": ..., "memory_mb": ...} per container, None takes a whole VM
+        self.app_resources = app_info.get("resources")
+        # Commit or branch workers build the app from, the repo head if unset
+        self.app_revision = app_info.get("revision")
+        self.worker_operation_lock = TimedLock("worker_operation_lock")
+        self.worker_data_lock = TimedLock("worker_data_lock")
+        self.worker_locks: Dict[str, TimedLock] = {}
         self.ssh_user = os.getenv("SSH_USER")
         if not self.ssh_user:
             raise RuntimeError("no SSH_USER env variable provided for ssh remote VMs")
+        breaker_info = dict(breaker_info or {})
+        # Explicit deadlines, a dead VM must not hang a request
+        self.request_timeout = aiohttp.ClientTimeout(
+            total=None,
+            sock_connect=breaker_info.pop("connect_timeout", 2),
+            sock_read=breaker_info.pop("read_timeout", 5),
+        )
+        self.breakers = CircuitBreakers(**breaker_info)
+        self.ssh_pool = SSHPool(self.ssh_user, breakers=self.breakers, **(ssh_info or {}))
+        heartbeat_info = heartbeat_info or {}
+        self.heartbeat_url = heartbeat_info.get("master_url", "")
+        self.heartbeat_interval = heartbeat_info.get("interval", 2)
+        self.heartbeat_timeout = heartbeat_info.get(
+            "timeout", 3 * self.heartbeat_interval
+        )
+        # worker_name -> (last heartbeat seq, monotonic time of last sign of life)
+        self.heartbeats: Dict[str, tuple] = {}
+        # worker_name -> monotonic time of its removal. Late heartbeats and
+        # polls of a removed worker are dropped while it is remembered.
+        self.removed_workers: Dict[str, float] = {}
+        self.image_distributor = None
+        self.app_image_ref = ""
+        if image_distribution and image_distribution.get("enabled", True):
+            self.image_distributor = ImageDistributor(
+                self.ssh_pool, registry=image_distribution.get("registry")
+            )
+        self.journal = None
+        if state_info and state_info.get("directory"):
+            self.journal = StateJournal(**state_info)
+        self.recovering = False
+        self.interrupted_operations: List[dict] = []
+        operations_info = operations_info or {}
+        self.operations = OperationRunner(
+            max_parallel=operations_info.get("max_parallel", 10),
+            max_parallel_per_vm=operations_info.get("max_parallel_per_vm", 1),
+            on_change=lambda operation: self.journal_record(
+                {"type": "operation", "operation": dict(operation)}
+            ),
+        )
+        self.readiness_timeout = operations_info.get("readiness_timeout", 300)
+        self.readiness_max_delay = operations_info.get("readiness_max_delay", 5)
+        self.lb_sync_timeout = operations_info.get("lb_sync_timeout", 30)
+        self.drain_timeout = operations_info.get("drain_timeout", 120)
+        # How long a drain waits once load balancers acked when the agent
+        # can not count the connections
+        self.drain_grace_period = operations_info.get("drain_grace_period", 5)
+        self.agent_operation_timeout = operations_info.get("agent_operation_timeout", 900)
+        self.removed_worker_ttl = operations_info.get("removed_worker_ttl", 600)
+        load_balancer_info = load_balancer_info or {}
+        self.upstream_max_weight = load_balancer_info.get("max_weight", 5)
+        self.upstreams_long_poll_timeout = load_balancer_info.get("long_poll_timeout", 30)
+        self.load_balancer_ttl = load_balancer_info.get("client_ttl", 120)
+        self.telemetry = TrafficTelemetry(ttl=load_balancer_info.get("telemetry_ttl", 30))
+        self.traffic_summary: Optional[dict] = None
+        # Versions restart with the master, the epoch keeps old ETags from matching
+        self.epoch = uuid.uuid4().hex[:8]
+        self.upstreams_version = 0
+        self.upstreams: List[dict] = []
+        # worker name -> its upstream entry, for healthy workers only
+        self.upstream_entries: Dict[str, dict] = {}
+        # Telemetry addresses of the last report that matched no worker
+        self.unknown_upstreams: Set[str] = set()
+        self.upstreams_changed = asyncio.Event()
+        self.workers_changed = asyncio.Event()
+        # load balancer id -> (last applied upstreams version, monotonic time seen)
+        self.load_balancer_acks: Dict[str, tuple] = {}
+        self.session = None
+        self.scheduler = scheduler or BinPackingScheduler()
+        self.scheduler.register(self)
+        # Replicas split the VMs, without a cluster this master owns all of them
+        self.cluster = cluster
+        # peer replica id -> "<epoch>-<version>" of its workers we have
+        self.peer_versions: Dict[str, str] = {}
+        self.rebalance_task = None
+        if cluster is not None:
+            cluster.subscribe(self.on_rebalance)
+        self.rollout_info = rollout_info or {}
+        self.rollouts: Dict[str, Rollout] = {}
+        self.rollout: Optional[Rollout] = None
+
+        logger.info(f"WorkerManager initialized for app {self.app_name}.")
+
+    def get_worker_lock(self, worker_name: str) -> TimedLock:
+        lock = self.worker_locks.get(worker_name)
+        if lock is None:
+            # One series for the locks of all workers, not one per worker
+            lock = self.worker_locks[worker_name] = TimedLock("worker_lock")
+        return lock
+
+    def is_worker_busy(self, worker_name: str) -> bool:
+        return self.get_worker_lock(worker_name).locked()
 
-        logger.info("WorkerManager initialized with app_info and worker_info.")
+    def journal_record(self, record: dict) -> None:
+        if self.journal is not None:
+            self.journal.append(record)
+
+    def owns(self, host: Optional[str]) -> bool:
+        return self.cluster is None or host is None or self.cluster.owns(host)
+
+    @property
+    def is_leader(self) -> bool:
+        return self.cluster is None or self.cluster.is_leader
+
+    def on_rebalance(self, old_ring: HashRing, new_ring: HashRing) -> None:
+        replica_id = self.cluster.replica_id
+        owned = [vm for vm in self.virtual_machines if new_ring.owner(vm) == replica_id]
+        taken_over = [vm for vm in owned if old_ring.owner(vm) != replica_id]
+        logger.info(
+            f"App {self.app_name}: replica owns {len(owned)} of "
+            f"{len(self.virtual_machines)} VMs, {len(taken_over)} taken over"
+        )
+        # Workers of taken over VMs are known from their previous owner, VMs
+        # nobody reported yet are probed
+        unknown = [vm for vm in taken_over if not self.workers_data.on_host(vm)]
+        if unknown and self.session is not None:
+            self.rebalance_task = asyncio.create_task(
+                self.initialize_workers_data(vms=unknown)
+            )
 
     async def set_worker_value_data(self, worker_name, key, value):
+        # A single value never makes a record, the worker may be gone already
         async with self.worker_data_lock:
-            self.workers_data[worker_name][key] = value
+            self.workers_data.update(worker_name, {key: value}, create=False)
 
-    async def set_worker_data(self, worker_name, data):
+    async def set_worker_data(self, worker_name, data, create=True):
         async with self.worker_data_lock:
-            if worker_name in self.workers_data:
-                self.workers_data[worker_name].update(**data)
-            else:
-                self.workers_data[worker_name] = data
+            if worker_name not in self.workers_data:
+                if not create:
+                    return
+                self.heartbeats.setdefault(worker_name, (0, time.monotonic()))
+            for metric in WORKER_METRICS:
+                if data.get(metric) is not None:
+                    self.metric_store.record(worker_name, metric, data[metric])
+            self.workers_data.update(
+                worker_name, data, load=self.metric_store.ewma(worker_name, "cpu_usage") or 0
+            )
+
+    def poll_outdated(self, worker_name: str) -> bool:
+        # The worker was removed or taken by an operation while its status
+        # was being fetched, the result must not be written back
+        return (
+            worker_name not in self.workers_data
+            or worker_name in self.removed_workers
+            or self.is_worker_busy(worker_name)
+        )
 
     async def del_worker_data(self, worker_name):
         async with self.worker_data_lock:
-            del self.workers_data[worker_name]
+            self.workers_data.remove(worker_name)
+            self.worker_locks.pop(worker_name, None)
+            self.heartbeats.pop(worker_name, None)
+            self.forget_removed_workers()
+            # Moved to the end when removed again
+            self.removed_workers.pop(worker_name, None)
+            self.removed_workers[worker_name] = time.monotonic()
+        self.metric_store.drop(worker_name)
+
+    def forget_removed_workers(self) -> None:
+        # Removals are recorded in order, the oldest come first
+        expired = time.monotonic() - self.removed_worker_ttl
+        while self.removed_workers:
+            worker_name, removed_at = next(iter(self.removed_workers.items()))
+            if removed_at > expired:
+                break
+            del self.removed_workers[worker_name]
+
+    def on_worker_change(
+            self, event: str, worker_name: str, worker_data: WorkerRecord, changes: dict
+    ) -> None:
+        # Wake up the dashboard streams
+        self.workers_changed.set()
+        self.workers_changed = asyncio.Event()
+        if event == "removed":
+            self.journal_record({"type": "worker_removed", "name": worker_name})
+            self.update_upstream(worker_name, None)
+            return
+        # Metrics go to snapshots only, the journal keeps real state changes
+        state_changes = {
+            key: value for key, value in changes.items() if key not in SAMPLED_FIELDS
+        }
+        if state_changes:
+            self.journal_record({"type": "worker", "name": worker_name, "data": state_changes})
+        if "vm_cpus" in changes or ("host" in changes and worker_data.get("vm_cpus")):
+            self.report_capacity(worker_data)
+        self.update_upstream(worker_name, worker_data)
+
+    async def restore_state(self) -> bool:
+        if self.journal is None:
+            return False
+        state = self.journal.load() or await self.journal.load_remote()
+        if not state:
+            return False
+        self.workers_data.replace(state["workers"])
+        self.app_revision = state.get("app_revision") or self.app_revision
+        self.metric_store.load(state["metrics"])
+        for worker_name, worker_data in self.workers_data.items():
+            self.heartbeats[worker_name] = (0, time.monotonic())
+            self.workers_data.set_load(
+                worker_name, self.metric_store.ewma(worker_name, "cpu_usage") or 0
+            )
+            if worker_data.get("vm_cpus"):
+                self.report_capacity(worker_data)
+        self.interrupted_operations = list(state["operations"].values())
+        self.recovering = True
+        self.refresh_upstreams()
+        logger.info(
+            f"Restored {len(self.workers_data)} workers and "
+            f"{len(self.interrupted_operations)} unfinished operations"
+        )
+        return True
+
+    async def recover(self, timeout: Optional[aiohttp.ClientTimeout] = None) -> None:
+        # Checks the restored state against the VMs while it is already served
+        try:
+            await self.initialize_workers_data(timeout)
+            await asyncio.gather(
+                *(
+                    self.update_worker_data(worker, timeout)
+                    for worker in list(self.workers_data.values())
+                )
+            )
+            for operation in self.interrupted_operations:
+                self.operations.interrupt(operation)
+                self.resume_operation(operation)
+            logger.info("Restored state verified")
+        finally:
+            self.interrupted_operations = []
+            self.recovering = False
+
+    def resume_operation(self, operation: dict) -> None:
+        kind = operation["kind"]
+        worker_name = operation["worker"]
+        if worker_name not in self.workers_data:
+            # Deploys that got far enough were adopted by the VM probe, the
+            # reconcile loop redoes the rest
+            return
+        if kind in REMOVAL_KINDS or (
+                kind == "restart" and not self.is_app_healthy(worker_name)
+        ):
+            logger.info(f"Resuming interrupted {kind} of worker {worker_name}")
+            self.submit_action(kind, operation["host"], worker_name)
+
+    async def checkpoint(self) -> None:
+        if self.journal is None or not self.journal.needs_snapshot():
+            return
+        await self.journal.write_snapshot(
+            {
+                "workers": self.workers_data.to_dict(),
+                "operations": {
+                    operation["id"]: operation for operation in self.operations.active()
+                },
+                "metrics": self.metric_store.dump(),
+                "app_revision": self.app_revision,
+            }
+        )
+
+    def report_capacity(self, worker_data: dict) -> None:
+        if worker_data.get("host"):
+            self.scheduler.report_capacity(
+                worker_data["host"], worker_data["vm_cpus"], worker_data.get("vm_memory_mb")
+            )
+
+    def app_request_body(self) -> Optional[dict]:
+        body = {}
+        if self.app_image_ref:
+            body["image"] = self.app_image_ref
+        if self.app_resources:
+            body["resources"] = self.app_resources
+        if self.app_revision:
+            body["revision"] = self.app_revision
+        return body or None
+
+    def set_app_revision(self, revision: Optional[str]) -> None:
+        if revision == self.app_revision:
+            return
+        logger.info(f"App {self.app_name} revision set to {revision}")
+        self.app_revision = revision
+        # A prebuilt image of the old revision must not be offered any more
+        self.app_image_ref = ""
+        self.journal_record({"type": "app_revision", "revision": revision})
+
+    def start_rollout(self, **params) -> Rollout:
+        if self.rollout is not None and self.rollout.active:
+            raise RuntimeError(f"Rollout {self.rollout.id} is in progress")
+        rollout = Rollout(self, **{**self.rollout_info, **params})
+        self.rollout = self.rollouts[rollout.id] = rollout
+        rollout.start()
+        return rollout
+
+    @property
+    def rollout_active(self) -> bool:
+        return self.rollout is not None and self.rollout.active
+
+    @property
+    def rollout_surge(self) -> int:
+        return self.rollout.surge if self.rollout_active else 0
+
+    @property
+    def heartbeat_enabled(self) -> bool:
+        return bool(self.heartbeat_url)
+
+    async def apply_heartbeat(
+            self, heartbeat: dict, remote_host: str, forwarded_by: Optional[str] = None
+    ) -> bool:
+        worker_name = heartbeat.get("worker_name")
+        seq = heartbeat.get("seq", 0)
+        status = heartbeat.get("status", {})
+        if not worker_name or worker_name in self.removed_workers:
+            return True
+        if self.is_worker_busy(worker_name):
+            # Deploy/remove owns the worker state, the next full heartbeat resyncs it
+            return True
+
+        host = (
+            self.workers_data.get(worker_name, {}).get("host")
+            or heartbeat.get("host")
+            or remote_host
+        )
+        if not self.owns(host):
+            if forwarded_by:
+                # The rings disagree while a rebalance settles, the agent
+                # resyncs with its next beat instead of bouncing between us
+                logger.debug(
+                    f"Heartbeat of {worker_name} forwarded by {forwarded_by} is not ours"
+                )
+                return False
+            # Agents keep reporting to whichever replica deployed them
+            return await self.forward_heartbeat({**heartbeat, "host": host}, host)
+
+        last = self.heartbeats.get(worker_name)
+        if heartbeat.get("full"):
+            await self.set_worker_data(
+                worker_name, {"name": worker_name, "host": host, **status}
+            )
+        elif worker_name in self.workers_data and last and last[0] + 1 == seq:
+            await self.set_worker_data(worker_name, status)
+        else:
+            return False
+
+        self.heartbeats[worker_name] = (seq, time.monotonic())
+        return True
+
+    async def forward_heartbeat(self, heartbeat: dict, host: str) -> bool:
+        owner = self.cluster.owner(host)
+        if owner is None or self.session is None:
+            return True
+        try:
+            async with self.session.post(
+                    f"{owner['api_url']}/apps/{self.app_name}/heartbeat",
+                    json=heartbeat,
+                    headers={"X-Forwarded-By": self.cluster.replica_id},
+                    timeout=self.request_timeout,
+            ) as response:
+                return response.status != 409
+        except Exception as e:
+            logger.warning(f"Failed to forward heartbeat to replica {owner['id']}: {e!r}")
+            return True
+
+    async def expire_missing_heartbeats(self) -> None:
+        deadline = time.monotonic() - self.heartbeat_timeout
+        for worker_name in list(self.workers_data):
+            last = self.heartbeats.get(worker_name)
+            if self.is_worker_busy(worker_name) or (last and last[1] >= deadline):
+                continue
+            if not self.owns(self.workers_data[worker_name].get("host")):
+                # Followed through the owning replica
+                continue
+            if self.workers_data[worker_name].get("status") != "failed":
+                await self.set_worker_value_data(worker_name, "status", "failed")
+                logger.warning(
+                    f"Worker {worker_name} missed heartbeat deadline of {self.heartbeat_timeout} sec"
+                )
 
     async def check_and_scale_workers(self) -> None:
-        healthy_workers = 0
+        await self.checkpoint()
+        if self.recovering:
+            logger.info("Skipping scaling until the restored state is verified")
+            return
+        if not self.is_leader:
+            # The leader plans for the whole fleet and hands us our VMs' share
+            return
+        started = time.monotonic()
+        self.autoscaler.record_fleet(
+            [
+                self.workers_data[worker_name]
+                for worker_name in self.workers_data.with_status("healthy")
+            ]
+        )
+        self.record_traffic()
+        for action in self.plan_actions():
+            self.submit_action(**action)
+        RECONCILE_SECONDS.observe(time.monotonic() - started)
+
+    def record_traffic(self) -> None:
+        self.traffic_summary = summary = self.telemetry.summary()
+        if summary is None:
+            return
+        # Load balancers spread requests over the upstreams they serve
+        self.autoscaler.record_traffic(
+            summary["requests_per_second"], summary["latency_p95_ms"], len(self.upstreams)
+        )
+        upstream_workers = {
+            entry["host"]: worker_name for worker_name, entry in self.upstream_entries.items()
+        }
+        unknown = set()
+        for address, stats in summary["upstreams"].items():
+            worker_name = upstream_workers.get(address)
+            if worker_name is None:
+                unknown.add(address)
+                continue
+            self.metric_store.record(
+                worker_name, "requests_per_worker", stats["requests_per_second"]
+            )
+            if stats["latency_p95_ms"] is not None:
+                self.metric_store.record(worker_name, "latency_p95_ms", stats["latency_p95_ms"])
+        # Told once per address, until it goes missing from the reports again
+        if unknown - self.unknown_upstreams:
+            logger.warning(
+                f"Telemetry of app {self.app_name} reports upstreams that match no "
+                f"worker: {sorted(unknown - self.unknown_upstreams)}"
+            )
+        self.unknown_upstreams = unknown
+
+    async def forward_telemetry(self, report: dict) -> None:
+        # The leader scales, it needs the reports of all load balancers
+        leader = self.cluster.members.get(self.cluster.leader) if self.cluster else None
+        if leader is None or self.session is None:
+            return
+        try:
+            async with self.session.post(
+                    f"{leader['api_url']}/apps/{self.app_name}/telemetry",
+                    json=report,
+                    headers={"X-Forwarded-By": self.cluster.replica_id},
+                    timeout=self.request_timeout,
+            ) as response:
+                response.raise_for_status()
+        except Exception as e:
+            logger.warning(f"Failed to forward telemetry to replica {leader['id']}: {e!r}")
+
+    def plan_actions(self) -> List[dict]:
+        actions = []
         min_workers = self.worker_limits["min_workers"]
-        max_workers = self.worker_limits["max_workers"]
+        # Surge workers of a rollout replace old ones once they are ready
+        max_workers = self.worker_limits["max_workers"] + self.rollout_surge
+        warm_pool_size = self.worker_limits.get("warm_pool_size", 0)
+
+        # Workers and VMs with an operation in flight are left alone, in-flight
+        # deploys already count towards the worker total
+        active_operations = self.operations.active()
+        busy_workers = {op["worker"]: op["kind"] for op in active_operations}
+        taken_hosts = {op["host"] for op in active_operations}
+        healthy_workers = sum(
+            op["kind"] == "deploy" and op["worker"] not in self.workers_data
+            for op in active_operations
+        )
+        standby_workers = sum(
+            op["kind"] == "provision" and op["worker"] not in self.workers_data
+            for op in active_operations
+        )
+        available_standby = [
+            worker_name
+            for worker_name in self.workers_data.with_status("standby")
+            if worker_name not in busy_workers and self.is_standby(worker_name)
+        ]
+        total_workers = healthy_workers + sum(
+            busy_workers.get(worker_name) not in REMOVAL_KINDS
+            and not self.is_standby(worker_name)
+            for worker_name in self.workers_data
+        )
+
+        def plan_deploy():
+            # Promote a warm standby if there is one, cold deploy otherwise
+            if available_standby:
+                worker_name = available_standby.pop(0)
+                actions.append(
+                    {
+                        "kind": "promote",
+                        "host": self.workers_data[worker_name]["host"],
+                        "worker_name": worker_name,
+                    }
+                )
+                return worker_name
+            free_vm = self.discover_free_vm(exclude=taken_hosts)
+            if free_vm:
+                taken_hosts.add(free_vm)
+                actions.append({"kind": "deploy", "host": free_vm})
+            return free_vm
+
+        for worker_name, worker_data in list(self.workers_data.items()):
+            if worker_name in busy_workers:
+                if busy_workers[worker_name] == "provision":
+                    standby_workers += 1
+                elif busy_workers[worker_name] not in REMOVAL_KINDS:
+                    healthy_workers += 1
+                continue
+
+            if self.is_standby(worker_name):
+                if worker_data.get("status") != "standby":
+                    # A broken standby is replaced by refilling the pool
+                    actions.append(
+                        {
+                            "kind": "remove",
+                            "host": worker_data["host"],
+                            "worker_name": worker_name,
+                        }
+                    )
+                continue
 
-        for worker_name, worker_data in dict(**self.workers_data).items():
             if not self.is_app_healthy(worker_name):
+                if not self.breakers.is_closed(worker_data["host"]):
+                    # Nothing can be done on an unreachable VM, a replacement
+                    # is deployed elsewhere while it does not count
+                    logger.warning(
+                        f"Worker {worker_name} host {worker_data['host']} is unreachable"
+                    )
+                    continue
                 if (
                         self.is_app_failed_worker_running(worker_name)
                         and "host" in worker_data
                 ):
-                    await self.start_app(worker_name, worker_data["host"])
-                    await asyncio.sleep(1)
+                    actions.append(
+                        {
+                            "kind": "start_app",
+                            "host": worker_data["host"],
+                            "worker_name": worker_name,
+                        }
+                    )
                 else:
                     logger.warning(
                         f"Worker {worker_name} is not healthy, restarting..."
                     )
-                    await self.restart_worker(worker_name)
-                    healthy_workers += 1
-                    continue
+                    actions.append(
+                        {
+                            "kind": "restart",
+                            "host": worker_data["host"],
+                            "worker_name": worker_name,
+                        }
+                    )
+                healthy_workers += 1
+                continue
 
             healthy_workers += 1
-            memory_usage = worker_data.get("memory_usage", 0)
-            cpu_usage = worker_data.get("cpu_usage", 0)
 
-            if (
-                    memory_usage >= self.worker_limits["memory_limit"]
-                    or cpu_usage >= self.worker_limits["cpu_limit"]
-            ):
-                logger.info(
-                    f"Worker {worker_name} reached resource limits, trying to deploy new worker"
+        # Scaling on load is decided for the whole fleet, not per worker sample
+        change = self.autoscaler.desired_change(healthy_workers)
+        if change > 0:
+            room = max_workers - total_workers - self._count(actions, "deploy", "promote")
+            planned = 0
+            for _ in range(min(change, room)):
+                if not plan_deploy():
+                    break
+                planned += 1
+            if planned:
+                self.autoscaler.record_scale_out()
+
+        healthy_workers += self._count(actions, "deploy", "promote")
+        excluded = set(busy_workers)
+
+        def plan_remove():
+            worker_to_remove = self.select_healthy_worker_to_remove(exclude=excluded)
+            if worker_to_remove:
+                excluded.add(worker_to_remove)
+                actions.append(
+                    {
+                        "kind": "scale_in",
+                        "host": self.workers_data[worker_to_remove]["host"],
+                        "worker_name": worker_to_remove,
+                    }
                 )
-                free_vm = self.discover_free_vm()
-                if free_vm:
-                    await self.deploy_worker(free_vm)
+            return worker_to_remove
 
         if healthy_workers < min_workers:
             logger.warning(
                 f"Not enough healthy workers, expected at least {min_workers}, found {healthy_workers}"
             )
             for _ in range(min_workers - healthy_workers):
-                free_vm = self.discover_free_vm()
-                if free_vm:
-                    await self.deploy_worker(free_vm)
+                if not plan_deploy():
+                    break
         elif healthy_workers > max_workers:
             logger.warning(
                 f"Too many healthy workers, expected at most {max_workers}, found {healthy_workers}"
             )
             for _ in range(healthy_workers - max_workers):
-                worker_to_remove = self.select_healthy_worker_to_remove()
-                if worker_to_remove:
-                    await self.remove_worker(worker_to_remove)
+                if not plan_remove():
+                    break
+        elif change < 0 and healthy_workers > min_workers and not self.rollout_active:
+            # Scaling in would fight the rollout over which workers stay,
+            # also when it only updates in place
+            if plan_remove():
+                self.autoscaler.record_scale_in()
         else:
             logger.info(
                 f"Healthy workers within limits, current count: {healthy_workers}"
             )
 
+        standby_workers += len(available_standby)
+        for _ in range(warm_pool_size - standby_workers):
+            free_vm = self.discover_free_vm(exclude=taken_hosts)
+            if not free_vm:
+                break
+            taken_hosts.add(free_vm)
+            actions.append({"kind": "provision", "host": free_vm})
+        return actions
+
+    @staticmethod
+    def _count(actions: List[dict], *kinds: str) -> int:
+        return sum(action["kind"] in kinds for action in actions)
+
+    def submit_action(
+            self, kind: str, host: str, worker_name: Optional[str] = None
+    ) -> dict:
+        if kind == "deploy":
+            action = lambda operation: self.deploy_worker(host, operation)
+        elif kind == "restart":
+            action = lambda operation: self.restart_worker(worker_name, operation)
+        elif kind == "start_app":
+            action = lambda operation: self.start_app(worker_name, host, operation)
+        elif kind == "provision":
+            action = lambda operation: self.provision_standby(host, operation)
+        elif kind == "promote":
+            action = lambda operation: self.promote_standby(worker_name, operation)
+        elif kind == "remove":
+            action = lambda operation: self.remove_worker(worker_name)
+        elif kind == "scale_in":
+            action = lambda operation: self.drain_and_remove_worker(worker_name, operation)
+        elif kind == "update":
+            action = lambda operation: self.update_worker(worker_name, operation)
+        else:
+            raise ValueError(f"Unknown worker action {kind}")
+        if not self.owns(host):
+            action = lambda operation: self.forward_action(kind, host, worker_name, operation)
+        return self.operations.submit(kind, host, worker_name, action)
+
+    async def forward_action(
+            self, kind: str, host: str, worker_name: Optional[str], operation: dict
+    ) -> None:
+        # Runs the action on the replica owning the VM and follows it there
+        owner = self.cluster.owner(host)
+        if owner is None:
+            raise Exception(f"No replica owns VM {host}")
+        app_url = f"{owner['api_url']}/apps/{self.app_name}"
+        async with self.session.post(
+                f"{app_url}/actions",
+                json={
+                    "kind": kind,
+                    "host": host,
+                    "worker_name": worker_name,
+                    "revision": self.app_revision,
+                },
+                timeout=self.request_timeout,
+        ) as response:
+            if response.status != 202:
+                raise Exception(
+                    f"Replica {owner['id']} refused {kind} on {host}: "
+                    f"{response.status} {await response.text()}"
+                )
+            remote_operation = await response.json()
+        delay = 0.5
+        while remote_operation["state"] in ("pending", "running"):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.readiness_max_delay)
+            async with self.session.get(
+                    f"{app_url}/operations/{remote_operation['id']}",
+                    timeout=self.request_timeout,
+            ) as response:
+                if response.status != 200:
+                    raise Exception(
+                        f"{kind} operation on replica {owner['id']} is unknown: {response.status}"
+                    )
+                remote_operation = await response.json()
+            operation["worker"] = remote_operation["worker"]
+            if remote_operation.get("step"):
+                OperationRunner.set_step(operation, f"{owner['id']}:{remote_operation['step']}")
+        if remote_operation["state"] != "succeeded":
+            raise Exception(
+                f"{kind} on replica {owner['id']} {remote_operation['state']}: "
+                f"{remote_operation['error']}"
+            )
+
+    async def sync_peers(self) -> None:
+        # Mirrors the workers of the other replicas' VMs, so every replica
+        # serves the whole fleet and the leader plans with it
+        if self.cluster is None or self.session is None:
+            return
+        peers = self.cluster.peers()
+        for replica_id in set(self.peer_versions) - {peer["id"] for peer in peers}:
+            del self.peer_versions[replica_id]
+        await asyncio.gather(*(self.sync_peer(peer) for peer in peers))
+
+    async def sync_peer(self, peer: dict) -> None:
+        replica_id = peer["id"]
+
+        def owned_by_peer(worker_data) -> bool:
+            host = worker_data.get("host")
+            return host is not None and self.cluster.ring.owner(host) == replica_id
+
+        try:
+            async with self.session.get(
+                    f"{peer['api_url']}/apps/{self.app_name}/workers",
+                    params={"since": self.peer_versions.get(replica_id, "")},
+                    timeout=self.request_timeout,
+            ) as response:
+                response.raise_for_status()
+                delta = await response.json()
+        except Exception as e:
+            logger.warning(f"Failed to sync workers from replica {replica_id}: {e!r}")
+            return
+        for worker_name, worker_data in delta["workers"].items():
+            if owned_by_peer(worker_data):
+                await self.set_worker_data(worker_name, worker_data)
+                # Restarts remove and re-add a worker under the same name
+                self.removed_workers.pop(worker_name, None)
+        removed = delta["removed"]
+        if delta["full"]:
+            removed = [
+                worker_name
+                for worker_name, worker_data in list(self.workers_data.items())
+                if owned_by_peer(worker_data) and worker_name not in delta["workers"]
+            ]
+        for worker_name in removed:
+            worker_data = self.workers_data.get(worker_name)
+            if worker_data is not None and owned_by_peer(worker_data):
+                await self.del_worker_data(worker_name)
+        self.peer_versions[replica_id] = f"{delta['epoch']}-{delta['version']}"
+
     def is_app_healthy(self, worker_name: str) -> bool:
         return self.workers_data[worker_name].get("status") == "healthy"
 
+    def is_standby(self, worker_name: str) -> bool:
+        worker_data = self.workers_data[worker_name]
+        # Workers found on startup only report their status, not the flag
+        return worker_data.get("standby", worker_data.get("status") == "standby")
+
     def is_app_failed_worker_running(self, worker_name: str) -> bool:
         return (
                 self.workers_data[worker_name].get("status") == "app_failed_worker_running"
         )
 
-    async def update_worker_data(self, worker: dict) -> None:
-        async with self.worker_operation_lock:
-            try:
-                async with self.session.get(
-                        f"http://{worker['host']}:{self.worker_port}/status"
-                ) as response:
-                    data = await response.json()
-                    if response.status == 200:
-                        await self.set_worker_data(worker["name"], data)
+    async def update_worker_data(
+            self, worker: dict, timeout: Optional[aiohttp.ClientTimeout] = None
+    ) -> bool:
+        # False when the worker was left alone instead of refreshed
+        if not self.owns(worker.get("host")):
+            # Polled by the replica owning the VM
+            return False
+        if self.is_worker_busy(worker["name"]):
+            logger.debug(
+                f"Skipping status update of worker {worker['name']}, operation in progress"
+            )
+            return False
+        if not self.breakers.allow(worker["host"]):
+            return False
+        # Only status changes are logged, a line per worker per cycle is too much
+        previous_status = worker.get("status")
+        started = time.monotonic()
+        try:
+            async with self.session.get(
+                    f"http://{worker['host']}:{self.worker_port}/status",
+                    timeout=timeout or self.request_timeout,
+            ) as response:
+                self.breakers.record_success(worker["host"])
+                data = await response.json()
+                WORKER_POLL_SECONDS.observe(time.monotonic() - started, outcome="success")
+                if self.poll_outdated(worker["name"]):
+                    return False
+                if response.status == 200:
+                    await self.set_worker_data(worker["name"], data, create=False)
+                    if data.get("status") != previous_status:
                         logger.info(
-                            f"Updated worker {worker['name']} status to {data.get('status')}"
-                        )
-                    else:
-                        await self.set_worker_value_data(
-                            worker["name"], "status", "app_failed_worker_running"
-                        )
-                        logger.warning(
-                            f"Failed to update worker {worker['name']} status: {response.status}"
+                            f"Worker {worker['name']} status changed from "
+                            f"{previous_status} to {data.get('status')}"
                         )
-            except Exception as e:
-                await self.set_worker_value_data(worker["name"], "status", "failed")
-                logger.error(f"Error updating worker {worker['name']} status: {e}")
+                else:
+                    await self.set_worker_value_data(
+                        worker["name"], "status", "app_failed_worker_running"
+                    )
+                    logger.warning(
+                        f"Failed to update worker {worker['name']} status: {response.status}"
+                    )
+        except Exception as e:
+            WORKER_POLL_SECONDS.observe(time.monotonic() - started, outcome="failure")
+            if is_unreachable_error(e):
+                self.breakers.record_failure(worker["host"])
+            if self.poll_outdated(worker["name"]):
+                return False
+            await self.set_worker_value_data(worker["name"], "status", "failed")
+            if previous_status != "failed":
+                logger.error(f"Error updating worker {worker['name']} status: {e!r}")
+            else:
+                logger.debug(f"Worker {worker['name']} still failing: {e!r}")
+        return True
 
-    def discover_free_vm(self) -> str:
-        worker_hosts = {
-            worker_data["host"] for worker_data in self.workers_data.values()
-        }
-        free_vm = next(
-            (vm for vm in self.virtual_machines if vm not in worker_hosts), None
-        )
-        logger.info(f"Discovered free VM: {free_vm}")
+    def discover_free_vm(self, exclude=()) -> str:
+        free_vm = self.scheduler.place(self, exclude)
+        logger.info(f"Discovered free VM for app {self.app_name}: {free_vm}")
         return free_vm
 
-    async def _deploy_worker_to_host(self, host: str, worker_name: str) -> None:
-        credentials = f"{self.ssh_user}@{host}"
-        async with self.worker_operation_lock:
-            commands = [
-                ("scp", "./deploy_worker.sh", f"{credentials}:./deploy_worker.sh"),
-                ("ssh", credentials, "chmod", "+x", "./deploy_worker.sh"),
-                (
-                    "ssh",
-                    credentials,
-                    "./deploy_worker.sh",
+    async def prepare_images(self, host: str) -> str:
+        if not self.image_distributor:
+            return ""
+        try:
+            worker_image_ref, self.app_image_ref = await asyncio.gather(
+                self.image_distributor.ensure_image(
                     self.worker_git_repo,
-                    worker_name,
-                    self.worker_port,
-                    self.app_image,
+                    self.worker_dockerfile,
+                    f"worker_image_{self.app_image}",
+                ),
+                self.image_distributor.ensure_image(
                     self.app_git_repo,
-                    self.app_port,
-                    self.healthcheck_api,
                     self.app_dockerfile,
-                    self.worker_dockerfile,
+                    self.app_image,
+                    self.app_revision or "HEAD",
                 ),
-            ]
+            )
+            await asyncio.gather(
+                self.image_distributor.distribute(host, worker_image_ref),
+                self.image_distributor.distribute(host, self.app_image_ref),
+            )
+            return worker_image_ref
+        except Exception as e:
+            logger.warning(
+                f"Failed to distribute prebuilt images to {host}, it will build them itself: {e}"
+            )
+            return ""
+
+    async def deploy_plan(self, host: str, worker_name: str) -> DeployPlan:
+        worker_image_ref = await self.prepare_images(host)
+        worker_image = worker_image_ref
+        if not worker_image:
+            # The agent builds from the repo head, pin it to know when it moved
+            try:
+                worker_image = await resolve_revision(self.worker_git_repo, "HEAD")
+            except CommandError as e:
+                logger.warning(f"Failed to resolve the worker repo head: {e}")
+        try:
+            with open("./deploy_worker.sh", "rb") as script:
+                script_content = script.read()
+        except FileNotFoundError:
+            # Copying it fails the deploy with the actual error
+            script_content = None
+        return DeployPlan(
+            worker_name,
+            script_content,
+            worker_image and f"{self.worker_git_repo}:{self.worker_dockerfile}:{worker_image}",
+            (
+                self.worker_git_repo,
+                worker_name,
+                self.worker_port,
+                self.app_image,
+                self.app_git_repo,
+                self.app_port,
+                self.healthcheck_api,
+                self.app_dockerfile,
+                self.worker_dockerfile,
+                self.heartbeat_url,
+                str(self.heartbeat_interval),
+                host,
+                worker_image_ref,
+            ),
+        )
+
+    async def read_deploy_manifest(self, host: str) -> dict:
+        # Without the script on the VM nothing deployed before can be reused
+        try:
+            output = await self.ssh_pool.run(
+                host,
+                "test", "-x", "./deploy_worker.sh",
+                "&&", "cat", shlex.quote(manifest_path(self.app_image)),
+                name="read_manifest",
+            )
+            return json.loads(output)
+        except (CommandError, ValueError):
+            return {}
 
-            for cmd in commands:
-                proc = await asyncio.create_subprocess_exec(
-                    *cmd, stderr=asyncio.subprocess.PIPE
+    async def write_deploy_manifest(self, host: str, plan: DeployPlan) -> None:
+        await self.ssh_pool.run(
+            host,
+            "mkdir", "-p", MANIFEST_DIR,
+            "&&", "printf", "%s", shlex.quote(json.dumps(plan.manifest())),
+            ">", shlex.quote(manifest_path(self.app_image)),
+            name="write_manifest",
+        )
+
+    async def _deploy_worker_to_host(
+            self, host: str, worker_name: str, plan: Optional[DeployPlan] = None
+    ) -> None:
+        self.removed_workers.pop(worker_name, None)
+        async with self.get_worker_lock(worker_name):
+            plan = plan or await self.deploy_plan(host, worker_name)
+            steps = plan.changed_steps(await self.read_deploy_manifest(host))
+            if not steps:
+                status = await self.fetch_worker_status(host)
+                if status and status.get("worker_name") == worker_name:
+                    logger.info(f"Worker {worker_name} on host {host} is up to date")
+                    return
+                steps = ["container"]
+            try:
+                if "script" in steps:
+                    await self.ssh_pool.copy(host, "./deploy_worker.sh", "./deploy_worker.sh")
+                    await self.ssh_pool.run(host, "chmod", "+x", "./deploy_worker.sh")
+                await self.ssh_pool.run(
+                    host,
+                    "./deploy_worker.sh",
+                    # ssh joins arguments into one remote command line, quote
+                    # them so empty values keep their position
+                    *map(
+                        shlex.quote,
+                        plan.deploy_args + (str("worker_image" in steps).lower(),),
+                    ),
                 )
-                stdout, stderr = await proc.communicate()
+                await self.write_deploy_manifest(host, plan)
+            except CommandError as e:
+                logger.error(str(e))
+                raise
 
-                if proc.returncode != 0:
-                    error_message = stderr.decode() if stderr else "Unknown error"
-                    logger.error(
-                        f"Error executing command {' '.join(cmd)}: {error_message}"
-                    )
-                    raise Exception(
-                        f"Error executing command {' '.join(cmd)}: {error_message}"
-                    )
+            logger.info(
+                f"Worker {worker_name} deployed to host {host}, ran {', '.join(steps)}"
+            )
+
+    async def fetch_worker_status(self, host: str) -> Optional[dict]:
+        try:
+            async with self.session.get(
+                    f"http://{host}:{self.worker_port}/status",
+                    timeout=self.request_timeout,
+            ) as response:
+                if response.status == 200:
+                    return await response.json()
+        except Exception:
+            pass
+        return None
 
-            logger.info(f"Worker {worker_name} deployed to host {host}")
+    async def wait_for_worker(
+            self, host: str, expected_status: Optional[str] = None
+    ) -> None:
+        # Poll with exponential backoff instead of sleeping a fixed time
+        delay = 0.5
+        deadline = time.monotonic() + self.readiness_timeout
+        while True:
+            status = await self.fetch_worker_status(host)
+            if status is not None and (
+                    expected_status is None or status.get("status") == expected_status
+            ):
+                return
+            if time.monotonic() + delay > deadline:
+                raise TimeoutError(
+                    f"Timed out waiting for worker on {host} to become {expected_status or 'ready'}"
+                )
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.readiness_max_delay)
 
-    async def deploy_worker(self, host: str) -> None:
+    async def deploy_worker(self, host: str, operation: Optional[dict] = None) -> None:
         new_worker_name = f"worker-{str(uuid.uuid4())}"
-        await self._deploy_worker_to_host(host, new_worker_name)
-        await asyncio.sleep(20)
-        try:
-            await self.start_app(new_worker_name, host)
-            await asyncio.sleep(1)
-        except Exception as e:
-            logger.error(
-                f"Failed started app on host {host} and worker_name {new_worker_name}"
-            )
+        if operation is not None:
+            operation["worker"] = new_worker_name
+        await self._bring_up_worker(host, new_worker_name, operation)
 
-    async def start_app(self, worker_name, host):
-        async with self.worker_operation_lock:
+    async def _bring_up_worker(
+            self,
+            host: str,
+            worker_name: str,
+            operation: Optional[dict],
+            plan: Optional[DeployPlan] = None,
+    ) -> None:
+        OperationRunner.set_step(operation, "deploying_worker")
+        await self._deploy_worker_to_host(host, worker_name, plan)
+        OperationRunner.set_step(operation, "waiting_worker_ready")
+        await self.wait_for_worker(host)
+        OperationRunner.set_step(operation, "starting_app")
+        await self.start_app(worker_name, host, operation)
+        OperationRunner.set_step(operation, "waiting_app_healthy")
+        await self.wait_for_worker(host, "healthy")
+        await self.update_worker_data(self.workers_data[worker_name])
+
+    async def provision_standby(self, host: str, operation: Optional[dict] = None) -> None:
+        worker_name = f"worker-{str(uuid.uuid4())}"
+        if operation is not None:
+            operation["worker"] = worker_name
+        OperationRunner.set_step(operation, "deploying_worker")
+        await self._deploy_worker_to_host(host, worker_name)
+        OperationRunner.set_step(operation, "waiting_worker_ready")
+        await self.wait_for_worker(host)
+        OperationRunner.set_step(operation, "preparing_app")
+        async with self.get_worker_lock(worker_name):
             async with self.session.post(
-                    f"http://{host}:{self.worker_port}/start_app"
+                    f"http://{host}:{self.worker_port}/prepare_app",
+                    json=self.app_request_body(),
             ) as response:
-                if response.status == 200:
-                    logger.info(
-                        f"Successfully started app on host {host} and worker_name {worker_name}"
+                if response.status not in (200, 202):
+                    raise Exception(
+                        f"Failed preparing app on host {host} and worker_name {worker_name}: {response.status}"
                     )
-                    await self.set_worker_data(
-                        worker_name, {"name": worker_name, "host": host}
+                accepted = await response.json() if response.status == 202 else None
+            if accepted:
+                await self.wait_for_agent_operation(host, accepted["operation_id"], operation)
+        OperationRunner.set_step(operation, "waiting_standby")
+        await self.wait_for_worker(host, "standby")
+        await self.set_worker_data(
+            worker_name,
+            {"name": worker_name, "host": host, "standby": True, "status": "standby"},
+        )
+        logger.info(f"Standby worker {worker_name} provisioned on {host}")
+
+    async def promote_standby(
+            self, worker_name: str, operation: Optional[dict] = None
+    ) -> None:
+        host = self.workers_data[worker_name]["host"]
+        OperationRunner.set_step(operation, "starting_app")
+        await self.start_app(worker_name, host, operation)
+        OperationRunner.set_step(operation, "waiting_app_healthy")
+        await self.wait_for_worker(host, "healthy")
+        await self.update_worker_data(self.workers_data[worker_name])
+        logger.info(f"Standby worker {worker_name} promoted on {host}")
+
+    async def wait_for_agent_operation(
+            self, host: str, operation_id: str, operation: Optional[dict] = None
+    ) -> dict:
+        # Builds run in the background on the agent, follow them with backoff
+        delay = 0.5
+        deadline = time.monotonic() + self.agent_operation_timeout
+        while True:
+            async with self.session.get(
+                    f"http://{host}:{self.worker_port}/operations/{operation_id}",
+                    timeout=self.request_timeout,
+            ) as response:
+                if response.status != 200:
+                    raise Exception(
+                        f"Agent operation {operation_id} on host {host} is unknown: {response.status}"
                     )
-                    logger.info(f"New worker {worker_name} deployed on {host}")
-                else:
+                agent_operation = await response.json()
+            if agent_operation.get("step"):
+                OperationRunner.set_step(operation, f"agent:{agent_operation['step']}")
+            if agent_operation["state"] == "succeeded":
+                return agent_operation
+            if agent_operation["state"] == "failed":
+                raise Exception(
+                    f"Agent {agent_operation['kind']} on host {host} failed: {agent_operation['error']}"
+                )
+            if time.monotonic() + delay > deadline:
+                raise TimeoutError(
+                    f"Timed out waiting for agent operation {operation_id} on host {host}"
+                )
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.readiness_max_delay)
+
+    async def start_app(self, worker_name, host, operation: Optional[dict] = None):
+        async with self.get_worker_lock(worker_name):
+            async with self.session.post(
+                    f"http://{host}:{self.worker_port}/start_app",
+                    json=self.app_request_body(),
+            ) as response:
+                if response.status not in (200, 202):
                     logger.error(
                         f"Failed started app on host {host} and worker_name {worker_name}"
                     )
+                    raise Exception(
+                        f"Failed started app on host {host} and worker_name {worker_name}: {response.status}"
+                    )
+                # Older agents answer 200 once the app is up
+                accepted = await response.json() if response.status == 202 else None
+            if accepted:
+                await self.wait_for_agent_operation(host, accepted["operation_id"], operation)
+            logger.info(
+                f"Successfully started app on host {host} and worker_name {worker_name}"
+            )
+            await self.set_worker_data(
+                worker_name,
+                {
+                    "name": worker_name,
+                    "host": host,
+                    "standby": False,
+                    "draining": False,
+                    "started_at": time.time(),
+                },
+            )
+            logger.info(f"New worker {worker_name} deployed on {host}")
 
-    async def restart_worker(self, worker_name: str) -> None:
+    async def restart_worker(
+            self, worker_name: str, operation: Optional[dict] = None
+    ) -> None:
         worker_host = self.workers_data[worker_name]["host"]
-        await self.remove_worker(worker_name)
+        OperationRunner.set_step(operation, "planning")
+        plan = await self.deploy_plan(worker_host, worker_name)
         try:
-            await self._deploy_worker_to_host(worker_host, worker_name)
+            if not plan.changed_steps(await self.read_deploy_manifest(worker_host)):
+                status = await self.fetch_worker_status(worker_host)
+                if status and status.get("worker_name") == worker_name:
+                    # Only the app went down, the agent keeps running
+                    OperationRunner.set_step(operation, "restarting_app")
+                    await self.restart_app(worker_name, worker_host, operation)
+                    logger.info(f"App of worker {worker_name} restarted on {worker_host}")
+                    return
+            OperationRunner.set_step(operation, "removing_worker")
+            await self.remove_worker(worker_name)
+            await self._bring_up_worker(worker_host, worker_name, operation, plan)
             logger.info(f"Worker {worker_name} restarted on {worker_host}")
-            await asyncio.sleep(5)
-            await self.update_worker_data(self.workers_data[worker_name])
-            await asyncio.sleep(5)
         except Exception as e:
             logger.error(
                 f"Error restarting worker {worker_name} on {worker_host}: {str(e)}"
             )
             raise
 
-    async def initialize_workers_data(self) -> None:
+    async def restart_app(
+            self, worker_name: str, host: str, operation: Optional[dict] = None
+    ) -> None:
+        async with self.get_worker_lock(worker_name):
+            async with self.session.post(
+                    f"http://{host}:{self.worker_port}/stop_app"
+            ) as response:
+                if response.status != 200:
+                    raise Exception(
+                        f"Error stopping the application on worker {worker_name} at {host}: {await response.text()}"
+                    )
+        await self.start_app(worker_name, host, operation)
+        OperationRunner.set_step(operation, "waiting_app_healthy")
+        await self.wait_for_worker(host, "healthy")
+        await self.update_worker_data(self.workers_data[worker_name])
+
+    async def initialize_workers_data(
+            self, timeout: Optional[aiohttp.ClientTimeout] = None, vms: Optional[List[str]] = None
+    ) -> None:
         async with self.worker_operation_lock:
             logger.info("Initializing worker data")
-            for vm in self.virtual_machines:
-                worker_status_url = f"http://{vm}:{self.worker_port}/status"
+            await asyncio.gather(
+                *(
+                    self._initialize_vm_worker(vm, timeout)
+                    for vm in vms or self.virtual_machines
+                    if self.owns(vm)
+                )
+            )
 
-                try:
-                    async with self.session.get(worker_status_url) as response:
-                        worker_status = await response.json()
-                        worker_name = worker_status.get("worker_name")
-                        status = worker_status.get("status")
-                        memory_usage = worker_status.get("memory_usage")
-                        cpu_usage = worker_status.get("cpu_usage")
-
-                        if worker_name and worker_status:
-                            await self.set_worker_data(
-                                worker_name,
-                                {
-                                    "name": worker_name,
-                                    "host": vm,
-                                    "status": status,
-                                    "memory_usage": memory_usage,
-                                    "cpu_usage": cpu_usage,
-                                },
-                            )
-                            logger.info(
-                                f"Worker {worker_name} initialized with status {status} on {vm}"
-                            )
-                except Exception as e:
-                    logger.warning(f"Failed to initialize worker data for VM {vm}: {e}")
-                    continue
+    async def _initialize_vm_worker(
+            self, vm: str, timeout: Optional[aiohttp.ClientTimeout]
+    ) -> None:
+        worker_status_url = f"http://{vm}:{self.worker_port}/status"
 
-    def select_healthy_worker_to_remove(self) -> str:
-        healthy_worker = next(
-            (
-                worker_name
-                for worker_name, worker_data in self.workers_data.items()
-                if worker_data["status"] == "healthy"
-            ),
-            None,
+        try:
+            async with self.session.get(
+                    worker_status_url, timeout=timeout or self.request_timeout
+            ) as response:
+                self.breakers.record_success(vm)
+                worker_status = await response.json()
+                worker_name = worker_status.get("worker_name")
+                status = worker_status.get("status")
+                memory_usage = worker_status.get("memory_usage")
+                cpu_usage = worker_status.get("cpu_usage")
+
+                if worker_name and worker_status:
+                    # A restored record of a worker that is gone from this VM
+                    for stale_worker in self.workers_data.on_host(vm) - {worker_name}:
+                        await self.del_worker_data(stale_worker)
+                    await self.set_worker_data(
+                        worker_name,
+                        {
+                            "name": worker_name,
+                            "host": vm,
+                            "status": status,
+                            "memory_usage": memory_usage,
+                            "cpu_usage": cpu_usage,
+                        },
+                    )
+                    logger.info(
+                        f"Worker {worker_name} initialized with status {status} on {vm}"
+                    )
+        except Exception as e:
+            if is_unreachable_error(e):
+                self.breakers.record_failure(vm)
+            logger.warning(f"Failed to initialize worker data for VM {vm}: {e!r}")
+
+    def update_metric_gauges(self) -> None:
+        known = 0
+        for status, worker_names in self.workers_data.by_status.items():
+            WORKERS.set(len(worker_names), app=self.app_name, status=status)
+            known += len(worker_names)
+        if len(self.workers_data) > known:
+            WORKERS.set(len(self.workers_data) - known, app=self.app_name, status="unknown")
+        ACTIVE_OPERATIONS.set(len(self.operations.active()), app=self.app_name)
+        if self.traffic_summary is not None:
+            TRAFFIC_REQUESTS.set(self.traffic_summary["requests_per_second"], app=self.app_name)
+            if self.traffic_summary["latency_p95_ms"] is not None:
+                TRAFFIC_LATENCY_P95.set(
+                    self.traffic_summary["latency_p95_ms"] / 1000, app=self.app_name
+                )
+        OPEN_CIRCUITS.set(
+            sum(not self.breakers.is_closed(host) for host in self.breakers.breakers),
+            app=self.app_name,
+        )
+
+    def get_healthy_hosts(self) -> List[str]:
+        return [upstream["host"] for upstream in self.upstreams]
+
+    def upstream_weight(self, worker_name: str) -> int:
+        # Few coarse levels, so load noise does not turn into nginx reloads
+        headroom = 1 - self.worker_load(worker_name) / self.worker_limits["cpu_limit"]
+        return max(1, round(self.upstream_max_weight * min(max(headroom, 0), 1)))
+
+    def upstream_entry(self, worker_name: str, worker_data: WorkerRecord) -> Optional[dict]:
+        if worker_data.get("status") != "healthy" or worker_data.get("draining"):
+            return None
+        return {
+            "host": f"{worker_data['host']}:{self.app_port}",
+            "weight": self.upstream_weight(worker_name),
+        }
+
+    def update_upstream(self, worker_name: str, worker_data: Optional[WorkerRecord]) -> None:
+        # Called for every change of one worker, only that worker's entry is redone
+        entry = self.upstream_entry(worker_name, worker_data) if worker_data else None
+        if self.upstream_entries.get(worker_name) == entry:
+            return
+        if entry is None:
+            del self.upstream_entries[worker_name]
+        else:
+            self.upstream_entries[worker_name] = entry
+        self.publish_upstreams()
+
+    def refresh_upstreams(self) -> None:
+        self.upstream_entries = {}
+        for worker_name, worker_data in self.workers_data.items():
+            entry = self.upstream_entry(worker_name, worker_data)
+            if entry is not None:
+                self.upstream_entries[worker_name] = entry
+        self.publish_upstreams()
+
+    def publish_upstreams(self) -> None:
+        upstreams = sorted(
+            self.upstream_entries.values(), key=lambda upstream: upstream["host"]
+        )
+        if upstreams == self.upstreams:
+            return
+        self.upstreams = upstreams
+        self.upstreams_version += 1
+        # Wake up the long-polling load balancers
+        self.upstreams_changed.set()
+        self.upstreams_changed = asyncio.Event()
+        logger.info(
+            f"Upstreams changed to version {self.upstreams_version}: "
+            f"{', '.join(upstream['host'] for upstream in upstreams) or 'none'}"
+        )
+
+    def version_etag(self, version: int) -> str:
+        return f'"{self.epoch}-{version}"'
+
+    @property
+    def upstreams_etag(self) -> str:
+        return self.version_etag(self.upstreams_version)
+
+    @property
+    def workers_etag(self) -> str:
+        return self.version_etag(self.workers_data.version)
+
+    def parse_version(self, token: Optional[str]) -> Optional[int]:
+        # An ETag or "<epoch>-<version>", a bare version is taken as this epoch's
+        epoch, _, version = (token or "").strip('"').rpartition("-")
+        if (epoch and epoch != self.epoch) or not version.isdigit():
+            return None
+        return int(version)
+
+    def ack_upstreams(self, load_balancer: str, version: int) -> None:
+        self.load_balancer_acks[load_balancer] = (version, time.monotonic())
+
+    def load_balancers_synced(self, version: int) -> bool:
+        now = time.monotonic()
+        return all(
+            acked_version >= version
+            for acked_version, seen_at in self.load_balancer_acks.values()
+            if now - seen_at < self.load_balancer_ttl
         )
+
+    def worker_load(self, worker_name: str) -> float:
+        return self.workers_data.loads.get(worker_name, 0)
+
+    def select_healthy_worker_to_remove(self, exclude=()) -> str:
+        def removable(worker_name):
+            worker_data = self.workers_data[worker_name]
+            return (
+                worker_data.get("status") == "healthy"
+                and not worker_data.get("draining")
+                and worker_name not in exclude
+            )
+
+        if self.worker_limits.get("scale_in_policy") == "newest":
+            healthy_worker = max(
+                filter(removable, self.workers_data.with_status("healthy")),
+                key=lambda worker_name: self.workers_data[worker_name].get("started_at", 0),
+                default=None,
+            )
+        else:
+            # Least loaded first, the load index is kept sorted
+            healthy_worker = next(filter(removable, self.workers_data.by_load()), None)
         if healthy_worker:
             logger.info(f"Selected healthy worker {healthy_worker} to remove")
         else:
             logger.warning("No healthy worker found to remove")
         return healthy_worker
 
+    async def fetch_active_connections(self, host: str) -> Optional[int]:
+        try:
+            async with self.session.get(
+                    f"http://{host}:{self.worker_port}/connections",
+                    timeout=self.request_timeout,
+            ) as response:
+                if response.status == 200:
+                    return (await response.json()).get("active_connections")
+        except Exception as e:
+            logger.warning(f"Failed to fetch active connections from {host}: {e!r}")
+        return None
+
+    async def drain_and_remove_worker(
+            self, worker_name: str, operation: Optional[dict] = None
+    ) -> None:
+        await self.drain_worker(worker_name, operation)
+        OperationRunner.set_step(operation, "removing_worker")
+        await self.remove_worker(worker_name)
+
+    async def update_worker(
+            self, worker_name: str, operation: Optional[dict] = None
+    ) -> None:
+        # Restarts the app of a worker with the current revision, out of the
+        # upstreams until it is healthy again
+        host = self.workers_data[worker_name]["host"]
+        await self.drain_worker(worker_name, operation)
+        await self.set_worker_value_data(worker_name, "status", "updating")
+        try:
+            OperationRunner.set_step(operation, "starting_app")
+            await self.start_app(worker_name, host, operation)
+            OperationRunner.set_step(operation, "waiting_app_healthy")
+            await self.wait_for_worker(host, "healthy")
+        finally:
+            await self.set_worker_value_data(worker_name, "draining", False)
+        await self.update_worker_data(self.workers_data[worker_name])
+        logger.info(f"Worker {worker_name} on {host} updated to revision {self.app_revision}")
+
+    async def drain_worker(
+            self, worker_name: str, operation: Optional[dict] = None
+    ) -> None:
+        host = self.workers_data[worker_name]["host"]
+        await self.set_worker_value_data(worker_name, "draining", True)
+        drain_version = self.upstreams_version
+        logger.info(f"Draining worker {worker_name} on {host}")
+
+        try:
+            # Load balancers ack a version by polling with its ETag once applied
+            OperationRunner.set_step(operation, "waiting_load_balancer")
+            deadline = time.monotonic() + self.lb_sync_timeout
+            while not self.load_balancers_synced(drain_version):
+                if time.monotonic() >= deadline:
+                    logger.warning(
+                        f"Load balancers did not apply upstreams version {drain_version} "
+                        f"within {self.lb_sync_timeout} sec"
+                    )
+                    break
+                await asyncio.sleep(0.5)
+
+            OperationRunner.set_step(operation, "draining_connections")
+            delay = 0.5
+            started = time.monotonic()
+            deadline = started + self.drain_timeout
+            while True:
+                active_connections = await self.fetch_active_connections(host)
+                if active_connections == 0:
+                    break
+                if active_connections is None:
+                    if time.monotonic() - started >= self.drain_grace_period:
+                        logger.warning(
+                            f"Connections of worker {worker_name} can not be counted, going on "
+                            f"after a grace period of {self.drain_grace_period} sec"
+                        )
+                        break
+                elif time.monotonic() + delay > deadline:
+                    logger.warning(
+                        f"Worker {worker_name} still has {active_connections} connections "
+                        f"after {self.drain_timeout} sec, going on anyway"
+                    )
+                    break
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.readiness_max_delay)
+        except Exception:
+            await self.set_worker_value_data(worker_name, "draining", False)
+            raise
+
     async def remove_worker(self, worker_name: str) -> None:
-        async with self.worker_operation_lock:
+        async with self.get_worker_lock(worker_name):
             worker_data = self.workers_data.get(worker_name)
             if worker_data:
                 host = worker_data["host"]
                 stop_app_url = f"http://{host}:{self.worker_port}/stop_app"
 
                 # Send API request to stop the application
-                async with self.session as session:
-                    try:
-                        async with session.post(stop_app_url) as response:
-                            if response.status != 200:
-                                raise Exception(
-                                    f"Error stopping the application on worker {worker_name} at {host}: {await response.text()}"
-                                )
-
-                        logger.info(
-                            f"Application stopped on worker {worker_name} at {host}"
-                        )
-                    except Exception as e:
-                        logger.error(
-                            f"Error stopping the application on worker {worker_name} at {host}: {str(e)}"
-                        )
-
-                # Stop and delete the worker container
-                credentials = f"{self.ssh_user}@{host}"
-                remove_process = await asyncio.create_subprocess_exec(
-                    "ssh",
-                    credentials,
-                    "docker",
-                    "rm",
-                    "-f",
-                    worker_name,
-                    stderr=asyncio.subprocess.PIPE,
-                )
-                stdout, stderr = await remove_process.communicate()
+                try:
+                    async with self.session.post(stop_app_url) as response:
+                        if response.status != 200:
+                            raise Exception(
+                                f"Error stopping the application on worker {worker_name} at {host}: {await response.text()}"
+                            )
 
-                if remove_process.returncode != 0:
-                    error_message = stderr.decode() if stderr else "Unknown error"
+                    logger.info(
+                        f"Application stopped on worker {worker_name} at {host}"
+                    )
+                except Exception as e:
                     logger.error(
-                        f"Error removing worker {worker_name} from {host}: {error_message}"
+                        f"Error stopping the application on worker {worker_name} at {host}: {str(e)}"
                     )
+
+                # Stop and delete the worker container
+                try:
+                    await self.ssh_pool.run(host, "docker", "rm", "-f", worker_name)
+                except CommandError as e:
+                    logger.error(f"Error removing worker {worker_name} from {host}: {e}")
                     raise Exception(
-                        f"Error removing worker {worker_name} from {host}: {error_message}"
+                        f"Error removing worker {worker_name} from {host}: {e}"
                     )
 
                 logger.info(f"Worker {worker_name} removed from {host}")
@@ -0,0 +1,322 @@
+import asyncio
+import logging
+import math
+import re
+import statistics
+import time
+import uuid
+from typing import List, Optional, Union
+
+from master.operations import ACTIVE_STATES
+from master.ssh_pool import CommandError, run_command
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+COMMIT_RE = re.compile(r"^[0-9a-f]{40}$")
+
+
+class RolloutFailed(Exception):
+    pass
+
+
+def resolve_count(value: Union[int, str], total: int, round_up: bool) -> int:
+    # A worker count or a percentage of the fleet, like "25%"
+    if isinstance(value, str) and value.endswith("%"):
+        share = total * float(value[:-1]) / 100
+        return math.ceil(share) if round_up else math.floor(share)
+    return int(value)
+
+
+async def resolve_revision(git_repo: str, ref: str) -> str:
+    if COMMIT_RE.match(ref):
+        return ref
+    output = await run_command("git", "ls-remote", git_repo, ref)
+    if not output:
+        raise CommandError(f"Ref {ref} not found in {git_repo}")
+    return output.split()[0]
+
+
+# Moves the fleet of one app to another revision in waves. A wave brings up to
+# max_surge new workers on free VMs and updates up to max_unavailable workers
+# in place. Its workers must stay healthy for ready_seconds and answer the
+# health check about as fast as the old version did, or the fleet is rolled
+# back to the previous revision the same way.
+class Rollout:
+    def __init__(
+        self,
+        manager,
+        revision: str,
+        max_surge: Union[int, str] = 1,
+        max_unavailable: Union[int, str] = 0,
+        ready_seconds: float = 10,
+        max_latency_ratio: float = 1.5,
+        latency_tolerance_ms: float = 20,
+        latency_probes: int = 5,
+        rollback: bool = True,
+    ):
+        self.manager = manager
+        self.id = str(uuid.uuid4())
+        self.ref = revision
+        self.revision: Optional[str] = None
+        self.previous_revision: Optional[str] = None
+        self.max_surge = max_surge
+        self.max_unavailable = max_unavailable
+        self.ready_seconds = ready_seconds
+        self.max_latency_ratio = max_latency_ratio
+        self.latency_tolerance = latency_tolerance_ms / 1000
+        self.latency_probes = latency_probes
+        self.rollback = rollback
+        if max_surge in (0, "0%") and max_unavailable in (0, "0%"):
+            raise ValueError("max_surge and max_unavailable can not both be 0")
+        # pending, running, rolling_back, succeeded, rolled_back, failed or aborted
+        self.state = "pending"
+        self.error: Optional[str] = None
+        self.waves: List[dict] = []
+        self.baseline_latency: Optional[float] = None
+        self.surge = 0
+        # Workers brought to the revision being rolled, also those whose agent
+        # does not report revisions and so never look up to date
+        self.rolled = set()
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def active(self) -> bool:
+        return self.state in ("pending", "running", "rolling_back")
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.run())
+
+    def abort(self) -> None:
+        if self.task is not None and self.active:
+            self.task.cancel()
+
+    async def run(self) -> None:
+        manager = self.manager
+        try:
+            self.revision = await resolve_revision(manager.app_git_repo, self.ref)
+            # What the workers run, the configured revision may be a branch
+            self.previous_revision = self.fleet_revision() or manager.app_revision
+            self.state = "running"
+            logger.info(
+                f"Rolling out {manager.app_name} revision {self.revision} "
+                f"from {self.previous_revision or 'unknown'}"
+            )
+            self.baseline_latency = await self.measure_latency(
+                self.outdated_workers(self.revision)[: self.latency_probes]
+            )
+            manager.set_app_revision(self.revision)
+            try:
+                await self.roll(self.revision, gate=True)
+            except RolloutFailed as e:
+                self.error = str(e)
+                if not self.rollback or not self.previous_revision:
+                    raise
+                logger.warning(f"Rollout of {self.revision} failed, rolling back: {e}")
+                self.state = "rolling_back"
+                manager.set_app_revision(self.previous_revision)
+                await self.roll(self.previous_revision, gate=False)
+                self.state = "rolled_back"
+            else:
+                self.state = "succeeded"
+        except asyncio.CancelledError:
+            self.state = "aborted"
+        except Exception as e:
+            self.state = "failed"
+            self.error = self.error or str(e)
+            logger.error(f"Rollout {self.id} of {manager.app_name} failed: {e}")
+        finally:
+            self.surge = 0
+            self.finished_at = time.time()
+            logger.info(f"Rollout {self.id} of {manager.app_name} {self.state}")
+
+    def fleet_revision(self) -> Optional[str]:
+        revisions = [
+            worker_data.get("app_revision")
+            for worker_data in self.manager.workers_data.values()
+            if worker_data.get("app_revision")
+        ]
+        return statistics.mode(revisions) if revisions else None
+
+    def outdated_workers(self, revision: str) -> List[str]:
+        manager = self.manager
+        busy = {operation["worker"] for operation in manager.operations.active()}
+        return sorted(
+            worker_name
+            for worker_name in manager.workers_data.with_status("healthy")
+            if worker_name not in busy
+            and not manager.is_standby(worker_name)
+            and not manager.workers_data[worker_name].get("draining")
+            and worker_name not in self.rolled
+            and manager.workers_data[worker_name].get("app_revision") != revision
+        )
+
+    async def roll(self, revision: str, gate: bool) -> None:
+        manager = self.manager
+        self.rolled = set()
+        while True:
+            outdated = self.outdated_workers(revision)
+            if not outdated:
+                return
+            fleet = manager.workers_data.count("healthy")
+            max_surge = resolve_count(self.max_surge, fleet, round_up=True)
+            max_unavailable = resolve_count(self.max_unavailable, fleet, round_up=False)
+            if max_surge + max_unavailable <= 0:
+                raise ValueError("max_surge and max_unavailable can not both be 0")
+
+            # Surge workers go to free VMs, the reconcile loop may go over
+            # max_workers by as many while the wave runs
+            self.surge = max_surge
+            taken_hosts = {operation["host"] for operation in manager.operations.active()}
+            surge_vms = []
+            for _ in range(min(max_surge, len(outdated))):
+                vm = manager.discover_free_vm(exclude=taken_hosts)
+                if not vm:
+                    break
+                taken_hosts.add(vm)
+                surge_vms.append(vm)
+            replaced = outdated[: len(surge_vms)]
+            updated = outdated[len(surge_vms): len(surge_vms) + max_unavailable]
+            if not surge_vms and not updated:
+                raise RolloutFailed("No free VM for a surge worker and max_unavailable is 0")
+
+            wave = {
+                "revision": revision,
+                "surge": surge_vms,
+                "updated": updated,
+                "replaced": replaced,
+                "started_at": time.time(),
+                "latency": None,
+            }
+            self.waves.append(wave)
+            logger.info(
+                f"Rollout wave {len(self.waves)} of {manager.app_name}: "
+                f"{len(surge_vms)} new, {len(updated)} in place, {len(outdated)} outdated"
+            )
+            operations = [manager.submit_action("deploy", vm) for vm in surge_vms] + [
+                manager.submit_action("update", manager.workers_data[name]["host"], name)
+                for name in updated
+            ]
+            await self.wait_for(operations)
+            new_workers = [operation["worker"] for operation in operations]
+            failed = [operation for operation in operations if operation["state"] != "succeeded"]
+            if failed:
+                raise RolloutFailed(
+                    f"{failed[0]['kind']} on {failed[0]['host']} failed: {failed[0]['error']}"
+                )
+            await self.wait_ready(new_workers)
+            self.check_revisions(new_workers, revision)
+            self.rolled.update(new_workers)
+            wave["latency"] = await self.measure_latency(new_workers)
+            if gate:
+                self.check_latency(wave["latency"])
+
+            # The new workers took over, the old ones they replace are drained.
+            # One that stays would be replaced again by every following wave.
+            removals = [
+                manager.submit_action("scale_in", manager.workers_data[name]["host"], name)
+                for name in replaced
+                if name in manager.workers_data
+            ]
+            await self.wait_for(removals)
+            failed = [operation for operation in removals if operation["state"] != "succeeded"]
+            if failed:
+                raise RolloutFailed(
+                    f"Removing replaced worker {failed[0]['worker']} failed: {failed[0]['error']}"
+                )
+            wave["finished_at"] = time.time()
+
+    @staticmethod
+    async def wait_for(operations: List[dict]) -> None:
+        while any(operation["state"] in ACTIVE_STATES for operation in operations):
+            await asyncio.sleep(1)
+
+    async def wait_ready(self, worker_names: List[str]) -> None:
+        # Readiness gate: all healthy without a break for ready_seconds. Workers
+        # deployed by another replica show up with its next sync.
+        deadline = time.monotonic() + self.manager.readiness_timeout
+        healthy_since = None
+        while True:
+            now = time.monotonic()
+            statuses = {}
+            for worker_name in worker_names:
+                worker_data = self.manager.workers_data.get(worker_name)
+                statuses[worker_name] = worker_data.get("status") if worker_data else None
+            for worker_name, status in statuses.items():
+                if status not in (None, "healthy"):
+                    raise RolloutFailed(f"Worker {worker_name} became {status}")
+            if None in statuses.values():
+                if now >= deadline:
+                    raise RolloutFailed("New workers were not reported in time")
+            else:
+                healthy_since = healthy_since or now
+                if now - healthy_since >= self.ready_seconds:
+                    return
+            await asyncio.sleep(1)
+
+    def check_revisions(self, worker_names: List[str], revision: str) -> None:
+        for worker_name in worker_names:
+            worker_data = self.manager.workers_data.get(worker_name)
+            reported = worker_data.get("app_revision") if worker_data else None
+            if reported is None:
+                logger.warning(
+                    f"Worker {worker_name} does not report its revision, taking it as rolled"
+                )
+            elif reported != revision:
+                raise RolloutFailed(f"Worker {worker_name} runs {reported}, not {revision}")
+
+    def check_latency(self, latency: Optional[float]) -> None:
+        if latency is None or self.baseline_latency is None:
+            return
+        limit = max(
+            self.baseline_latency * self.max_latency_ratio,
+            self.baseline_latency + self.latency_tolerance,
+        )
+        if latency > limit:
+            raise RolloutFailed(
+                f"Health check latency {latency * 1000:.1f} ms is over "
+                f"{limit * 1000:.1f} ms, it was {self.baseline_latency * 1000:.1f} ms"
+            )
+
+    async def measure_latency(self, worker_names: List[str]) -> Optional[float]:
+        # Median health check round trip over the workers, None without samples
+        manager = self.manager
+        if not manager.healthcheck_api or manager.session is None:
+            return None
+        samples = []
+        for worker_name in worker_names:
+            worker_data = manager.workers_data.get(worker_name)
+            if worker_data is None:
+                continue
+            url = f"http://{worker_data['host']}:{manager.app_port}{manager.healthcheck_api}"
+            for _ in range(self.latency_probes):
+                started = time.monotonic()
+                try:
+                    async with manager.session.get(
+                        url, timeout=manager.request_timeout
+                    ) as response:
+                        await response.read()
+                        if response.status == 200:
+                            samples.append(time.monotonic() - started)
+                except Exception as e:
+                    logger.debug(f"Latency probe of {worker_name} failed: {e!r}")
+        return statistics.median(samples) if samples else None
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "ref": self.ref,
+            "revision": self.revision,
+            "previous_revision": self.previous_revision,
+            "state": self.state,
+            "error": self.error,
+            "max_surge": self.max_surge,
+            "max_unavailable": self.max_unavailable,
+            "ready_seconds": self.ready_seconds,
+            "baseline_latency": self.baseline_latency,
+            "waves": self.waves,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
@@ -0,0 +1,139 @@
+import logging
+from typing import Dict, Iterable, List, Optional
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+RESOURCES = ("cpus", "memory_mb")
+
+
+def empty_usage() -> dict:
+    return {"cpus": 0.0, "memory_mb": 0.0, "exclusive": False, "apps": []}
+
+
+# Places the workers of every application on the shared VMs, best fit first,
+# so containers are packed onto VMs that already run something and empty VMs
+# stay free for bigger apps. An app's agent and app ports are fixed, so one
+# VM runs at most one worker of each app.
+class BinPackingScheduler:
+    def __init__(
+        self,
+        headroom: float = 0.1,
+        vm_capacity: Optional[Dict[str, dict]] = None,
+        default_capacity: Optional[dict] = None,
+    ):
+        # Fraction of every VM kept free for the agents, the OS and load spikes
+        self.headroom = headroom
+        self.configured_capacity = vm_capacity or {}
+        self.default_capacity = default_capacity
+        # host -> capacity reported by the worker agents running on it
+        self.reported_capacity: Dict[str, dict] = {}
+        self.managers: List = []
+
+    def register(self, manager) -> None:
+        for other in self.managers:
+            if other.app_name == manager.app_name:
+                raise ValueError(f"Application {manager.app_name} is configured twice")
+            for port in ("worker_port", "app_port"):
+                if getattr(other, port) == getattr(manager, port):
+                    raise ValueError(
+                        f"Applications {other.app_name} and {manager.app_name} "
+                        f"both use {port} {getattr(manager, port)}"
+                    )
+        self.managers.append(manager)
+
+    def report_capacity(self, host: str, cpus: float, memory_mb: Optional[float]) -> None:
+        capacity = {"cpus": cpus, "memory_mb": memory_mb}
+        if self.reported_capacity.get(host) != capacity:
+            logger.info(f"VM {host} reported {cpus} cpus and {memory_mb} MB memory")
+            self.reported_capacity[host] = capacity
+
+    def capacity(self, host: str) -> Optional[dict]:
+        return (
+            self.reported_capacity.get(host)
+            or self.configured_capacity.get(host)
+            or self.default_capacity
+        )
+
+    @staticmethod
+    def pending_hosts(manager) -> Iterable[str]:
+        # Deploys in flight hold their VM before the worker is recorded
+        for operation in manager.operations.active():
+            if (
+                operation["kind"] in ("deploy", "provision")
+                and operation["worker"] not in manager.workers_data
+            ):
+                yield operation["host"]
+
+    @classmethod
+    def app_hosts(cls, manager) -> Iterable[str]:
+        yield from manager.workers_data.hosts()
+        yield from cls.pending_hosts(manager)
+
+    def usage(self) -> Dict[str, dict]:
+        usage: Dict[str, dict] = {}
+        for manager in self.managers:
+            for host in set(self.app_hosts(manager)):
+                used = usage.setdefault(host, empty_usage())
+                used["apps"].append(manager.app_name)
+                if manager.app_resources is None:
+                    used["exclusive"] = True
+                else:
+                    for resource in RESOURCES:
+                        used[resource] += manager.app_resources.get(resource, 0)
+        return usage
+
+    def fit(self, host: str, request: Optional[dict], used: Optional[dict]) -> Optional[float]:
+        # Free share of the VM left after the placement, lower is a better fit
+        used = used or empty_usage()
+        if used["exclusive"]:
+            return None
+        capacity = self.capacity(host)
+        if request is None or capacity is None:
+            # Apps without a resource request take the VM for themselves, VMs
+            # of unknown size take one worker until their agent reports it
+            return 2.0 if not used["apps"] else None
+        left = 0.0
+        for resource in RESOURCES:
+            total = capacity.get(resource)
+            if not total:
+                continue
+            usable = total * (1 - self.headroom)
+            free = usable - used[resource] - request.get(resource, 0)
+            if free < 0:
+                return None
+            left += free / usable
+        return left
+
+    def place(self, manager, exclude=()) -> Optional[str]:
+        usage = self.usage()
+        # VMs without a recorded worker of the app are indexed by the registry
+        free_vms = manager.workers_data.free_vms.difference(exclude, self.pending_hosts(manager))
+        candidates = []
+        for index, vm in enumerate(manager.virtual_machines):
+            if vm not in free_vms:
+                continue
+            fit = self.fit(vm, manager.app_resources, usage.get(vm))
+            if fit is not None:
+                candidates.append((fit, index, vm))
+        for _, _, vm in sorted(candidates):
+            # Half-open hosts get the deploy as their probe
+            if manager.breakers.allow(vm):
+                return vm
+        return None
+
+    def to_dict(self) -> dict:
+        usage = self.usage()
+        hosts = dict.fromkeys(
+            vm for manager in self.managers for vm in manager.virtual_machines
+        )
+        return {
+            "headroom": self.headroom,
+            "vms": {
+                host: {
+                    "capacity": self.capacity(host),
+                    "used": usage.get(host, empty_usage()),
+                }
+                for host in hosts
+            },
+        }
@@ -0,0 +1,224 @@
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Set, Tuple
+
+from master.circuit_breaker import CircuitBreakers
+from master.metrics import SSH_COMMAND_SECONDS
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+# Exit status ssh uses for its own (connection) errors
+SSH_ERROR_RETURNCODE = 255
+
+
+class CommandError(Exception):
+    def __init__(
+        self, message: str, returncode: Optional[int] = None, stderr: str = ""
+    ):
+        super().__init__(message)
+        self.returncode = returncode
+        self.stderr = stderr
+
+
+async def run_command(*cmd, stdin=None) -> str:
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=stdin,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        error_message = stderr.decode() if stderr else "Unknown error"
+        raise CommandError(
+            f"Error executing command {' '.join(cmd)}: {error_message}",
+            proc.returncode,
+            error_message,
+        )
+    return stdout.decode().strip()
+
+
+# Runs remote commands over one long-lived, multiplexed OpenSSH connection per
+# VM (ControlMaster), so only the first command to a host pays the handshake.
+class SSHPool:
+    def __init__(
+        self,
+        ssh_user: str,
+        max_channels: int = 8,
+        control_persist: int = 600,
+        connect_timeout: int = 10,
+        control_dir: Optional[str] = None,
+        breakers: Optional[CircuitBreakers] = None,
+    ):
+        self.ssh_user = ssh_user
+        self.breakers = breakers
+        self.max_channels = max_channels
+        self.control_persist = control_persist
+        self.connect_timeout = connect_timeout
+        self.control_dir = control_dir or tempfile.mkdtemp(prefix="orchestrator-ssh-")
+        self.connected_hosts: Set[str] = set()
+        self.host_locks: Dict[str, asyncio.Lock] = {}
+        self.channels: Dict[str, asyncio.Semaphore] = {}
+        self.latencies: Deque[Tuple[str, str, float, bool]] = deque(maxlen=500)
+
+    def credentials(self, host: str) -> str:
+        return f"{self.ssh_user}@{host}"
+
+    def control_path(self, host: str) -> str:
+        # Short and known up front, so the socket can be checked for without
+        # asking ssh; unix socket paths are limited to about 100 bytes
+        digest = hashlib.sha1(self.credentials(host).encode()).hexdigest()[:16]
+        return os.path.join(self.control_dir, digest)
+
+    def ssh_options(self, host: str, control_master: str = "no") -> list:
+        return [
+            "-o", f"ControlMaster={control_master}",
+            "-o", f"ControlPath={self.control_path(host)}",
+            "-o", f"ControlPersist={self.control_persist}",
+            "-o", f"ConnectTimeout={self.connect_timeout}",
+            "-o", "ServerAliveInterval=15",
+            "-o", "BatchMode=yes",
+        ]
+
+    def is_connected(self, host: str) -> bool:
+        # The master exits after ControlPersist idle seconds and takes its
+        # socket with it, commands would silently fall back to a full handshake
+        if host in self.connected_hosts and not os.path.exists(self.control_path(host)):
+            self.connected_hosts.discard(host)
+        return host in self.connected_hosts
+
+    async def connect(self, host: str) -> None:
+        if self.is_connected(host):
+            return
+        lock = self.host_locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            if self.is_connected(host):
+                return
+            started = time.monotonic()
+            # -f backgrounds the master once authenticated, its stdio goes to
+            # /dev/null so nothing waits on pipes the master keeps open
+            proc = await asyncio.create_subprocess_exec(
+                "ssh",
+                *self.ssh_options(host, "yes"),
+                "-N",
+                "-f",
+                self.credentials(host),
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+            await proc.wait()
+            self._record(host, "connect", started, proc.returncode == 0)
+            if proc.returncode != 0:
+                self._host_failed(host)
+                raise CommandError(f"Error opening ssh connection to {host}")
+            self.connected_hosts.add(host)
+            logger.info(f"Opened ssh master connection to {host}")
+
+    async def _exec(
+        self, host: str, name: str, description: str, cmd: list, stdin=None
+    ) -> str:
+        if self.breakers is not None and not self.breakers.allow(host):
+            raise CommandError(f"Not running {description} on {host}, circuit open")
+        await self.connect(host)
+        semaphore = self.channels.setdefault(
+            host, asyncio.Semaphore(self.max_channels)
+        )
+        async with semaphore:
+            started = time.monotonic()
+            try:
+                output = await run_command(*cmd, stdin=stdin)
+            except CommandError as e:
+                self._record(host, name, started, False)
+                if e.returncode == SSH_ERROR_RETURNCODE:
+                    # The master connection may be gone, reconnect next time
+                    self.connected_hosts.discard(host)
+                    self._host_failed(host)
+                raise CommandError(
+                    f"Error executing command {description} on {host}: {e.stderr}",
+                    e.returncode,
+                    e.stderr,
+                ) from e
+            self._record(host, name, started, True)
+            if self.breakers is not None:
+                self.breakers.record_success(host)
+            return output
+
+    async def run(self, host: str, *args: str, stdin=None, name: Optional[str] = None) -> str:
+        # Latency is aggregated per command, docker per subcommand, compound
+        # command lines are named by the caller
+        if name is None:
+            name = " ".join(args[:2]) if args[0] == "docker" else os.path.basename(args[0])
+        return await self._exec(
+            host,
+            name,
+            " ".join(args),
+            ["ssh", *self.ssh_options(host), self.credentials(host), *args],
+            stdin=stdin,
+        )
+
+    async def copy(self, host: str, local_path: str, remote_path: str) -> None:
+        await self._exec(
+            host,
+            "scp",
+            f"scp {local_path} {remote_path}",
+            [
+                "scp",
+                *self.ssh_options(host),
+                local_path,
+                f"{self.credentials(host)}:{remote_path}",
+            ],
+        )
+
+    async def close(self) -> None:
+        for host in list(self.connected_hosts):
+            proc = await asyncio.create_subprocess_exec(
+                "ssh",
+                *self.ssh_options(host),
+                "-O",
+                "exit",
+                self.credentials(host),
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+            await proc.wait()
+        self.connected_hosts.clear()
+
+    def _host_failed(self, host: str) -> None:
+        if self.breakers is not None:
+            self.breakers.record_failure(host)
+
+    def _record(self, host: str, name: str, started: float, ok: bool) -> None:
+        duration = time.monotonic() - started
+        self.latencies.append((host, name, duration, ok))
+        SSH_COMMAND_SECONDS.observe(
+            duration, command=name, outcome="success" if ok else "failure"
+        )
+        logger.info(
+            f"ssh {name} on {host} {'finished' if ok else 'failed'} in {duration:.3f} sec"
+        )
+
+    def stats(self) -> dict:
+        commands: Dict[str, dict] = {}
+        for host, name, duration, ok in self.latencies:
+            command = commands.setdefault(
+                name, {"count": 0, "failed": 0, "total_sec": 0.0, "max_sec": 0.0}
+            )
+            command["count"] += 1
+            command["failed"] += not ok
+            command["total_sec"] += duration
+            command["max_sec"] = max(command["max_sec"], duration)
+        for command in commands.values():
+            command["avg_sec"] = command.pop("total_sec") / command["count"]
+        return {
+            "connected_hosts": sorted(self.connected_hosts),
+            "max_channels": self.max_channels,
+            "commands": commands,
+        }
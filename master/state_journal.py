@@ -0,0 +1,173 @@
+import base64
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+import aiohttp
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FILE = "snapshot.json"
+JOURNAL_FILE = "journal.jsonl"
+
+
+def empty_state() -> dict:
+    return {"seq": 0, "workers": {}, "operations": {}, "metrics": [], "app_revision": None}
+
+
+def apply_record(state: dict, record: dict) -> None:
+    kind = record["type"]
+    if kind == "worker":
+        state["workers"].setdefault(record["name"], {}).update(record["data"])
+    elif kind == "worker_removed":
+        state["workers"].pop(record["name"], None)
+    elif kind == "operation":
+        operation = record["operation"]
+        if operation["state"] in ("pending", "running"):
+            state["operations"][operation["id"]] = operation
+        else:
+            state["operations"].pop(operation["id"], None)
+    elif kind == "app_revision":
+        state["app_revision"] = record["revision"]
+    state["seq"] = record["seq"]
+
+
+# Checkpoints the master state as a snapshot plus an append-only journal of
+# changes since it, and optionally mirrors snapshots to etcd (v3 JSON API).
+class StateJournal:
+    def __init__(
+        self,
+        directory: str,
+        snapshot_every: int = 1000,
+        snapshot_interval: float = 60,
+        fsync: bool = False,
+        etcd_url: Optional[str] = None,
+        etcd_prefix: str = "/orchestrator",
+    ):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.snapshot_interval = snapshot_interval
+        self.fsync = fsync
+        self.etcd_url = etcd_url.rstrip("/") if etcd_url else None
+        self.etcd_key = f"{etcd_prefix.rstrip('/')}/snapshot"
+        os.makedirs(directory, exist_ok=True)
+        self.snapshot_path = os.path.join(directory, SNAPSHOT_FILE)
+        self.journal_path = os.path.join(directory, JOURNAL_FILE)
+        self.seq = 0
+        self.records_since_snapshot = 0
+        self.last_snapshot = time.monotonic()
+        self.journal_file = None
+
+    def load(self) -> Optional[dict]:
+        if not os.path.exists(self.snapshot_path) and not os.path.exists(
+            self.journal_path
+        ):
+            return None
+        state = empty_state()
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path) as snapshot_file:
+                state = json.load(snapshot_file)
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as journal_file:
+                for line in journal_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Torn write of the last record before a crash
+                        logger.warning("Skipping corrupt journal record")
+                        continue
+                    if record["seq"] > state["seq"]:
+                        apply_record(state, record)
+                        self.records_since_snapshot += 1
+        self.seq = state["seq"]
+        logger.info(
+            f"Loaded state seq {self.seq} with {len(state['workers'])} workers "
+            f"from {self.directory}"
+        )
+        return state
+
+    async def load_remote(self) -> Optional[dict]:
+        if not self.etcd_url:
+            return None
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.post(
+                    f"{self.etcd_url}/v3/kv/range",
+                    json={"key": self._encode(self.etcd_key)},
+                    timeout=aiohttp.ClientTimeout(total=5),
+                ) as response:
+                    response.raise_for_status()
+                    kvs = (await response.json()).get("kvs")
+        except Exception as e:
+            logger.warning(f"Failed to load state snapshot from etcd: {e!r}")
+            return None
+        if not kvs:
+            return None
+        state = json.loads(base64.b64decode(kvs[0]["value"]))
+        self.seq = state["seq"]
+        logger.info(f"Loaded state seq {self.seq} from etcd")
+        return state
+
+    def append(self, record: dict) -> None:
+        self.seq += 1
+        record["seq"] = self.seq
+        if self.journal_file is None:
+            self.journal_file = open(self.journal_path, "a")
+        self.journal_file.write(json.dumps(record) + "\n")
+        self.journal_file.flush()
+        if self.fsync:
+            os.fsync(self.journal_file.fileno())
+        self.records_since_snapshot += 1
+
+    def needs_snapshot(self) -> bool:
+        return self.records_since_snapshot >= self.snapshot_every or (
+            self.records_since_snapshot
+            and time.monotonic() - self.last_snapshot >= self.snapshot_interval
+        )
+
+    async def write_snapshot(self, state: dict) -> None:
+        state["seq"] = self.seq
+        temp_path = f"{self.snapshot_path}.tmp"
+        with open(temp_path, "w") as snapshot_file:
+            json.dump(state, snapshot_file)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temp_path, self.snapshot_path)
+        # Records up to seq are in the snapshot now
+        if self.journal_file is not None:
+            self.journal_file.close()
+        self.journal_file = open(self.journal_path, "w")
+        self.records_since_snapshot = 0
+        self.last_snapshot = time.monotonic()
+        logger.info(f"Wrote state snapshot at seq {self.seq}")
+
+        if self.etcd_url:
+            # Metric history would exceed etcd's value size limit on big fleets
+            await self._put_remote({**state, "metrics": []})
+
+    async def _put_remote(self, state: dict) -> None:
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.post(
+                    f"{self.etcd_url}/v3/kv/put",
+                    json={
+                        "key": self._encode(self.etcd_key),
+                        "value": self._encode(json.dumps(state)),
+                    },
+                    timeout=aiohttp.ClientTimeout(total=5),
+                ) as response:
+                    response.raise_for_status()
+        except Exception as e:
+            logger.warning(f"Failed to store state snapshot in etcd: {e!r}")
+
+    @staticmethod
+    def _encode(value: str) -> str:
+        return base64.b64encode(value.encode()).decode()
+
+    def close(self) -> None:
+        if self.journal_file is not None:
+            self.journal_file.close()
+            self.journal_file = None
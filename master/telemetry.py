@@ -0,0 +1,90 @@
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+
+def bucket_percentile(
+    bounds: Sequence[float], counts: Sequence[int], percentile: float
+) -> Optional[float]:
+    # Interpolated within the bucket the rank falls into, the overflow bucket
+    # is reported as the last bound
+    total = sum(counts)
+    if not total:
+        return None
+    rank = percentile / 100 * total
+    seen = 0
+    for index, count in enumerate(counts):
+        if count and seen + count >= rank:
+            if index >= len(bounds):
+                return float(bounds[-1])
+            lower = bounds[index - 1] if index else 0.0
+            return lower + (bounds[index] - lower) * (rank - seen) / count
+        seen += count
+    return float(bounds[-1])
+
+
+# Latest report of every load balancer's telemetry collector. Reports older
+# than the TTL are left out, a load balancer that went away stops counting.
+class TrafficTelemetry:
+    def __init__(self, ttl: float = 30):
+        self.ttl = ttl
+        # load balancer id -> (monotonic time received, report)
+        self.reports: Dict[str, Tuple[float, dict]] = {}
+
+    def add(self, load_balancer: str, report: dict) -> None:
+        self.reports[load_balancer] = (time.monotonic(), report)
+
+    def fresh_reports(self) -> List[dict]:
+        deadline = time.monotonic() - self.ttl
+        for load_balancer, (received_at, _) in list(self.reports.items()):
+            if received_at < deadline:
+                del self.reports[load_balancer]
+        return [report for _, report in self.reports.values()]
+
+    def summary(self) -> Optional[dict]:
+        # Request rates add up over the load balancers, latency histograms
+        # are merged before taking percentiles
+        reports = [report for report in self.fresh_reports() if report.get("interval")]
+        if not reports:
+            return None
+        bounds = reports[0]["buckets_ms"]
+        total_buckets = [0] * (len(bounds) + 1)
+        upstreams: Dict[str, dict] = {}
+        active_connections = 0
+        for report in reports:
+            active_connections += (report.get("connections") or {}).get("active", 0)
+            same_buckets = report["buckets_ms"] == bounds
+            for address, stats in report["upstreams"].items():
+                upstream = upstreams.setdefault(
+                    address,
+                    {
+                        "requests_per_second": 0.0,
+                        "errors_per_second": 0.0,
+                        "buckets": [0] * len(total_buckets),
+                    },
+                )
+                upstream["requests_per_second"] += stats["requests"] / report["interval"]
+                upstream["errors_per_second"] += stats["errors"] / report["interval"]
+                if same_buckets:
+                    for index, count in enumerate(stats["latency_buckets"]):
+                        upstream["buckets"][index] += count
+                        total_buckets[index] += count
+        return {
+            "load_balancers": len(reports),
+            "active_connections": active_connections,
+            "requests_per_second": sum(
+                upstream["requests_per_second"] for upstream in upstreams.values()
+            ),
+            "errors_per_second": sum(
+                upstream["errors_per_second"] for upstream in upstreams.values()
+            ),
+            "latency_p50_ms": bucket_percentile(bounds, total_buckets, 50),
+            "latency_p95_ms": bucket_percentile(bounds, total_buckets, 95),
+            "upstreams": {
+                address: {
+                    "requests_per_second": upstream["requests_per_second"],
+                    "errors_per_second": upstream["errors_per_second"],
+                    "latency_p95_ms": bucket_percentile(bounds, upstream.pop("buckets"), 95),
+                }
+                for address, upstream in upstreams.items()
+            },
+        }
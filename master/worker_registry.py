@@ -0,0 +1,250 @@
+from bisect import bisect_left, insort
+from collections import deque
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+_UNSET = object()
+
+# Fields every agent reports, kept in slots; anything else goes to `extra`
+FIELDS = (
+    "name",
+    "host",
+    "status",
+    "standby",
+    "draining",
+    "started_at",
+    "cpu_usage",
+    "memory_usage",
+    "vm_cpus",
+    "vm_memory_mb",
+)
+
+
+# One worker's state. Reads work like the dicts it replaces, writes go
+# through WorkerRegistry.update so the indexes stay in sync.
+class WorkerRecord:
+    __slots__ = FIELDS + ("extra",)
+
+    def __init__(self) -> None:
+        for field in FIELDS:
+            setattr(self, field, _UNSET)
+        self.extra: Optional[dict] = None
+
+    def get(self, key: str, default=None):
+        if key in FIELDS:
+            value = getattr(self, key)
+            return default if value is _UNSET else value
+        return self.extra.get(key, default) if self.extra else default
+
+    def __getitem__(self, key: str):
+        value = self.get(key, _UNSET)
+        if value is _UNSET:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key, _UNSET) is not _UNSET
+
+    def set(self, key: str, value) -> None:
+        if key in FIELDS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def to_dict(self) -> dict:
+        data = {
+            field: getattr(self, field)
+            for field in FIELDS
+            if getattr(self, field) is not _UNSET
+        }
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def __repr__(self) -> str:
+        return f"WorkerRecord({self.to_dict()!r})"
+
+
+# callback(event, worker name, record, changes), event is "added", "updated"
+# or "removed"
+Listener = Callable[[str, str, WorkerRecord, dict], None]
+
+
+# Workers by name with secondary indexes by host, by status and by load, and
+# the set of VMs without a worker, so scheduling decisions do not scan the
+# whole fleet. Subscribers are told about every change, and every change
+# bumps the version so clients can ask for what changed since theirs. Quiet
+# fields, like the age of a sample, are stored without either.
+class WorkerRegistry:
+    def __init__(
+        self,
+        virtual_machines: Iterable[str] = (),
+        history_size: int = 10000,
+        quiet_fields: Iterable[str] = (),
+    ):
+        self.records: Dict[str, WorkerRecord] = {}
+        self.by_host: Dict[str, Set[str]] = {}
+        self.by_status: Dict[str, Set[str]] = {}
+        self.loads: Dict[str, float] = {}
+        # (load, worker name), ascending
+        self.load_order: List[Tuple[float, str]] = []
+        self.virtual_machines = set(virtual_machines)
+        self.free_vms: Set[str] = set(self.virtual_machines)
+        self.listeners: List[Listener] = []
+        self.version = 0
+        # (version, worker name) of recent changes, oldest first
+        self.history: Deque[Tuple[int, str]] = deque()
+        self.history_size = history_size
+        self.quiet_fields = frozenset(quiet_fields)
+        # Changes since this version or later can be told from the history
+        self.history_start = 0
+
+    def subscribe(self, listener: Listener) -> None:
+        self.listeners.append(listener)
+
+    def _emit(self, event: str, name: str, record: WorkerRecord, changes: dict) -> None:
+        self.version += 1
+        self.history.append((self.version, name))
+        if len(self.history) > self.history_size:
+            self.history_start = self.history.popleft()[0]
+        for listener in self.listeners:
+            listener(event, name, record, changes)
+
+    # Mapping interface, read-only
+    def __getitem__(self, name: str) -> WorkerRecord:
+        return self.records[name]
+
+    def __contains__(self, name: object) -> bool:
+        return name in self.records
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.records)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def get(self, name: str, default=None) -> Optional[WorkerRecord]:
+        return self.records.get(name, default)
+
+    def keys(self):
+        return self.records.keys()
+
+    def values(self):
+        return self.records.values()
+
+    def items(self):
+        return self.records.items()
+
+    def to_dict(self) -> Dict[str, dict]:
+        return {name: record.to_dict() for name, record in self.records.items()}
+
+    def _index(self, index: Dict[str, Set[str]], key, name: str) -> None:
+        if key is not _UNSET and key is not None:
+            index.setdefault(key, set()).add(name)
+
+    def _unindex(self, index: Dict[str, Set[str]], key, name: str) -> None:
+        names = index.get(key)
+        if names is not None:
+            names.discard(name)
+            if not names:
+                del index[key]
+
+    def _move_host(self, name: str, old_host, new_host) -> None:
+        if old_host is not _UNSET:
+            self._unindex(self.by_host, old_host, name)
+            if old_host not in self.by_host and old_host in self.virtual_machines:
+                self.free_vms.add(old_host)
+        if new_host is not _UNSET and new_host is not None:
+            self._index(self.by_host, new_host, name)
+            self.free_vms.discard(new_host)
+
+    def update(
+        self, name: str, data: dict, load: Optional[float] = None, create: bool = True
+    ) -> dict:
+        record = self.records.get(name)
+        added = record is None
+        if added and not create:
+            return {}
+        if added:
+            record = self.records[name] = WorkerRecord()
+        changes = {}
+        for key, value in data.items():
+            old = record.get(key, _UNSET)
+            if old is not _UNSET and old == value:
+                continue
+            changes[key] = value
+            record.set(key, value)
+            if key == "host":
+                self._move_host(name, old, value)
+            elif key == "status":
+                self._unindex(self.by_status, old, name)
+                self._index(self.by_status, value, name)
+        load_changed = load is not None and self.loads.get(name) != load
+        if load_changed:
+            self.set_load(name, load)
+        loud_changes = {
+            key: value for key, value in changes.items() if key not in self.quiet_fields
+        }
+        if added or loud_changes or load_changed:
+            self._emit("added" if added else "updated", name, record, loud_changes)
+        return changes
+
+    def remove(self, name: str) -> Optional[WorkerRecord]:
+        record = self.records.pop(name, None)
+        if record is None:
+            return None
+        self._move_host(name, record.host, _UNSET)
+        self._unindex(self.by_status, record.status, name)
+        self.set_load(name, None)
+        self._emit("removed", name, record, {})
+        return record
+
+    def replace(self, workers: Dict[str, dict]) -> None:
+        # Loads a snapshot, subscribers are not told about it
+        listeners, self.listeners = self.listeners, []
+        try:
+            for name in list(self.records):
+                self.remove(name)
+            for name, data in workers.items():
+                self.update(name, data)
+        finally:
+            self.listeners = listeners
+        self.history.clear()
+        self.history_start = self.version
+
+    def changed_since(self, version: Optional[int]) -> Optional[Set[str]]:
+        # Names of workers changed or removed after `version`, None when the
+        # history does not reach back that far
+        if version is None or not self.history_start <= version <= self.version:
+            return None
+        names = set()
+        for changed_version, name in reversed(self.history):
+            if changed_version <= version:
+                break
+            names.add(name)
+        return names
+
+    def set_load(self, name: str, load: Optional[float]) -> None:
+        old = self.loads.pop(name, None)
+        if old is not None:
+            del self.load_order[bisect_left(self.load_order, (old, name))]
+        if load is not None:
+            self.loads[name] = load
+            insort(self.load_order, (load, name))
+
+    def hosts(self):
+        return self.by_host.keys()
+
+    def on_host(self, host: str) -> Set[str]:
+        return self.by_host.get(host, set())
+
+    def with_status(self, status: str) -> Set[str]:
+        return self.by_status.get(status, set())
+
+    def count(self, status: str) -> int:
+        return len(self.by_status.get(status, ()))
+
+    def by_load(self) -> Iterator[str]:
+        for _, name in self.load_order:
+            yield name
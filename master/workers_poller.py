@@ -1,7 +1,9 @@
 import asyncio
 import logging
+import time
 
 import aiohttp
+from master.metrics import POLL_CYCLE_SECONDS
 from master.remote_workers_manager import RemoteWorkerManager
 
 logging.basicConfig(level=logging.INFO)
@@ -9,25 +11,98 @@ logger = logging.getLogger(__name__)
 
 
 class WorkersPoller:
-    def __init__(self, worker_manager: RemoteWorkerManager):
+    def __init__(
+        self,
+        worker_manager: RemoteWorkerManager,
+        interval: float = 7,
+        concurrency: int = 50,
+        request_timeout: float = 5,
+        connect_timeout: float = 2,
+        retry_delay: float = 5,
+        max_retry_delay: float = 60,
+    ):
         self.worker_manager = worker_manager
+        self.interval = interval
+        self.request_timeout = aiohttp.ClientTimeout(
+            total=request_timeout, sock_connect=connect_timeout
+        )
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.last_cycle_duration = None
+        self.recovery_task = None
 
     async def poll_workers(self) -> None:
-        try:
-            async with aiohttp.ClientSession() as self.session:
-                await self._poll_workers()
-        except Exception as e:
-            logger.exception(f"Error in poll_workers, retrying after 60 sec: {e!r}")
-            await asyncio.sleep(15)
+        # Apps share the process, one failing app must not stop being managed
+        # while the others go on
+        delay = self.retry_delay
+        while True:
+            started = time.monotonic()
+            try:
+                async with aiohttp.ClientSession() as self.session:
+                    await self._poll_workers()
+            except Exception as e:
+                if time.monotonic() - started > self.max_retry_delay:
+                    delay = self.retry_delay
+                logger.exception(
+                    f"Error polling workers of app {self.worker_manager.app_name}, "
+                    f"retrying after {delay:.0f} sec: {e!r}"
+                )
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+
+    async def _poll_worker(self, worker: dict) -> None:
+        async with self.semaphore:
+            await self.worker_manager.update_worker_data(
+                worker, timeout=self.request_timeout
+            )
+
+    async def poll_cycle(self) -> float:
+        started = time.monotonic()
+        # Workers on VMs of other replicas are mirrored from them, not polled
+        workers = [
+            worker
+            for worker in self.worker_manager.workers_data.values()
+            if self.worker_manager.owns(worker.get("host"))
+        ]
+        await asyncio.gather(*(self._poll_worker(worker) for worker in workers))
+        self.last_cycle_duration = time.monotonic() - started
+        POLL_CYCLE_SECONDS.observe(self.last_cycle_duration)
+        logger.info(
+            f"Polled {len(workers)} workers in {self.last_cycle_duration:.3f} sec"
+        )
+        return self.last_cycle_duration
+
+    async def _expire_heartbeats(self) -> None:
+        while True:
+            await self.worker_manager.expire_missing_heartbeats()
+            await asyncio.sleep(self.worker_manager.heartbeat_interval)
 
     async def _poll_workers(self):
         self.worker_manager.session = self.session
-        await self.worker_manager.initialize_workers_data()
+        if self.worker_manager.recovering:
+            # Restored state is served right away and verified in the background,
+            # a retried cycle leaves a recovery that is still running alone
+            if self.recovery_task is None or self.recovery_task.done():
+                self.recovery_task = asyncio.create_task(
+                    self.worker_manager.recover(self.request_timeout)
+                )
+        else:
+            await self.worker_manager.initialize_workers_data(self.request_timeout)
+        if self.worker_manager.heartbeat_enabled:
+            # Workers push their status, only deadlines are checked here
+            logger.info("Heartbeat mode enabled, status polling is disabled")
+            heartbeats_task = asyncio.create_task(self._expire_heartbeats())
+            try:
+                while True:
+                    await self.worker_manager.sync_peers()
+                    await self.worker_manager.check_and_scale_workers()
+                    await asyncio.sleep(self.interval)
+            finally:
+                heartbeats_task.cancel()
+
         while True:
-            tasks = [
-                self.worker_manager.update_worker_data(worker)
-                for worker in self.worker_manager.workers_data.values()
-            ]
-            await asyncio.gather(*tasks)
+            cycle_duration = await self.poll_cycle()
+            await self.worker_manager.sync_peers()
             await self.worker_manager.check_and_scale_workers()
-            await asyncio.sleep(7)
+            await asyncio.sleep(max(0.0, self.interval - cycle_duration))
@@ -1,16 +1,36 @@
+import hashlib
 import os
-import tempfile
 import logging
+import re
+import shutil
 
 import docker
 import requests
-from git import Repo
+from git import Git, GitCommandError, InvalidGitRepositoryError, Repo
+
+from metrics_sampler import MetricsSampler
 
 # Configure logging
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
+# Where the host's /proc is mounted in the agent container, app container
+# processes are looked up there by their host pid
+PROC_ROOT = os.environ.get("PROC_ROOT", "/proc")
+
+REVISION_LABEL = "org.opencontainers.image.revision"
+SOURCE_LABEL = "org.opencontainers.image.source"
+COMMIT_RE = re.compile(r"^[0-9a-f]{40}$")
+PRESSURE_METRICS = (
+    "cpu_throttled",
+    "cpu_pressure",
+    "memory_pressure",
+    "io_pressure",
+    "io_read_bytes_per_second",
+    "io_write_bytes_per_second",
+)
+
 
 class AppRunner:
     def __init__(
@@ -21,14 +41,49 @@ class AppRunner:
         self.healthcheck_api = healthcheck_api
         self.app_dockerfile = app_dockerfile
         self.app_git_repo = app_git_repo
+        # Mirrors of app repos, kept between builds and agent restarts when
+        # the directory is a mounted volume
+        self.repo_cache_dir = os.environ.get(
+            "APP_REPO_CACHE", "/var/cache/orchestrator/repos"
+        )
         self.client = docker.from_env()
         self.container = None
+        self.health_session = requests.Session()
+        # Revision of the app the running container was built from
+        self.revision = self.container_revision(self.get_existing_container(only_running=True))
+        self.sampler = MetricsSampler(self)
+        self.sampler.start()
 
-    def start(self):
+    def start(self, image_ref=None, resources=None, revision=None, on_step=None):
+        on_step = on_step or (lambda step: None)
         logging.info("Starting the app")
 
+        standby_container = self.get_standby_container()
+        if (
+            standby_container
+            and (not image_ref or self.is_container_image(standby_container, image_ref))
+            and (not revision or self.container_revision(standby_container) == revision)
+        ):
+            logging.info(f"Starting prepared standby container {self.app_image}")
+            on_step("starting_container")
+            standby_container.start()
+            self.container = standby_container
+        else:
+            self.container = self.create_container(image_ref, resources, revision, on_step)
+            on_step("starting_container")
+            self.container.start()
+        self.revision = self.container_revision(self.container)
+
+    def prepare(self, image_ref=None, resources=None, revision=None, on_step=None):
+        logging.info("Preparing the app container without starting it")
+        self.container = self.create_container(
+            image_ref, resources, revision, on_step or (lambda step: None)
+        )
+
+    def create_container(self, image_ref, resources, revision, on_step):
         existing_container = self.get_existing_container()
         if existing_container:
+            on_step("removing_old_container")
             logging.info(
                 f"Container with name {self.app_image} already exists. Stopping and removing ..."
             )
@@ -36,36 +91,126 @@ class AppRunner:
             existing_container.wait()
             existing_container.remove()
 
-        self.build_image()
+        if image_ref and self.image_exists(image_ref):
+            logging.info(f"Using prebuilt image {image_ref}, skipping build")
+            self.client.images.get(image_ref).tag(self.app_image)
+        else:
+            self.build_image(on_step, revision)
+
+        # Several apps share a VM, each container is held to what it was placed with
+        limits = {}
+        if resources and resources.get("cpus"):
+            limits["nano_cpus"] = int(resources["cpus"] * 1e9)
+        if resources and resources.get("memory_mb"):
+            limits["mem_limit"] = f"{int(resources['memory_mb'])}m"
 
-        self.container = self.client.containers.run(
+        on_step("creating_container")
+        return self.client.containers.create(
             self.app_image,
             name=self.app_image,
-            detach=True,
             ports={f"{self.app_port}/tcp": self.app_port},
+            **limits,
         )
 
-    def build_image(self):
-        logging.info("Building the app image...")
-        with tempfile.TemporaryDirectory() as tempdir:
-            self._clone_repo(tempdir)
-            build_context = os.path.dirname(os.path.join(tempdir, self.app_dockerfile))
-            dockerfile = os.path.basename(self.app_dockerfile)
-            logging.info(
-                f"Build context for app image is {build_context}, dockerfile is {dockerfile}"
-            )
-            self.client.images.build(
-                path=build_context, tag=self.app_image, dockerfile=dockerfile, rm=True
+    def get_standby_container(self):
+        containers = self.client.containers.list(
+            all=True, filters={"name": self.app_image, "status": "created"}
+        )
+        return containers[0] if containers else None
+
+    def is_container_image(self, container, image_ref):
+        try:
+            return container.image.id == self.client.images.get(image_ref).id
+        except docker.errors.ImageNotFound:
+            return False
+
+    @staticmethod
+    def container_revision(container):
+        if container is None:
+            return None
+        return container.image.labels.get(REVISION_LABEL)
+
+    def image_exists(self, image_ref):
+        try:
+            self.client.images.get(image_ref)
+            return True
+        except docker.errors.ImageNotFound:
+            return False
+
+    def build_image(self, on_step=None, revision=None):
+        # Builds the given commit or branch, the repo head without one
+        on_step = on_step or (lambda step: None)
+        on_step("resolving_revision")
+        revision = self.resolve_revision(revision or "HEAD")
+        if revision and self.image_revision() == revision:
+            logging.info(f"Image {self.app_image} is already built from {revision}, skipping build")
+            return
+        if revision is None and self.image_exists(self.app_image):
+            logging.warning(
+                f"Could not resolve {self.app_git_repo}, using the existing {self.app_image} image"
             )
+            return
 
-    def _clone_repo(self, tempdir):
-        logging.info(f"Cloning the app git repo {self.app_git_repo}")
-        remote_repo = Repo.clone_from(self.app_git_repo, tempdir)
-        logging.info(f"Git repository cloned to {tempdir}")
-        logging.info("Listing content of the cloned repository:")
-        for item in os.listdir(tempdir):
-            logging.info(f"  - {item}")
-        return remote_repo
+        on_step("fetching_source")
+        repo = self._sync_mirror(revision)
+        revision = repo.head.commit.hexsha
+        build_context = os.path.dirname(os.path.join(repo.working_dir, self.app_dockerfile))
+        dockerfile = os.path.basename(self.app_dockerfile)
+        logging.info(
+            f"Building the app image from {revision}, context {build_context}, dockerfile {dockerfile}"
+        )
+        on_step("building_image")
+        # The daemon keeps the layer cache between builds, the previous image
+        # is offered as a cache source too, e.g. after it was distributed
+        self.client.images.build(
+            path=build_context,
+            tag=self.app_image,
+            dockerfile=dockerfile,
+            rm=True,
+            cache_from=[self.app_image] if self.image_exists(self.app_image) else None,
+            labels={REVISION_LABEL: revision, SOURCE_LABEL: self.app_git_repo},
+        )
+
+    def resolve_revision(self, ref="HEAD"):
+        if COMMIT_RE.match(ref):
+            return ref
+        try:
+            output = Git().ls_remote(self.app_git_repo, ref)
+        except GitCommandError as e:
+            logging.warning(f"Failed to resolve {ref} of {self.app_git_repo}: {e}")
+            return None
+        return output.split()[0] if output else None
+
+    def image_revision(self):
+        try:
+            return self.client.images.get(self.app_image).labels.get(REVISION_LABEL)
+        except docker.errors.ImageNotFound:
+            return None
+
+    def _sync_mirror(self, revision=None):
+        repo_dir = os.path.join(
+            self.repo_cache_dir, hashlib.sha1(self.app_git_repo.encode()).hexdigest()[:16]
+        )
+        if os.path.isdir(os.path.join(repo_dir, ".git")):
+            # Only the new tip is fetched, the checkout is updated in place so
+            # unchanged files stay byte-identical for the layer cache
+            logging.info(f"Fetching {self.app_git_repo} into {repo_dir}")
+            try:
+                repo = Repo(repo_dir)
+                repo.git.fetch("--depth", "1", "origin", revision or "HEAD")
+                repo.git.reset("--hard", "FETCH_HEAD")
+                repo.git.clean("-ffdx")
+                return repo
+            except (GitCommandError, InvalidGitRepositoryError) as e:
+                logging.warning(f"Mirror {repo_dir} is broken, cloning again: {e}")
+        shutil.rmtree(repo_dir, ignore_errors=True)
+        logging.info(f"Cloning {self.app_git_repo} into {repo_dir}")
+        os.makedirs(self.repo_cache_dir, exist_ok=True)
+        repo = Repo.clone_from(self.app_git_repo, repo_dir, depth=1, single_branch=True)
+        if revision and repo.head.commit.hexsha != revision:
+            repo.git.fetch("--depth", "1", "origin", revision)
+            repo.git.reset("--hard", "FETCH_HEAD")
+        return repo
 
     def get_existing_container(self, only_running: bool = False):
         logging.info(
@@ -88,16 +233,15 @@ class AppRunner:
             container.wait()
             logging.info(f"Container with name {self.app_image} stopped")
             self.container = None
+            self.revision = None
 
-    def get_status(self):
-        logging.info("Getting the app status")
+    def check_status(self):
         if self.healthcheck_api:
             try:
-                response = requests.get(
+                response = self.health_session.get(
                     f"http://localhost:{self.app_port}{self.healthcheck_api}", timeout=5
                 )
                 if response.status_code == 200:
-                    logging.info(f"App healthcheck OK")
                     return "healthy"
                 else:
                     logging.info(f"App healthcheck FAIL")
@@ -105,54 +249,61 @@ class AppRunner:
             except (requests.exceptions.RequestException, requests.exceptions.Timeout):
                 logging.info(f"App healthcheck FAIL. Trying check running container")
 
-        if self.get_existing_container(only_running=True):
-            logging.info(f"App healthcheck OK")
+        if self.client.containers.list(filters={"name": self.app_image}):
             return "healthy"
+        elif self.get_standby_container():
+            return "standby"
         else:
             logging.info(f"App healthcheck FAIL")
             return "app_failed_worker_running"
 
-    def get_memory_usage(self):
-        if not self.container:
-            logging.info(f"Memory usage empty")
-            return 0
-
-        stats = self.container.stats(stream=False)
-        memory_stats = stats.get("memory_stats", {})
-        memory_usage = memory_stats.get("usage", 0)
-        logging.info(f"Memory usage {memory_usage}")
-        total_memory = memory_stats.get("limit", 1)
-
-        logging.info(f"Memory limit {total_memory}")
+    def get_status(self):
+        status = self.sampler.latest("status")
+        if status is None:
+            # Nothing sampled yet, answer the first request directly
+            status = self.check_status()
+            self.sampler.record("status", status)
+        return status
 
-        memory_usage_percent = (memory_usage / total_memory) * 100
-        logging.info(f"Memory usage percent usage/limit {memory_usage_percent}%")
-        return memory_usage_percent
+    def get_memory_usage(self):
+        return self.sampler.latest("memory_usage", 0)
 
     def get_cpu_usage(self):
-        if not self.container:
-            logging.info(f"CPU usage empty")
-            return 0
+        return self.sampler.latest("cpu_usage", 0)
 
-        stats = self.container.stats(stream=False)
-        cpu_stats = stats.get("cpu_stats", {})
-        precpu_stats = stats.get("precpu_stats", {})
-        cpu_usage = cpu_stats.get("cpu_usage", {})
-        precpu_usage = precpu_stats.get("cpu_usage", {})
+    def get_pressure_metrics(self):
+        # Only sampled from the container's cgroup, left out on docker stats
+        metrics = {metric: self.sampler.latest(metric) for metric in PRESSURE_METRICS}
+        return {metric: value for metric, value in metrics.items() if value is not None}
 
-        cpu_delta = cpu_usage.get("total_usage", 0) - precpu_usage.get("total_usage", 0)
-        system_cpu_delta = cpu_stats.get("system_cpu_usage", 0) - precpu_stats.get(
-            "system_cpu_usage", 0
-        )
-
-        if system_cpu_delta > 0 and cpu_delta > 0:
-            cpu_usage_percent = (
-                (cpu_delta / system_cpu_delta)
-                * len(cpu_usage.get("percpu_usage", []))
-                * 100
-            )
-            logging.info(f"CPU usage {cpu_usage_percent}%")
-            return cpu_usage_percent
+    def get_active_connections(self):
+        # None when the count can not be told, the master then stops waiting
+        # for the connections to drain
+        container = self.get_existing_container(only_running=True)
+        if not container:
+            return 0
+        pid = container.attrs.get("State", {}).get("Pid")
+        if not pid:
+            return None
+        # Established (state 01) TCP connections on the app port, from the
+        # network namespace of the container's main process. Nothing needs to
+        # run inside the app container for it.
+        local_port = f":{int(self.app_port):04X}"
+        active_connections = 0
+        try:
+            for name in ("tcp", "tcp6"):
+                with open(os.path.join(PROC_ROOT, str(pid), "net", name)) as table:
+                    for line in table:
+                        fields = line.split()
+                        if len(fields) > 3 and fields[1].endswith(local_port) and fields[3] == "01":
+                            active_connections += 1
+        except OSError as e:
+            logging.warning(f"Failed to read the connections of container {container.id}: {e!r}")
+            return None
+        return active_connections
 
-        logging.info(f"CPU usage empty")
-        return 0
+    def get_sample_ages(self):
+        return {
+            f"{metric}_age": self.sampler.age(metric)
+            for metric in ("status", "memory_usage", "cpu_usage")
+        }
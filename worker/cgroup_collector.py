@@ -0,0 +1,149 @@
+import logging
+import os
+import time
+
+# Where the host's cgroup v2 hierarchy is mounted in the agent container
+CGROUP_ROOT = os.environ.get("CGROUP_ROOT", "/sys/fs/cgroup")
+
+# Container cgroup relative to the root, with the systemd and the cgroupfs
+# cgroup drivers of docker
+CONTAINER_CGROUPS = ("system.slice/docker-{id}.scope", "docker/{id}")
+
+
+def read_keyed(text):
+    # "usage_usec 1234\nnr_periods 10\n..."
+    values = {}
+    for line in text.splitlines():
+        key, _, value = line.partition(" ")
+        if value.isdigit():
+            values[key] = int(value)
+    return values
+
+
+def read_pressure(text):
+    # "some avg10=0.12 avg60=0.05 avg300=0.01 total=1234", the share of time
+    # in % some task of the cgroup was stalled over the last 10 seconds
+    for line in text.splitlines():
+        fields = line.split()
+        if fields and fields[0] == "some":
+            for field in fields[1:]:
+                key, _, value = field.partition("=")
+                if key == "avg10":
+                    return float(value)
+    return None
+
+
+def read_io_stat(text):
+    # "8:0 rbytes=1024 wbytes=2048 rios=1 wios=2 dbytes=0 dios=0", per device
+    totals = {"rbytes": 0, "wbytes": 0}
+    for line in text.splitlines():
+        for field in line.split()[1:]:
+            key, _, value = field.partition("=")
+            if key in totals:
+                totals[key] += int(value)
+    return totals
+
+
+def cpu_limit(text):
+    # "200000 100000" is a quota of 2 CPUs, "max 100000" no quota
+    fields = text.split()
+    if len(fields) < 2 or fields[0] == "max":
+        return float(os.cpu_count() or 1)
+    return int(fields[0]) / int(fields[1])
+
+
+def host_memory():
+    with open("/proc/meminfo") as meminfo:
+        for line in meminfo:
+            if line.startswith("MemTotal:"):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+# Reads the usage of one container straight from its cgroup v2 files: a few
+# small reads per sample instead of a docker API round trip, so it can sample
+# often. Besides the usage it reports how much the container is held back,
+# CFS throttling and pressure stall information.
+class CgroupCollector:
+    def __init__(self, path):
+        self.path = path
+        # (monotonic time, cpu.stat, io.stat) of the previous sample
+        self.previous = None
+
+    @classmethod
+    def for_container(cls, container_id, root=CGROUP_ROOT):
+        if not os.path.exists(os.path.join(root, "cgroup.controllers")):
+            # cgroup v1 or the hierarchy is not mounted, docker stats it is
+            return None
+        for pattern in CONTAINER_CGROUPS:
+            path = os.path.join(root, pattern.format(id=container_id))
+            if os.path.isdir(path):
+                return cls(path)
+        return None
+
+    def read(self, name):
+        with open(os.path.join(self.path, name)) as file:
+            return file.read()
+
+    def read_optional(self, name):
+        # Controllers that are not enabled and kernels without PSI lack files
+        try:
+            return self.read(name)
+        except FileNotFoundError:
+            return None
+
+    def sample(self):
+        now = time.monotonic()
+        cpu_stat = read_keyed(self.read("cpu.stat"))
+        io_text = self.read_optional("io.stat")
+        io_stat = read_io_stat(io_text) if io_text is not None else None
+
+        sample = {"memory_usage": self.memory_usage_percent()}
+        for metric, name in (
+            ("cpu_pressure", "cpu.pressure"),
+            ("memory_pressure", "memory.pressure"),
+            ("io_pressure", "io.pressure"),
+        ):
+            text = self.read_optional(name)
+            sample[metric] = read_pressure(text) if text is not None else None
+
+        previous, self.previous = self.previous, (now, cpu_stat, io_stat)
+        if previous is None:
+            # Rates need two samples
+            return sample
+        elapsed = now - previous[0]
+        if elapsed <= 0:
+            return sample
+        previous_cpu, previous_io = previous[1], previous[2]
+
+        # Relative to the CPUs the container may use, 100 is the whole quota
+        cpus = cpu_limit(self.read_optional("cpu.max") or "max")
+        usage = cpu_stat.get("usage_usec", 0) - previous_cpu.get("usage_usec", 0)
+        sample["cpu_usage"] = min(100.0, max(0.0, usage / (elapsed * 1e6 * cpus) * 100))
+
+        # Share of the CFS periods in which the quota ran out
+        periods = cpu_stat.get("nr_periods", 0) - previous_cpu.get("nr_periods", 0)
+        throttled = cpu_stat.get("nr_throttled", 0) - previous_cpu.get("nr_throttled", 0)
+        sample["cpu_throttled"] = throttled / periods * 100 if periods > 0 else 0.0
+
+        if io_stat is not None and previous_io is not None:
+            sample["io_read_bytes_per_second"] = (
+                io_stat["rbytes"] - previous_io["rbytes"]
+            ) / elapsed
+            sample["io_write_bytes_per_second"] = (
+                io_stat["wbytes"] - previous_io["wbytes"]
+            ) / elapsed
+        return sample
+
+    def memory_usage_percent(self):
+        current = int(self.read("memory.current"))
+        # Page cache that can be dropped is not counted, like docker stats does
+        inactive_file = read_keyed(self.read_optional("memory.stat") or "").get(
+            "inactive_file", 0
+        )
+        limit = self.read_optional("memory.max")
+        limit = host_memory() if limit is None or limit.strip() == "max" else int(limit)
+        if not limit:
+            logging.warning(f"No memory limit known for cgroup {self.path}")
+            return 0.0
+        return max(0, current - inactive_file) / limit * 100
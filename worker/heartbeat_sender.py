@@ -0,0 +1,61 @@
+import logging
+import threading
+import time
+
+import requests
+
+
+class HeartbeatSender(threading.Thread):
+    def __init__(self, worker, master_url, interval, host=None, full_every=30):
+        super().__init__(daemon=True)
+        self.worker = worker
+        self.heartbeat_url = f"{master_url.rstrip('/')}/heartbeat"
+        self.interval = interval
+        self.host = host
+        self.full_every = full_every
+        self.session = requests.Session()
+        self.seq = 0
+        self.acked_status = None
+
+    def run(self):
+        logging.info(
+            f"Sending heartbeats to {self.heartbeat_url} every {self.interval} sec"
+        )
+        while True:
+            started = time.monotonic()
+            try:
+                self.send()
+            except Exception as e:
+                logging.warning(f"Heartbeat to {self.heartbeat_url} failed: {e!r}")
+                self.acked_status = None
+            time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def send(self):
+        status = {
+            key: round(value, 1) if isinstance(value, float) else value
+            for key, value in self.worker.get_status().items()
+        }
+        self.seq += 1
+        full = self.acked_status is None or self.seq % self.full_every == 0
+        if full:
+            changes = status
+        else:
+            changes = {
+                key: value
+                for key, value in status.items()
+                if self.acked_status.get(key) != value
+            }
+
+        response = self.session.post(
+            self.heartbeat_url,
+            json={
+                "worker_name": self.worker.worker_name,
+                "host": self.host,
+                "seq": self.seq,
+                "full": full,
+                "status": changes,
+            },
+            timeout=self.interval,
+        )
+        # Anything but an ack (e.g. 409 after a missed beat) forces a full resync
+        self.acked_status = status if response.ok else None
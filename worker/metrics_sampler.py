@@ -0,0 +1,136 @@
+import logging
+import os
+import threading
+import time
+
+from cgroup_collector import CgroupCollector
+
+
+def memory_usage_percent(stats):
+    memory_stats = stats.get("memory_stats", {})
+    memory_usage = memory_stats.get("usage", 0)
+    total_memory = memory_stats.get("limit", 1) or 1
+    return (memory_usage / total_memory) * 100
+
+
+def cpu_usage_percent(stats, cpus=None):
+    # Relative to the container's CPU quota, or to all CPUs without one
+    cpu_stats = stats.get("cpu_stats", {})
+    precpu_stats = stats.get("precpu_stats", {})
+    cpu_usage = cpu_stats.get("cpu_usage", {})
+    precpu_usage = precpu_stats.get("cpu_usage", {})
+
+    cpu_delta = cpu_usage.get("total_usage", 0) - precpu_usage.get("total_usage", 0)
+    system_cpu_delta = cpu_stats.get("system_cpu_usage", 0) - precpu_stats.get(
+        "system_cpu_usage", 0
+    )
+    # percpu_usage is not reported on cgroup v2 hosts
+    online_cpus = cpu_stats.get("online_cpus") or len(cpu_usage.get("percpu_usage") or []) or 1
+
+    if system_cpu_delta > 0 and cpu_delta > 0:
+        return min(
+            100.0,
+            (cpu_delta / system_cpu_delta) * online_cpus / (cpus or online_cpus) * 100,
+        )
+    return 0
+
+
+def container_cpus(container):
+    # CPUs the container may use by its quota, None without a quota
+    host_config = container.attrs.get("HostConfig", {})
+    if host_config.get("NanoCpus"):
+        return host_config["NanoCpus"] / 1e9
+    if host_config.get("CpuQuota", 0) > 0 and host_config.get("CpuPeriod"):
+        return host_config["CpuQuota"] / host_config["CpuPeriod"]
+    return None
+
+
+class MetricsSampler:
+    def __init__(self, app_runner, health_interval=2, retry_interval=1, cgroup_interval=None):
+        self.app_runner = app_runner
+        self.health_interval = health_interval
+        self.retry_interval = retry_interval
+        # Reading cgroup files is cheap enough to sample more often than
+        # docker pushes stats
+        self.cgroup_interval = cgroup_interval or float(
+            os.environ.get("CGROUP_SAMPLE_INTERVAL", 0.5)
+        )
+        # metric name -> (value, monotonic time the value was sampled)
+        self.samples = {}
+        self._lock = threading.Lock()
+        self._started = False
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._sample_stats, daemon=True).start()
+        threading.Thread(target=self._sample_health, daemon=True).start()
+        logging.info("Metrics sampler started")
+
+    def record(self, metric, value):
+        self.samples[metric] = (value, time.monotonic())
+
+    def latest(self, metric, default=None):
+        return self.samples.get(metric, (default, None))[0]
+
+    def age(self, metric):
+        sample = self.samples.get(metric)
+        if sample is None:
+            return None
+        return time.monotonic() - sample[1]
+
+    def _sample_stats(self):
+        while True:
+            container = self.app_runner.container
+            if container is None:
+                self.record("cpu_usage", 0)
+                self.record("memory_usage", 0)
+                time.sleep(self.health_interval)
+                continue
+
+            collector = CgroupCollector.for_container(container.id)
+            if collector is not None:
+                self._sample_cgroup(container, collector)
+            else:
+                self._sample_docker_stats(container)
+            time.sleep(self.retry_interval)
+
+    def _sample_cgroup(self, container, collector):
+        sampled = set()
+        try:
+            while self.app_runner.container is container:
+                started = time.monotonic()
+                for metric, value in collector.sample().items():
+                    self.record(metric, value)
+                    sampled.add(metric)
+                time.sleep(max(0.0, started + self.cgroup_interval - time.monotonic()))
+        except OSError as e:
+            # The cgroup goes away with the container
+            logging.warning(f"Reading cgroup of container {container.id} failed: {e!r}")
+        finally:
+            # Signals of a container that is gone must not be reported on
+            for metric in sampled - {"cpu_usage", "memory_usage"}:
+                self.samples.pop(metric, None)
+
+    def _sample_docker_stats(self, container):
+        try:
+            cpus = container_cpus(container)
+            # One long-lived subscription per container, docker pushes a
+            # sample with precpu_stats filled in about every second
+            for stats in container.stats(stream=True, decode=True):
+                if self.app_runner.container is not container:
+                    break
+                self.record("cpu_usage", cpu_usage_percent(stats, cpus))
+                self.record("memory_usage", memory_usage_percent(stats))
+        except Exception as e:
+            logging.warning(f"Stats stream of container {container.id} failed: {e!r}")
+
+    def _sample_health(self):
+        while True:
+            try:
+                self.record("status", self.app_runner.check_status())
+            except Exception as e:
+                logging.warning(f"App status check failed: {e!r}")
+            time.sleep(self.health_interval)
@@ -1,8 +1,31 @@
+import asyncio
+import logging
 import os
-from flask import Flask, jsonify, make_response
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
 from app_runner import AppRunner
+from heartbeat_sender import HeartbeatSender
+
+ACTIVE_STATES = ("pending", "running")
+
 
-app = Flask(__name__)
+def vm_capacity():
+    # The agent container sees the VM's processors and memory, the master
+    # packs app containers of all apps against it
+    capacity = {"vm_cpus": os.cpu_count(), "vm_memory_mb": None}
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemTotal:"):
+                    capacity["vm_memory_mb"] = int(line.split()[1]) // 1024
+                    break
+    except OSError:
+        pass
+    return capacity
 
 
 class Worker:
@@ -14,6 +37,8 @@ class Worker:
         healthcheck_api,
         app_dockerfile,
         app_git_repo,
+        executor_threads=2,
+        history_size=50,
     ):
         self.worker_name = worker_name
         self.app_image = app_image
@@ -28,12 +53,83 @@ class Worker:
             self.app_dockerfile,
             self.app_git_repo,
         )
+        # Docker and git calls block, they run here instead of on the event loop
+        self.executor = ThreadPoolExecutor(
+            max_workers=executor_threads, thread_name_prefix="docker"
+        )
+        # Container changes are applied one at a time, in submission order
+        self.operation_lock = asyncio.Lock()
+        self.operations = {}
+        self.finished = deque()
+        self.history_size = history_size
+        self.tasks = set()
+        self.capacity = vm_capacity()
+
+    def submit(self, kind, func, *args):
+        # A retried request joins the operation already in flight, one with
+        # other arguments, like a new revision, queues behind it
+        for operation in self.operations.values():
+            if (
+                operation["kind"] == kind
+                and operation["args"] == args
+                and operation["state"] in ACTIVE_STATES
+            ):
+                return operation
+        operation = {
+            "id": str(uuid.uuid4()),
+            "kind": kind,
+            "state": "pending",
+            "step": None,
+            "error": None,
+            "created_at": time.time(),
+            "finished_at": None,
+            "args": args,
+        }
+        self.operations[operation["id"]] = operation
+        operation["task"] = task = asyncio.create_task(self._run(operation, func, args))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return operation
+
+    async def _run(self, operation, func, args):
+        def on_step(step):
+            operation["step"] = step
+
+        try:
+            async with self.operation_lock:
+                operation["state"] = "running"
+                await asyncio.get_running_loop().run_in_executor(
+                    self.executor, lambda: func(*args, on_step=on_step)
+                )
+            operation["state"] = "succeeded"
+        except Exception as e:
+            logging.exception(f"{operation['kind']} operation {operation['id']} failed")
+            operation["state"] = "failed"
+            operation["error"] = str(e)
+        finally:
+            operation["finished_at"] = time.time()
+            self.finished.append(operation["id"])
+            while len(self.finished) > self.history_size:
+                self.operations.pop(self.finished.popleft(), None)
+
+    @staticmethod
+    def operation_view(operation):
+        return {
+            key: value for key, value in operation.items() if key not in ("task", "args")
+        }
 
-    def start_app(self):
-        self.app_runner.start()
+    def start_app(self, image_ref=None, resources=None, revision=None):
+        return self.submit(
+            "start_app", self.app_runner.start, image_ref, resources, revision
+        )
+
+    def prepare_app(self, image_ref=None, resources=None, revision=None):
+        return self.submit(
+            "prepare_app", self.app_runner.prepare, image_ref, resources, revision
+        )
 
     def stop_app(self):
-        self.app_runner.stop()
+        return self.submit("stop_app", lambda on_step: self.app_runner.stop())
 
     def get_status(self):
         return {
@@ -41,36 +137,119 @@ class Worker:
             "status": self.app_runner.get_status(),
             "memory_usage": self.app_runner.get_memory_usage(),
             "cpu_usage": self.app_runner.get_cpu_usage(),
+            **self.app_runner.get_pressure_metrics(),
+            "app_revision": self.app_runner.revision,
+            **self.app_runner.get_sample_ages(),
+            **self.capacity,
         }
 
 
-worker = Worker(
-    worker_name=os.environ["WORKER_NAME"],
-    app_image=os.environ["APP_IMAGE"],
-    app_port=os.environ["APP_PORT"],
-    healthcheck_api=os.environ["HEALTHCHECK_API"],
-    app_dockerfile=os.environ["APP_DOCKERFILE"],
-    app_git_repo=os.environ["APP_GIT_REPO"],
-)
+async def status(request):
+    # Served from the default thread pool, builds never hold it up
+    status_ = await asyncio.to_thread(request.app["worker"].get_status)
+    return web.json_response(status_)
+
+
+async def connections(request):
+    worker = request.app["worker"]
+    active_connections = await asyncio.to_thread(
+        worker.app_runner.get_active_connections
+    )
+    return web.json_response({"active_connections": active_connections})
+
+
+async def stop_app(request):
+    worker = request.app["worker"]
+    operation = worker.stop_app()
+    await asyncio.shield(operation["task"])
+    if operation["state"] == "failed":
+        return web.json_response(
+            {
+                "message": f"Failed to stop app: {operation['error']}",
+                "operation_id": operation["id"],
+            },
+            status=500,
+        )
+    return web.json_response(
+        {"message": "App stopped successfully", "operation_id": operation["id"]}
+    )
 
 
-@app.route("/status", methods=["GET"])
-def status():
-    status_ = worker.get_status()
-    return jsonify(status_)
+def accepted(operation):
+    return web.json_response(
+        {"operation_id": operation["id"], "state": operation["state"]},
+        status=202,
+        headers={"Location": f"/operations/{operation['id']}"},
+    )
 
 
-@app.route("/stop_app", methods=["POST"])
-def stop_app():
-    worker.stop_app()
-    return make_response(jsonify({"message": "App stopped successfully"}), 200)
+async def start_app(request):
+    body = (await request.json() if request.can_read_body else None) or {}
+    return accepted(
+        request.app["worker"].start_app(
+            body.get("image"), body.get("resources"), body.get("revision")
+        )
+    )
 
 
-@app.route("/start_app", methods=["POST"])
-def start_app():
-    worker.start_app()
-    return make_response(jsonify({"message": "App started successfully"}), 200)
+async def prepare_app(request):
+    body = (await request.json() if request.can_read_body else None) or {}
+    return accepted(
+        request.app["worker"].prepare_app(
+            body.get("image"), body.get("resources"), body.get("revision")
+        )
+    )
+
+
+async def get_operation(request):
+    worker = request.app["worker"]
+    operation = worker.operations.get(request.match_info["operation_id"])
+    if operation is None:
+        raise web.HTTPNotFound()
+    return web.json_response(worker.operation_view(operation))
+
+
+async def get_operations(request):
+    worker = request.app["worker"]
+    return web.json_response(
+        [worker.operation_view(operation) for operation in worker.operations.values()]
+    )
+
+
+async def create_app():
+    worker = Worker(
+        worker_name=os.environ["WORKER_NAME"],
+        app_image=os.environ["APP_IMAGE"],
+        app_port=os.environ["APP_PORT"],
+        healthcheck_api=os.environ["HEALTHCHECK_API"],
+        app_dockerfile=os.environ["APP_DOCKERFILE"],
+        app_git_repo=os.environ["APP_GIT_REPO"],
+        executor_threads=int(os.environ.get("WORKER_EXECUTOR_THREADS", 2)),
+    )
+
+    if os.environ.get("MASTER_URL"):
+        HeartbeatSender(
+            worker,
+            master_url=os.environ["MASTER_URL"],
+            interval=float(os.environ.get("HEARTBEAT_INTERVAL", 2)),
+            host=os.environ.get("WORKER_HOST"),
+        ).start()
+
+    app = web.Application()
+    app["worker"] = worker
+    app.add_routes(
+        [
+            web.get("/status", status),
+            web.get("/connections", connections),
+            web.post("/stop_app", stop_app),
+            web.post("/start_app", start_app),
+            web.post("/prepare_app", prepare_app),
+            web.get("/operations", get_operations),
+            web.get("/operations/{operation_id}", get_operation),
+        ]
+    )
+    return app
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=int(os.environ["WORKER_PORT"]))
+    web.run_app(create_app(), host="0.0.0.0", port=int(os.environ["WORKER_PORT"]))